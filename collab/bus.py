@@ -0,0 +1,406 @@
+import logging, socket, itertools, hmac, hashlib, binascii, os
+
+from .model import CollabModel
+from .connection import SocketServer, LoopSocket, Broadcast
+from .shard import ModelService, shard_for
+from .optransform import TEXT_TYPES
+
+logger = logging.getLogger('Sublime Collaboration')
+
+# Node ids go from 1 to MAX_NODES - 1, user ids handed out by node n are n plus multiples of MAX_NODES
+MAX_NODES = 256
+
+# The broker opens every connection with {'challenge': nonce}. Nodes and the
+# broker prove to each other that they know the secret they share by signing
+# the challenge of the other side, nothing else is accepted before that.
+#
+# Messages a node sends to the broker:
+#   {'hello': node, 'auth': digest, 'challenge': nonce, 'docs': [...]}
+#                                        joins the bus with the documents in its storage, node ids must be unique
+#   {'claim': doc}                       asks who owns doc, see BusBroker.pick_owner
+#   {'subscribe': doc} / {'unsubscribe'} starts or stops relaying the ops of doc to this node
+#   {'publish': doc, 'op': op}           sent by the owner for every op, relayed to the subscribers
+#   {'docs': id}                         lists every owned document
+#   {'presence': doc, 'entries': [...]}  relayed with 'from' added to the other nodes with doc open,
+#                                        entries None asks them for all of their users, see PresenceHub
+#   {'to': node, ...}                    relayed to node with 'from' added, carries calls and results
+# The broker answers hello with {'welcome': digest}, claims with {'claim': doc,
+# 'owner': node}, relays ops as {'doc': doc, 'op': op} and tells everybody
+# {'lost': node, 'docs': [...]} when a node goes away. Its documents get a new
+# owner on their next claim.
+
+def bus_digest(secret, purpose, nonce, node):
+    return hmac.new(secret.encode('utf-8'), '{0}:{1}:{2}'.format(purpose, nonce, node).encode('utf-8'), hashlib.sha256).hexdigest()
+
+def new_nonce():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+class BusBroker(object):
+    """Relays messages between the nodes of a cluster and decides which node owns each document.
+
+    Only nodes that know secret may join. The broker relays calls into the
+    models of the nodes, so keep it on a private network."""
+    def __init__(self, host='127.0.0.1', port=6634, secret=None):
+        if not secret:
+            raise ValueError('The op bus needs a secret shared by the broker and its nodes')
+        self.secret = secret
+        self.server = SocketServer(host, port)
+        self.nodes = {}
+        self.owners = {}
+        # docname -> node whose storage has the document
+        self.stored = {}
+        self.subscribers = {}
+        self.server.on('connection', self.on_connection)
+
+    def run_forever(self):
+        self.server.run_forever()
+
+    def close(self):
+        self.server.close()
+
+    def on_connection(self, connection):
+        peer = {'node': None, 'challenge': new_nonce()}
+        connection.on('message', lambda message: self.on_message(connection, peer, message))
+        connection.on('close', lambda: self.on_close(peer))
+        connection.send({'challenge': peer['challenge']})
+
+    def on_message(self, connection, peer, message):
+        if 'hello' in message:
+            node = message['hello']
+            if not isinstance(node, int) or not 0 < node < MAX_NODES or node in self.nodes or peer['node'] is not None:
+                logger.error("Refusing node {0} on the bus".format(node))
+                return connection.abort()
+            auth, challenge, docs = message.get('auth'), message.get('challenge'), message.get('docs', [])
+            if not isinstance(auth, TEXT_TYPES) or not hmac.compare_digest(auth.encode('utf-8'), bus_digest(self.secret, 'hello', peer['challenge'], node).encode('utf-8')):
+                logger.error("Node {0} failed to authenticate on the bus".format(node))
+                return connection.abort()
+            if not isinstance(challenge, TEXT_TYPES) or not isinstance(docs, list) or not all(isinstance(docname, TEXT_TYPES) for docname in docs):
+                logger.error("Malformed hello from node {0} on the bus".format(node))
+                return connection.abort()
+            peer['node'] = node
+            self.nodes[node] = connection
+            for docname in docs:
+                self.stored.setdefault(docname, node)
+            connection.send({'welcome': bus_digest(self.secret, 'welcome', challenge, node)})
+            return
+
+        node = peer['node']
+        if node is None:
+            logger.error("Message {0} before hello on the bus".format(message))
+            return connection.abort()
+
+        if 'to' in message:
+            target = self.nodes.get(message['to'])
+            if target is not None:
+                message['from'] = node
+                target.send(message)
+            elif 'call' in message and message.get('id') is not None:
+                connection.send({'from': message['to'], 'result': message['id'], 'args': ['Node {0} is not on the bus'.format(message['to']), None]})
+        elif 'publish' in message:
+            broadcast = Broadcast({'doc': message['publish'], 'op': message['op']})
+            for subscriber in self.subscribers.get(message['publish'], ()):
+                if subscriber != node:
+                    self.nodes[subscriber].send_broadcast(broadcast)
+        elif 'claim' in message:
+            docname = message['claim']
+            if docname not in self.owners:
+                self.owners[docname] = self.pick_owner(docname)
+            connection.send({'claim': docname, 'owner': self.owners[docname]})
+        elif 'presence' in message:
+            docname = message['presence']
+            targets = set(self.subscribers.get(docname, ()))
+            if docname in self.owners:
+                targets.add(self.owners[docname])
+            targets.discard(node)
+            broadcast = Broadcast({'presence': docname, 'entries': message.get('entries'), 'from': node})
+            for target in targets:
+                self.nodes[target].send_broadcast(broadcast)
+        elif 'subscribe' in message:
+            self.subscribers.setdefault(message['subscribe'], set()).add(node)
+        elif 'unsubscribe' in message:
+            subscribers = self.subscribers.get(message['unsubscribe'], set())
+            subscribers.discard(node)
+            if not subscribers: self.subscribers.pop(message['unsubscribe'], None)
+        elif 'docs' in message:
+            connection.send({'result': message['docs'], 'args': [None, sorted(set(self.owners) | set(self.stored))]})
+
+    def pick_owner(self, docname):
+        """The node whose storage has the document, or else one picked by its name, never the node that happens to ask first"""
+        node = self.stored.get(docname)
+        if node in self.nodes:
+            return node
+        nodes = sorted(self.nodes)
+        return nodes[shard_for(docname, len(nodes))]
+
+    def on_close(self, peer):
+        node = peer['node']
+        if node is None: return
+        del self.nodes[node]
+        docs = [docname for docname, owner in self.owners.items() if owner == node]
+        for docname in docs:
+            del self.owners[docname]
+        for docname in [docname for docname, owner in self.stored.items() if owner == node]:
+            del self.stored[docname]
+        for docname in list(self.subscribers):
+            self.subscribers[docname].discard(node)
+            if not self.subscribers[docname]: del self.subscribers[docname]
+        logger.warning("Node {0} left the bus, {1} documents lost their owner".format(node, len(docs)))
+        for connection in self.nodes.values():
+            connection.send({'lost': node, 'docs': docs})
+
+class BusModel(object):
+    """Stands in for CollabModel on one node of a cluster joined through a BusBroker.
+
+    Documents this node owns live in its own CollabModel. Calls for documents
+    owned elsewhere are forwarded through the broker to the owner, which
+    publishes their ops back to the nodes listening. Ops of a document are
+    only ever applied by its owner, so ordering stays per document while
+    connections are spread over the nodes. Remote listeners get the op but no
+    snapshots, like with ModelProxy."""
+    def __init__(self, options, loop):
+        if loop is None:
+            raise ValueError('The op bus needs the event loop server, it does not work in threaded mode')
+        if not options.get('busSecret'):
+            raise ValueError('The op bus needs busSecret, the secret shared with the broker')
+        self.options = options
+        self.node = options['node']
+        self.loop = loop
+        self.model = CollabModel(options, loop)
+        self.service = ModelService(self.model, self.on_service_message)
+        self.owners = {}
+        self.claims = {}
+        self.callbacks = {}
+        self.listeners = {}
+        self.subscriptions = {}
+        self.cancelled = []
+        # The server's PresenceHub, it gets the selections of users on other nodes
+        self.presence = None
+        self.requestids = itertools.count(1)
+        self.stats = {'broadcasts': 0, 'frames_encoded': 0, 'encodes_saved': 0}
+        self.closed = False
+        # Messages held back until the broker has challenged us, None once we said hello
+        self.backlog = []
+        self.challenge = new_nonce()
+        self.welcomed = False
+
+        host, port = options.get('busHost', '127.0.0.1'), options.get('busPort', 6634)
+        sock = socket.create_connection((host, port))
+        self.bus = LoopSocket(sock, (host, port), loop)
+        self.bus.on('message', self.on_bus_message)
+        self.bus.on('close', self.on_bus_close)
+
+    def send(self, message):
+        if self.backlog is not None:
+            return self.backlog.append(message)
+        self.bus.send(message)
+
+    def on_bus_close(self):
+        if not self.closed:
+            logger.error("Node {0} lost its connection to the bus".format(self.node))
+
+    def on_challenge(self, challenge):
+        def hello(error, docs):
+            if error:
+                logger.error("Node {0} could not list its stored documents: {1}".format(self.node, error))
+            self.bus.send({'hello': self.node, 'auth': bus_digest(self.options['busSecret'], 'hello', challenge, self.node), 'challenge': self.challenge, 'docs': docs or []})
+            backlog, self.backlog = self.backlog, None
+            for message in backlog:
+                self.bus.send(message)
+        self.model.get_docs(hello)
+
+    def on_bus_message(self, message):
+        if not self.welcomed:
+            # Nothing but the handshake counts until the broker has proven it knows the secret
+            if 'challenge' in message and self.backlog is not None and isinstance(message['challenge'], TEXT_TYPES):
+                return self.on_challenge(message['challenge'])
+            welcome = message.get('welcome')
+            if isinstance(welcome, TEXT_TYPES) and self.backlog is None and hmac.compare_digest(welcome.encode('utf-8'), bus_digest(self.options['busSecret'], 'welcome', self.challenge, self.node).encode('utf-8')):
+                self.welcomed = True
+                return
+            logger.error("Node {0} got {1} from a bus that has not authenticated".format(self.node, message))
+            return self.bus.abort()
+
+        if 'result' in message:
+            owner, method, args, callback = self.callbacks.pop(message['result'], (None, None, None, None))
+            if callback: callback(*message['args'])
+        elif 'op' in message:
+            self.on_bus_op(message['doc'], message['op'])
+        elif 'presence' in message:
+            if self.presence is not None:
+                self.presence.receive(message['presence'], message['entries'], message['from'])
+        elif 'call' in message:
+            requestid = (message['from'], message['id']) if message.get('id') is not None else None
+            self.service.handle(message['call'], requestid, tuple(message['args']))
+        elif 'claim' in message:
+            self.owners[message['claim']] = message['owner']
+            for callback in self.claims.pop(message['claim'], []):
+                callback(message['owner'])
+        elif 'lost' in message:
+            self.on_node_lost(message['lost'], message['docs'])
+
+    def on_service_message(self, message):
+        if message[0] == 'op':
+            self.send({'publish': message[1], 'op': message[2]})
+        elif message[1] is not None:
+            node, requestid = message[1]
+            self.send({'to': node, 'result': requestid, 'args': list(message[2])})
+
+    def on_bus_op(self, docname, op):
+        listeners = self.listeners.get(docname)
+        if not listeners: return
+        broadcast = Broadcast(op)
+        for listener in list(listeners):
+            listener(op, None, None, broadcast)
+        self.stats['broadcasts'] += 1
+        self.stats['frames_encoded'] += broadcast.encoded
+        self.stats['encodes_saved'] += broadcast.shared
+
+    def on_node_lost(self, node, docs):
+        if self.presence is not None:
+            self.presence.forget(node)
+        for docname in docs:
+            self.owners.pop(docname, None)
+            if self.listeners.pop(docname, None):
+                logger.warning("Owner of {0} left the bus, its listeners here will not see any more ops".format(docname))
+            self.subscriptions.pop(docname, None)
+        for requestid, (owner, method, args, callback) in list(self.callbacks.items()):
+            if owner == node:
+                del self.callbacks[requestid]
+                callback(*self.failed(method, args, 'Node {0} left the bus'.format(node)))
+
+    def failed(self, method, args, error):
+        if method in ('create', 'delete'):
+            return (error,)
+        if method == 'apply_ops':
+            return ([(error, None)] * len(args[1]),)
+        return (error, None)
+
+    def with_owner(self, docname, callback):
+        """Calls back with the node owning docname, claims are asked for once and shared by concurrent callers"""
+        if docname in self.owners:
+            return callback(self.owners[docname])
+        if docname in self.claims:
+            return self.claims[docname].append(callback)
+        self.claims[docname] = [callback]
+        self.send({'claim': docname})
+
+    def call(self, docname, method, args, callback=None):
+        def route(owner):
+            if owner == self.node:
+                return getattr(self.model, method)(*(args + ((callback,) if callback else ())))
+            requestid = None
+            if callback is not None:
+                requestid = next(self.requestids)
+                self.callbacks[requestid] = (owner, method, args, callback)
+            self.send({'to': owner, 'call': method, 'id': requestid, 'args': list(args)})
+        self.with_owner(docname, route)
+
+    def relay_presence(self, docname, entries):
+        self.send({'presence': docname, 'entries': entries})
+
+    def subscribe(self, docname):
+        self.subscriptions[docname] = self.subscriptions.get(docname, 0) + 1
+        if self.subscriptions[docname] == 1:
+            self.send({'subscribe': docname})
+
+    def unsubscribe(self, docname):
+        if docname not in self.subscriptions: return
+        self.subscriptions[docname] -= 1
+        if not self.subscriptions[docname]:
+            del self.subscriptions[docname]
+            self.send({'unsubscribe': docname})
+
+    def get_docs(self, callback):
+        def model_get_docs(error, docs):
+            if error: return callback(error, None)
+            def bus_get_docs(error, owned):
+                if error: return callback(error, None)
+                callback(None, sorted(set(docs) | set(owned)))
+            requestid = next(self.requestids)
+            self.callbacks[requestid] = (None, 'get_docs', (), bus_get_docs)
+            self.send({'docs': requestid})
+        self.model.get_docs(model_get_docs)
+
+    def create(self, docname, snapshot=None, callback=None):
+        self.call(docname, 'create', (docname, snapshot), callback)
+
+    def delete(self, docname, callback=None):
+        self.call(docname, 'delete', (docname,), callback)
+
+    def listen(self, docname, listener, callback=None):
+        self.register(docname, listener, 'listen', (docname,), callback)
+
+    def listen_data(self, docname, listener, since, callback):
+        self.register(docname, listener, 'listen_data', (docname, since), callback)
+
+    def register(self, docname, listener, method, args, callback):
+        def route(owner):
+            if owner == self.node:
+                return getattr(self.model, method)(*(args[:1] + (listener,) + args[1:] + (callback,)))
+            def listen(error, result):
+                if error or (docname, listener) in self.cancelled:
+                    self.unsubscribe(docname)
+                if error:
+                    return callback(error, None) if callback else None
+                if (docname, listener) in self.cancelled:
+                    # Removed again before the owner answered
+                    self.cancelled.remove((docname, listener))
+                    return self.call(docname, 'remove_listener', (docname,))
+                self.listeners.setdefault(docname, []).append(listener)
+                return callback(None, result) if callback else None
+            # Subscribing first means no op published after the owner registers us is missed
+            self.subscribe(docname)
+            self.call(docname, method, args, listen)
+        self.with_owner(docname, route)
+
+    def remove_listener(self, docname, listener):
+        if self.owners.get(docname) == self.node:
+            return self.model.remove_listener(docname, listener)
+        if listener not in self.listeners.get(docname, []):
+            if docname in self.subscriptions:
+                self.cancelled.append((docname, listener))
+            return
+        self.listeners[docname].remove(listener)
+        if not self.listeners[docname]: del self.listeners[docname]
+        self.unsubscribe(docname)
+        self.call(docname, 'remove_listener', (docname,))
+
+    def get_version(self, docname, callback):
+        self.call(docname, 'get_version', (docname,), callback)
+
+    def get_snapshot(self, docname, callback):
+        self.call(docname, 'get_snapshot', (docname,), callback)
+
+    def get_ops(self, docname, start, callback):
+        self.call(docname, 'get_ops', (docname, start), callback)
+
+    def get_data(self, docname, callback):
+        self.call(docname, 'get_data', (docname,), callback)
+
+    def apply_op(self, docname, op, callback):
+        self.apply_ops(docname, [(op, callback)])
+
+    def apply_ops(self, docname, batch):
+        def route(owner):
+            if owner == self.node:
+                return self.model.apply_ops(docname, batch)
+            def applied(results):
+                for (op, callback), (error, version) in zip(batch, results):
+                    callback(error, version)
+            self.call(docname, 'apply_ops', (docname, [op for op, callback in batch]), applied)
+        self.with_owner(docname, route)
+
+    def flush(self, callback=None):
+        self.model.flush(callback)
+
+    def close(self):
+        self.closed = True
+        self.model.close()
+        if self.loop.keep_running:
+            return self.bus.close()
+        # The server has stopped the loop already, the broker has to see us leave all the same
+        try:
+            self.bus.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.bus.sock.close()
@@ -1,11 +1,13 @@
-import logging
-from .doc import CollabDoc
-from .connection import ClientSocket
+import logging, threading, itertools
+from .doc import CollabDoc, FLUSH_POLICIES
+from .connection import ClientSocket, handshake_request
 
 logger = logging.getLogger('Sublime Collaboration')
 
 class CollabClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, reconnect_attempts=5, reconnect_delay=0.5, presence_interval=0.1, window=1, flush_policy='immediate', flush_interval=0.05):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError('Unknown flush policy {0}, expected one of {1}'.format(flush_policy, ', '.join(FLUSH_POLICIES)))
         self.docs = {}
         self.state = 'connecting'
 
@@ -14,20 +16,55 @@ class CollabClient:
         self.connected = False
         self.id = None
 
-        self.socket = ClientSocket(host, port)
+        self.host = host
+        self.port = port
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        # Our selection goes out at most once per presence_interval seconds
+        self.presence_interval = presence_interval
+        # Ops each document may have in flight, more than one needs a server that accepts pipelined ops
+        self.window = window
+        self.pipelining = False
+        # Numbers every op sent on the connection, across documents and reconnects
+        self.op_seqs = itertools.count(1)
+        # Edits typed within a flush window go out as one op, see FLUSH_POLICIES in doc.py
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        # Smoothed seconds from sending an op to its ack, None until the first one
+        self.rtt = None
+        self.attempt = 0
+        self.resume_id = None
+        # The server signs our user id with this, to take the id over again on a new connection
+        self.token = None
+        self.resume_token = None
+        # What the server authenticated us as on this connection, we go back to it if our resume is turned down
+        self.fresh_id = None
+        self.fresh_token = None
+        self.closing = False
+
+        self._events = {}
+
+        self.connect()
+
+    def connect(self):
+        self.socket = ClientSocket(self.host, self.port)
         self.socket.on('message', self.socket_message)
         self.socket.on('error', self.socket_error)
         self.socket.on('open', self.socket_open)
         self.socket.on('close', self.socket_close)
         self.socket.start()
 
-        self._events = {}
-
     def on(self, event, fct):
         if event not in self._events: self._events[event] = []
         self._events[event].append(fct)
         return self
 
+    def once(self, event, fct):
+        def wrapper(*args):
+            self.removeListener(event, wrapper)
+            fct(*args)
+        return self.on(event, wrapper)
+
     def removeListener(self, event, fct):
         if event not in self._events: return self
         self._events[event].remove(fct)
@@ -35,7 +72,7 @@ class CollabClient:
 
     def emit(self, event, *args):
         if event not in self._events: return self
-        for callback in self._events[event]:
+        for callback in list(self._events[event]):
             callback(*args)
         return self
 
@@ -43,10 +80,24 @@ class CollabClient:
         self.set_state('handshaking')
 
     def socket_close(self, reason=''):
-        self.set_state('closed', reason)
         self.socket = None
 
+        if self.state == 'ok':
+            self.resume_id = self.id
+            self.resume_token = self.token
+        if self.closing or self.resume_id is None or self.attempt >= self.reconnect_attempts:
+            return self.set_state('closed', reason)
+
+        self.attempt += 1
+        self.set_state('reconnecting')
+        logger.info('Connection lost, reconnecting (attempt {0} of {1})'.format(self.attempt, self.reconnect_attempts))
+        timer = threading.Timer(self.reconnect_delay * 2 ** (self.attempt - 1), self.connect)
+        timer.daemon = True
+        timer.start()
+
     def socket_error(self, error):
+        if self.state == 'reconnecting':
+            return logger.info('Reconnect failed: {0}'.format(error))
         self.emit('error', error)
 
     def socket_message(self, msg):
@@ -56,6 +107,16 @@ class CollabClient:
                 self.disconnect()
             else:
                 self.id = msg['auth']
+                self.token = msg.get('resume')
+                self.pipelining = bool(msg.get('pipeline'))
+                request = handshake_request(msg)
+                if request:
+                    self.send(request)
+                    self.socket.configure(request)
+                if self.resume_id is not None and self.docs:
+                    self.resume(msg.get('resume', False))
+                else:
+                    self.attempt = 0
                 self.set_state('ok')
             return
 
@@ -70,43 +131,74 @@ class CollabClient:
             return
 
         if 'doc' in msg and msg['doc'] in self.docs:
+            if msg.get('resumed') is False and self.id == self.resume_id:
+                self.id, self.token = self.fresh_id, self.fresh_token
+            elif msg.get('open') is True or 'resync' in msg:
+                # Only a connection that got a document back counts as working, a server
+                # that drops us on every resume does not keep us reconnecting forever
+                self.attempt = 0
             self.docs[msg['doc']].on_message(msg)
         else:
             logger.error('Unhandled message {0}'.format(msg))
 
+    def resume(self, supported):
+        """Picks the open documents back up on a new connection, the server takes over our old id"""
+        if supported:
+            self.fresh_id, self.fresh_token = self.id, self.token
+            self.id = self.resume_id
+            self.token = self.resume_token
+        for doc in list(self.docs.values()):
+            if supported or doc.state == 'opening':
+                doc.resume(self.resume_id, self.resume_token)
+            else:
+                doc.set_state('closed', 'server does not support resuming')
+                self.closed(doc.name)
+
     def set_state(self, state, data=None):
         if self.state is state: return
         self.state = state
 
-        if state is 'closed':
+        if state == 'closed':
             self.id = None
         self.emit(state, data)
 
     def send(self, data):
-        if self.state is not "closed":
+        if self.state != 'closed' and self.socket:
             self.socket.send(data)
 
+    def call_later(self, delay, callback):
+        """Runs callback on the connection thread after delay seconds, None while there is no connection"""
+        if self.socket is None: return None
+        return self.socket.loop.call_later(delay, callback)
+
+    def add_rtt_sample(self, sample):
+        """Folds in a measured round trip, weighted like TCP does so one slow ack does not swing it"""
+        self.rtt = sample if self.rtt is None else self.rtt * 0.875 + sample * 0.125
+
     def disconnect(self):
-        if self.state is not "closed":
+        self.closing = True
+        if self.state != 'closed' and self.socket:
             self.socket.close()
+        elif self.state == 'reconnecting':
+            self.set_state('closed', 'disconnected')
 
     def get_docs(self, callback):
-        if self.state is 'closed':
+        if self.state == 'closed':
             return callback('connection closed', None)
 
-        if self.state is 'connecting':
-            return self.on('ok', lambda x: self.get_docs(callback))
+        if self.state in ('connecting', 'reconnecting'):
+            return self.once('ok', lambda x: self.get_docs(callback))
 
         if not self.waiting_for_docs:
             self.send({"docs":None})
         self.waiting_for_docs.append(callback)
 
     def open(self, name, callback, **kwargs):
-        if self.state is 'closed':
+        if self.state == 'closed':
             return callback('connection closed', None)
 
-        if self.state is 'connecting':
-            return self.on('ok', lambda x: self.open(name, callback))
+        if self.state in ('connecting', 'reconnecting'):
+            return self.once('ok', lambda x: self.open(name, callback))
 
         if name in self.docs:
             return callback("doc {0} already open".format(name), None)
@@ -1,111 +1,609 @@
-import json, threading, socket, base64, hashlib, logging, sys
+import json, threading, socket, base64, hashlib, logging, sys, select, errno, heapq, collections, itertools, time, struct, codecs, zlib
 
-logger = logging.getLogger('Sublime Collaboration')
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
-#A pretty terrible hacky framing system, I'll need to come up with a better one soon
-def send_msg(sock, msg):
-    if sys.version_info[0] < 3:
-        sock.send(unicode("0")*(10-len(unicode(len(msg))))+unicode(len(msg))+msg)
-    else:
-        sock.send(bytes("0"*(10-len(str(len(msg))))+str(len(msg))+msg, 'UTF-8'))
+from .optransform import Component
 
-class ClientSocket(threading.Thread):
-    def __init__(self, host, port):
-        threading.Thread.__init__(self)
+logger = logging.getLogger('Sublime Collaboration')
 
-        self.host = host
-        self.port = port
-        self.sock = None
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Protocol 1 frames are a 10 digit ASCII length followed by a JSON payload.
+# Protocol 2 frames start with a flags byte (high bit always set, so it can
+# never be mistaken for an ASCII digit) and a 4 byte big-endian length. The
+# low bits of the flags byte carry the codec used for the payload, and
+# FRAME_COMPRESSED marks payloads that were deflated with zlib.
+PROTOCOL_VERSIONS = (1, 2)
+COMPRESSIONS = ('zlib',)
+
+FRAME_V2 = 0x80
+FRAME_COMPRESSED = 0x40
+FRAME_CODEC_MASK = 0x0f
+
+CODEC_JSON = 0
+CODEC_COMPACT = 1
+
+V1_HEADER_SIZE = 10
+V2_HEADER = struct.Struct('!BI')
+
+def encode_frame(payload, protocol=1, flags=0):
+    if protocol >= 2:
+        return V2_HEADER.pack(FRAME_V2 | flags, len(payload)) + payload
+    return ('%010d' % len(payload)).encode('ascii') + payload
+
+def _to_wire(value):
+    """Lets json encode op components and history entries"""
+    if hasattr(value, 'to_wire'):
+        return value.to_wire()
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+class JsonCodec(object):
+    name = 'json'
+
+    def encode(self, data):
+        return CODEC_JSON, json.dumps(data, default=_to_wire).encode('utf-8')
+
+    def decode(self, codec, payload):
+        if codec != CODEC_JSON:
+            raise ValueError('Unsupported message codec {0}'.format(codec))
+        return json.loads(codecs.utf_8_decode(payload, 'strict', True)[0])
+
+    def assign(self, docname):
+        return None
+
+    def key(self, data):
+        """Anything besides the message itself that changes how it encodes on this connection"""
+        return None
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(data, pos):
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+    result = byte & 0x7f
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+class CompactCodec(JsonCodec):
+    """Binary encoding for op and ack messages, everything else still goes out as JSON.
+
+    Documents are referred to by small ids the server assigns per connection
+    when a document is opened. An op is the doc id, version and source as
+    varints followed by its components, each a varint of the position shifted
+    left one bit (low bit set for deletes), the text's byte length and the
+    UTF-8 text itself. Pipelined ops put their seq and base after the
+    source.
+
+    Decoded ops hold Component objects, which are valid by construction, so
+    op_from_wire passes them through without checking each one again."""
+    name = 'compact'
+
+    TAG_OP = 1
+    TAG_ACK = 2
+    TAG_PIPELINED_OP = 3
+
+    def __init__(self):
+        self.doc_ids = {}
+        self.doc_names = {}
+
+    def assign(self, docname):
+        if docname not in self.doc_ids:
+            self.learn(docname, len(self.doc_ids) + 1)
+        return self.doc_ids[docname]
+
+    def learn(self, docname, docid):
+        self.doc_ids[docname] = docid
+        self.doc_names[docid] = docname
+
+    def key(self, data):
+        return self.doc_ids.get(data.get('doc'))
+
+    def encode(self, data):
+        docid = self.doc_ids.get(data.get('doc'))
+        version = data.get('v')
+        if docid is not None and type(version) is int:
+            if 'op' in data and len(data) == 3 + ('source' in data) + 2 * ('seq' in data and 'base' in data):
+                payload = self.encode_op(docid, version, data.get('source'), data['op'], data.get('seq'), data.get('base'))
+                if payload is not None:
+                    return CODEC_COMPACT, payload
+            elif len(data) == 2:
+                out = bytearray((self.TAG_ACK,))
+                _write_varint(out, docid)
+                _write_varint(out, version)
+                return CODEC_COMPACT, bytes(out)
+        return JsonCodec.encode(self, data)
+
+    def encode_op(self, docid, version, source, op, seq=None, base=None):
+        if source is not None and (type(source) is not int or source < 0):
+            return None
+        if seq is not None and (type(seq) is not int or type(base) is not int or seq < 0 or base < 0):
+            return None
+        out = bytearray((self.TAG_OP if seq is None else self.TAG_PIPELINED_OP,))
+        _write_varint(out, docid)
+        _write_varint(out, version)
+        _write_varint(out, 0 if source is None else source + 1)
+        if seq is not None:
+            _write_varint(out, seq)
+            _write_varint(out, base)
+        _write_varint(out, len(op))
+        for c in op:
+            if not isinstance(c, Component):
+                if len(c) != 2 or not ('i' in c or 'd' in c):
+                    return None
+                try:
+                    c = Component.from_wire(c)
+                except ValueError:
+                    return None
+            if type(c.p) is not int or c.p < 0:
+                return None
+            if c.i is not None:
+                text = c.i.encode('utf-8')
+                _write_varint(out, c.p << 1)
+            else:
+                text = c.d.encode('utf-8')
+                _write_varint(out, (c.p << 1) | 1)
+            _write_varint(out, len(text))
+            out += text
+        return bytes(out)
+
+    def decode(self, codec, payload):
+        if codec == CODEC_JSON:
+            message = JsonCodec.decode(self, codec, payload)
+            if 'docid' in message and 'doc' in message:
+                self.learn(message['doc'], message['docid'])
+            return message
+        if codec != CODEC_COMPACT:
+            raise ValueError('Unsupported message codec {0}'.format(codec))
 
-        self.saved_data = ''
-        self.target_size = None
+        try:
+            message, pos = self.decode_compact(bytearray(payload))
+        except IndexError:
+            raise ValueError('Truncated compact message')
+        if pos != len(payload):
+            raise ValueError('Compact message has {0} bytes left over'.format(len(payload) - pos))
+        return message
+
+    def decode_compact(self, data):
+        # Most varints here fit in one byte, those skip the call to _read_varint
+        tag = data[0]
+        docid = data[1]
+        pos = 2
+        if docid >= 0x80: docid, pos = _read_varint(data, 1)
+        docname = self.doc_names.get(docid)
+        if docname is None:
+            raise ValueError('Unknown document id {0}'.format(docid))
+        version = data[pos]
+        pos += 1
+        if version >= 0x80: version, pos = _read_varint(data, pos - 1)
+        message = {'doc':docname, 'v':version}
+        if tag == self.TAG_ACK:
+            return message, pos
+        if tag != self.TAG_OP and tag != self.TAG_PIPELINED_OP:
+            raise ValueError('Unknown compact message tag {0}'.format(tag))
+
+        source = data[pos]
+        pos += 1
+        if source >= 0x80: source, pos = _read_varint(data, pos - 1)
+        if source:
+            message['source'] = source - 1
+        if tag == self.TAG_PIPELINED_OP:
+            message['seq'], pos = _read_varint(data, pos)
+            message['base'], pos = _read_varint(data, pos)
+        count = data[pos]
+        pos += 1
+        if count >= 0x80: count, pos = _read_varint(data, pos - 1)
+        op = []
+        for _ in range(count):
+            position = data[pos]
+            pos += 1
+            if position >= 0x80: position, pos = _read_varint(data, pos - 1)
+            size = data[pos]
+            pos += 1
+            if size >= 0x80: size, pos = _read_varint(data, pos - 1)
+            if pos + size > len(data):
+                raise ValueError('Truncated compact message')
+            text = data[pos:pos + size].decode('utf-8')
+            pos += size
+            op.append(Component(position >> 1, None, text) if position & 1 else Component(position >> 1, text, None))
+        message['op'] = op
+        return message, pos
+
+CODECS = {'json': JsonCodec, 'compact': CompactCodec}
+
+class FrameReader(object):
+    """Receive buffer shared by all connection types.
+
+    Data is read with recv_into straight into a preallocated bytearray and
+    frames are split out of it in place, so a payload is decoded exactly once
+    no matter how many reads it took to arrive."""
+    def __init__(self, size=16384):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.stats = {'frames_received': 0, 'bytes_received': 0, 'decompress_time': 0.0}
+
+    def recv_from(self, sock):
+        if self.end == len(self.buffer):
+            self.reserve(self.end - self.start + 1)
+        received = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += received
+        self.stats['bytes_received'] += received
+        return received
+
+    def reserve(self, needed):
+        """Moves unconsumed data to the front of the buffer, growing it if it can't hold needed bytes"""
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, len(self.buffer) * 2))
+            buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = buffer
+        elif self.start:
+            self.buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def messages(self, decode, max_frame, compressed=False):
+        """Yields every complete message in the buffer, decode is called with each frame's flags and payload.
+
+        Raises ValueError on frames over max_frame bytes, before or after
+        decompression, and on compressed frames unless compression was agreed on."""
+        while self.end > self.start:
+            available = self.end - self.start
+            if self.buffer[self.start] & FRAME_V2:
+                if available < V2_HEADER.size: break
+                flags, size = V2_HEADER.unpack_from(self.buffer, self.start)
+                flags &= ~FRAME_V2
+                header = V2_HEADER.size
+            else:
+                if available < V1_HEADER_SIZE: break
+                flags, size = CODEC_JSON, int(bytes(self.buffer[self.start:self.start + V1_HEADER_SIZE]))
+                header = V1_HEADER_SIZE
+
+            if not 0 <= size <= max_frame:
+                raise ValueError('Frame of {0} bytes, the limit is {1}'.format(size, max_frame))
+            if available < header + size:
+                if self.start + header + size > len(self.buffer):
+                    self.reserve(header + size)
+                break
 
+            payload = memoryview(self.buffer)[self.start + header:self.start + header + size]
+            self.start += header + size
+            self.stats['frames_received'] += 1
+            if flags & FRAME_COMPRESSED:
+                if not compressed:
+                    raise ValueError('Compressed frame without agreeing on compression')
+                started = _clock()
+                decompressor = zlib.decompressobj()
+                payload = decompressor.decompress(payload, max_frame)
+                self.stats['decompress_time'] += _clock() - started
+                if decompressor.unconsumed_tail:
+                    raise ValueError('Frame inflates past the limit of {0} bytes'.format(max_frame))
+            message = decode(flags & FRAME_CODEC_MASK, payload)
+            del payload
+            yield message
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:
+                self.buffer = bytearray(self.size)
+
+class Broadcast(object):
+    """A message going out to many connections, encoded once per distinct set of wire settings.
+
+    Frames are immutable bytes, so every connection with the same settings
+    queues the very same object. encoded and shared count how many frames were
+    built and how many sends reused one."""
+    def __init__(self, message):
+        self.message = message
+        self.frames = {}
+        self.encoded = 0
+        self.shared = 0
+
+    def frame_for(self, connection):
+        key = connection.frame_key(self.message)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = connection.encode(self.message)
+            self.encoded += 1
+        else:
+            self.shared += 1
+        return frame
+
+def handshake_offer():
+    return {'protocols': list(PROTOCOL_VERSIONS), 'compression': list(COMPRESSIONS), 'codecs': list(CODECS)}
+
+def handshake_request(offer):
+    """Picks the newest settings both ends support from a server's offer, None means stay on protocol 1"""
+    common = [version for version in offer.get('protocols', [1]) if version in PROTOCOL_VERSIONS]
+    if not common or max(common) == 1:
+        return None
+    request = {'protocol': max(common)}
+    for compression in offer.get('compression', []):
+        if compression in COMPRESSIONS:
+            request['compression'] = compression
+            break
+    if 'compact' in offer.get('codecs', []):
+        request['codec'] = 'compact'
+    return request
+
+class Framing(object):
+    """Wire settings agreed on during the handshake, shared by all connection types"""
+    protocol = 1
+    codec = JsonCodec()
+    compression = None
+    compress_threshold = 1024
+    compress_level = 6
+    # Largest payload accepted from the peer, compressed frames count once inflated
+    max_frame_bytes = 64 * 1024 * 1024
+    receiving = False
+
+    def configure(self, request):
+        if request.get('protocol') not in PROTOCOL_VERSIONS:
+            return False
+        self.protocol = request['protocol']
+        if self.protocol >= 2 and request.get('compression') in COMPRESSIONS:
+            self.compression = request['compression']
+        if self.protocol >= 2 and request.get('codec') in CODECS:
+            self.codec = CODECS[request['codec']]()
+        return True
+
+    def encode(self, data):
+        flags, payload = self.codec.encode(data)
+        if self.compression and len(payload) >= self.compress_threshold:
+            payload, flags = self.compress(payload, flags)
+        return encode_frame(payload, self.protocol, flags)
+
+    def decode(self, codec, payload):
+        return self.codec.decode(codec, payload)
+
+    def frame_key(self, data):
+        return (self.protocol, self.codec.name, self.codec.key(data), self.compression, self.compress_threshold, self.compress_level)
+
+    def compress(self, payload, flags):
+        started = _clock()
+        compressed = zlib.compress(payload, self.compress_level)
+        self.stats['compress_time'] += _clock() - started
+        self.stats['bytes_uncompressed'] += len(payload)
+        if len(compressed) >= len(payload):
+            self.stats['bytes_compressed'] += len(payload)
+            return payload, flags
+        self.stats['bytes_compressed'] += len(compressed)
+        return compressed, flags | FRAME_COMPRESSED
+
+    def compression_ratio(self):
+        if not self.stats['bytes_compressed']:
+            return 1.0
+        return float(self.stats['bytes_uncompressed']) / self.stats['bytes_compressed']
+
+    def receive(self):
+        """Reads from the socket and emits every complete message, returns False once the connection is done"""
+        if not self.reader.recv_from(self.sock):
+            return False
+        self.receiving = True
+        try:
+            for message in self.reader.messages(self.decode, self.max_frame_bytes, self.compression is not None):
+                logger.debug('Recieved from {0}: <{1}>'.format(self.address, message))
+                self.emit('message', message)
+                if not self.ready(): break
+        except (ValueError, zlib.error) as e:
+            logger.error('Malformed frame from {0}: {1}'.format(self.address, e))
+            return False
+        finally:
+            self.receiving = False
+        # Lets listeners handle everything that arrived in one read as a batch
+        self.emit('received')
+        return True
+
+def _socketpair():
+    if hasattr(socket, 'socketpair'):
+        try:
+            return socket.socketpair()
+        except (AttributeError, OSError, socket.error):
+            pass
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    return a, b
+
+class LoopTimer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """Single threaded reactor multiplexing any number of sockets.
+
+    Handlers are objects with handle_read() and handle_write() methods. Uses
+    selectors when available and falls back to select() on older Pythons."""
+    def __init__(self):
+        self._selector = selectors.DefaultSelector() if selectors else None
+        self._handlers = {}
+        self._callbacks = collections.deque()
+        self._timers = []
+        self._timer_seq = 0
+        self.thread = None
         self.keep_running = True
 
-        self._events = {}
+        self._wakeup_r, self._wakeup_w = _socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.register(self._wakeup_r, self)
+
+    def register(self, sock, handler, writable=False):
+        fd = sock.fileno()
+        self._handlers[fd] = [sock, handler, writable]
+        if self._selector:
+            self._selector.register(sock, self._mask(writable), handler)
+
+    def set_writable(self, sock, writable):
+        entry = self._handlers.get(sock.fileno())
+        if not entry or entry[2] == writable: return
+        entry[2] = writable
+        if self._selector:
+            self._selector.modify(sock, self._mask(writable), entry[1])
+
+    def unregister(self, sock):
+        try:
+            fd = sock.fileno()
+        except (OSError, socket.error):
+            return
+        if self._handlers.pop(fd, None) and self._selector:
+            self._selector.unregister(sock)
 
-    def on(self, event, fct):
-        if event not in self._events: self._events[event] = []
-        self._events[event].append(fct)
-        return self
+    def _mask(self, writable):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if writable else 0)
 
-    def removeListener(self, event, fct):
-        if event not in self._events: return self
-        self._events[event].remove(fct)
-        return self
+    def in_loop_thread(self):
+        return self.thread is threading.current_thread()
 
-    def emit(self, event, *args):
-        if event not in self._events: return self
-        for callback in self._events[event]:
-            callback(*args)
-        return self
+    def call_soon(self, callback, *args):
+        self._callbacks.append((callback, args))
+        if not self.in_loop_thread():
+            self.wakeup()
 
-    def send(self, data):
-        logger.debug('Client sending: <{0}>'.format(data))
+    def call_later(self, delay, callback, *args):
+        timer = LoopTimer(time.time() + delay, callback, args)
+        self.call_soon(self._add_timer, timer)
+        return timer
 
-        msg = json.dumps(data)
+    def _add_timer(self, timer):
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (timer.when, self._timer_seq, timer))
 
+    def wakeup(self):
         try:
-            send_msg(self.sock, msg)
-        except:
-            self.close()
-
-    def close(self):
-        self.keep_running = False
-        if self.sock:
-            self.sock.shutdown(socket.SHUT_RDWR)
+            self._wakeup_w.send(b'x')
+        except (OSError, socket.error):
+            pass
 
-    def run(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def handle_read(self):
         try:
-            self.sock.connect((self.host, self.port))
-        except:
-            self.emit('error', 'could not connect to server')
-            self.emit('close')
-            self.sock = None
-            return
-        self.emit('open')
-        while self.keep_running:
-            try:
-                data = self.sock.recv(self.target_size if self.target_size else 10)
-            except:
-                break
-            if data is None or data == b'':
-                break
+            while self._wakeup_r.recv(4096):
+                pass
+        except (OSError, socket.error):
+            pass
 
-            logger.debug('Client recieved: <{0}>'.format(data))
+    def handle_write(self):
+        pass
 
-            if self.target_size:
-                self.saved_data += data.decode("utf-8")
-                if len(self.saved_data) == self.target_size:
-                    self.emit('message', json.loads(self.saved_data, "utf-8"))
-                    self.saved_data = ''
-                    self.target_size = None
-            else:
-                self.target_size = int(data)
-
-        self.sock.close()
-        self.emit('close')
-        self.sock = None
+    def stop(self):
+        self.keep_running = False
+        self.wakeup()
 
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        while self.keep_running:
+            self.run_once()
+        self.close()
 
+    def close(self):
+        self.unregister(self._wakeup_r)
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        if self._selector:
+            self._selector.close()
+
+    def run_once(self):
+        timeout = None
+        if self._callbacks:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+
+        for fd, handler, readable, writable in self._poll(timeout):
+            if readable and self._registered(fd, handler):
+                self._dispatch(handler.handle_read)
+            if writable and self._registered(fd, handler):
+                self._dispatch(handler.handle_write)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._dispatch(timer.callback, *timer.args)
+
+        for _ in range(len(self._callbacks)):
+            callback, args = self._callbacks.popleft()
+            self._dispatch(callback, *args)
+
+    def _poll(self, timeout):
+        ready = []
+        if self._selector:
+            for key, mask in self._selector.select(timeout):
+                ready.append((key.fd, key.data, mask & selectors.EVENT_READ, mask & selectors.EVENT_WRITE))
+            return ready
+
+        handlers = dict((fd, entry[1]) for fd, entry in self._handlers.items())
+        readers = list(handlers)
+        writers = [fd for fd, entry in self._handlers.items() if entry[2]]
+        r, w, _ = select.select(readers, writers, [], timeout)
+        w = set(w)
+        for fd in set(r) | w:
+            ready.append((fd, handlers[fd], fd in r, fd in w))
+        return ready
+
+    def _registered(self, fd, handler):
+        return fd in self._handlers and self._handlers[fd][1] is handler
+
+    def _dispatch(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Unhandled error in event loop callback')
 
-class ServerSocket(threading.Thread):
-    def __init__(self, sock, addr):
-        threading.Thread.__init__(self)
+class LoopSocket(Framing):
+    """A connection driven by an EventLoop.
 
-        self.sock = sock
-        sock.settimeout(None)
+    Outgoing frames are queued and written by the loop once per wakeup, so a
+    burst of sends is coalesced into a single sendmsg call and a peer that
+    stops reading only grows its own queue instead of blocking the sender."""
+    max_iov = 512
 
+    def __init__(self, sock, addr, loop, nodelay=True):
+        self.sock = None
         self.address = addr
-        self.headers = None
+        self.loop = loop
+        self.nodelay = nodelay
 
-        self.saved_data = ''
-        self.target_size = None
+        self.reader = FrameReader()
+        self.outbound = collections.deque()
+        self.outbound_bytes = 0
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        self.low_watermark = None
+        self.stats = {'frames_sent': 0, 'bytes_sent': 0, 'writes': 0, 'bytes_uncompressed': 0, 'bytes_compressed': 0, 'compress_time': 0.0}
 
         self._ready = False
         self._events = {}
 
+        if sock:
+            self.attach(sock)
+
     def on(self, event, fct):
         if event not in self._events: self._events[event] = []
         self._events[event].append(fct)
@@ -122,48 +620,109 @@ class ServerSocket(threading.Thread):
             callback(*args)
         return self
 
-    def run(self):
+    def attach(self, sock):
+        self.sock = sock
+        sock.setblocking(False)
+        if self.nodelay and sock.family in (socket.AF_INET, getattr(socket, 'AF_INET6', None)):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._ready = True
-        self.emit('ok')
+        self.loop.register(sock, self)
 
-        while self._ready:
-            try:
-                data = self.sock.recv(self.target_size if self.target_size else 10)
-            except:
-                break
-            if data is None or data == b'':
-                break
+    def handle_read(self):
+        try:
+            alive = self.receive()
+        except (OSError, socket.error) as e:
+            if e.errno in _WOULDBLOCK: return
+            alive = False
+        if not alive:
+            self.close()
 
-            logger.debug('Server recieved from {0}: <{1}>'.format(self.address, data))
+    def handle_write(self):
+        self.flush()
 
-            if self.target_size:
-                self.saved_data += data.decode("utf-8")
-                if len(self.saved_data) == self.target_size:
-                    self.emit('message', json.loads(self.saved_data, "utf-8"))
-                    self.saved_data = ''
-                    self.target_size = None
-            else:
-                self.target_size = int(data)
+    def send(self, data):
+        if not self._ready: return
 
-        self._ready = False
-        self.emit('close')
-        self.close()
+        logger.debug('Sending to {0}: <{1}>'.format(self.address, data))
 
-    def close(self):
-        self._ready = False
-        self.sock.shutdown(socket.SHUT_RDWR)
+        self.send_frame(self.encode(data))
 
-    def send(self, data):
+    def send_broadcast(self, broadcast):
         if not self._ready: return
 
-        logger.debug('Server sending to {0}: <{1}>'.format(self.address, data))
+        logger.debug('Sending to {0}: <{1}>'.format(self.address, broadcast.message))
+
+        self.send_frame(broadcast.frame_for(self))
+
+    def send_frame(self, frame):
+        with self._lock:
+            if not self._ready: return
+            self.outbound.append(frame)
+            self.outbound_bytes += len(frame)
+            if self._flush_scheduled: return
+            self._flush_scheduled = True
+        self.loop.call_soon(self.flush)
+
+    def queue_depth(self):
+        return len(self.outbound)
+
+    def flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+            self.write_outbound()
+        if self.low_watermark is not None and self.outbound_bytes <= self.low_watermark:
+            self.low_watermark = None
+            self.emit('drain')
+
+    def wait_for_drain(self, low_watermark):
+        """Emits 'drain' once the outbound queue has shrunk to low_watermark bytes"""
+        self.low_watermark = low_watermark
+
+    def write_outbound(self):
+        while self._ready and self.outbound:
+            chunks = list(itertools.islice(self.outbound, self.max_iov))
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(chunks)
+                else:
+                    sent = self.sock.send(b''.join(chunks))
+            except (OSError, socket.error) as e:
+                if e.errno in _WOULDBLOCK: break
+                return self.loop.call_soon(self.close)
+
+            self.stats['writes'] += 1
+            self.stats['bytes_sent'] += sent
+            self.outbound_bytes -= sent
+            written = sent
+            while written:
+                head = self.outbound[0]
+                if len(head) > written:
+                    self.outbound[0] = memoryview(head)[written:]
+                    break
+                written -= len(head)
+                self.outbound.popleft()
+                self.stats['frames_sent'] += 1
+            if sent < sum(len(chunk) for chunk in chunks):
+                break
 
-        msg = json.dumps(data)
+        if self._ready:
+            self.loop.set_writable(self.sock, bool(self.outbound))
 
+    def close(self):
+        if not self.loop.in_loop_thread() and self.loop.thread is not None:
+            return self.loop.call_soon(self.close)
+        if not self._ready: return
+        self._ready = False
+        self.loop.unregister(self.sock)
         try:
-            send_msg(self.sock, msg)
-        except:
-            self.close()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.sock.close()
+        with self._lock:
+            self.outbound.clear()
+            self.outbound_bytes = 0
+        self.emit('close')
 
     def ready(self):
         return self._ready
@@ -176,10 +735,56 @@ class ServerSocket(threading.Thread):
 
 
 
+class ClientSocket(LoopSocket):
+    """Client connection running its own EventLoop on a background thread"""
+    def __init__(self, host, port, nodelay=True):
+        LoopSocket.__init__(self, None, (host, port), EventLoop(), nodelay)
+
+        self.host = host
+        self.port = port
+
+    def start(self):
+        threading.Thread(target=self.run).start()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, self.port))
+        except:
+            self.loop.close()
+            self.emit('error', 'could not connect to server')
+            self.emit('close')
+            return
+        self.on('close', self.loop.stop)
+        self.loop.call_soon(self.attach, sock)
+        self.loop.call_soon(self.emit, 'open')
+        self.loop.run_forever()
+        self.sock = None
+
+
+
+class ServerSocket(LoopSocket):
+    """Server connection running its own EventLoop on a dedicated thread, used by the threaded server mode"""
+    def __init__(self, sock, addr, nodelay=True):
+        LoopSocket.__init__(self, sock, addr, EventLoop(), nodelay)
+        self.on('close', self.loop.stop)
+
+    def start(self):
+        threading.Thread(target=self.run).start()
+
+    def run(self):
+        self.loop.call_soon(self.emit, 'ok')
+        self.loop.run_forever()
+
+
+
 class SocketServer:
-    def __init__(self, host='127.0.0.1', port=6633):
+    def __init__(self, host='127.0.0.1', port=6633, threaded=False, nodelay=True):
         self.host = host
         self.port = port
+        self.threaded = threaded
+        self.nodelay = nodelay
+        self.loop = None if threaded else EventLoop()
         self.sock = None
         self.keep_running = True
         self.closed = False
@@ -205,10 +810,21 @@ class SocketServer:
     def run_forever(self):
         self.sock = socket.socket()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.settimeout(0.1)
         self.sock.bind(('', self.port))
-        self.sock.listen(1)
 
+        if self.threaded:
+            self.sock.settimeout(0.1)
+            self.sock.listen(1)
+            self.run_threaded()
+        else:
+            self.sock.setblocking(False)
+            self.sock.listen(128)
+            self.loop.register(self.sock, self)
+            self.loop.run_forever()
+
+        self.closed = True
+
+    def run_threaded(self):
         while self.keep_running:
             try:
                 conn, addr = self.sock.accept()
@@ -216,22 +832,46 @@ class SocketServer:
                 continue
             except OSError:
                 break
-            logger.debug('Server was connected by {0}'.format(addr))
-            connection = ServerSocket(conn, addr)
-            self.connections.append(connection)
-            def on_close():
-                logger.debug('Server was disconnected by {0}'.format(addr))
-                if connection in self.connections:
-                    self.connections.remove(connection)
-            connection.on('close', on_close)
-            connection.start()
-            self.emit('connection', connection)
+            self.add_connection(ServerSocket(conn, addr, self.nodelay), addr)
 
-        self.closed = True
+    def handle_read(self):
+        while self.keep_running:
+            try:
+                conn, addr = self.sock.accept()
+            except (OSError, socket.error) as e:
+                if e.errno not in _WOULDBLOCK:
+                    logger.error('Server could not accept connection: {0}'.format(e))
+                return
+            self.add_connection(LoopSocket(conn, addr, self.loop, self.nodelay), addr)
+
+    def handle_write(self):
+        pass
+
+    def add_connection(self, connection, addr):
+        logger.debug('Server was connected by {0}'.format(addr))
+        self.connections.append(connection)
+        def on_close():
+            logger.debug('Server was disconnected by {0}'.format(addr))
+            if connection in self.connections:
+                self.connections.remove(connection)
+        connection.on('close', on_close)
+        if self.threaded:
+            connection.start()
+        self.emit('connection', connection)
 
     def close(self):
         self.keep_running = False
-        for connection in self.connections:
+        if self.loop:
+            self.loop.call_soon(self.close_loop)
+        else:
+            for connection in list(self.connections):
+                connection.close()
+            self.sock.close()
+        while not self.closed: time.sleep(0.01)
+
+    def close_loop(self):
+        for connection in list(self.connections):
             connection.close()
+        self.loop.unregister(self.sock)
         self.sock.close()
-        while not self.closed: pass
+        self.loop.stop()
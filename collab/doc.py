@@ -1,14 +1,22 @@
-import functools, logging
-from .optransform import op_normalize, op_apply, op_compose, op_invert, op_transform_x
+import functools, logging, time
+from .optransform import Component, op_normalize, op_apply, op_compose, op_invert, op_transform_x, op_transform_regions, op_diff, op_from_wire
+from .rope import Rope
 
 logger = logging.getLogger('Sublime Collaboration')
 
+# How long edits wait in pending_op, composing with the ones after them, before they go out:
+#   'immediate'  as soon as the window has room
+#   'interval'   flush_interval seconds after the first of them
+#   'adaptive'   ADAPTIVE_RTT_FRACTION of the measured round trip time, at most flush_interval
+FLUSH_POLICIES = ('immediate', 'interval', 'adaptive')
+ADAPTIVE_RTT_FRACTION = 0.5
+
 class CollabDoc():
     def __init__(self, connection, name, snapshot=None):
         self.connection = connection
         self.name = name
         self.version = 0
-        self.snapshot = snapshot
+        self.snapshot = Rope(snapshot) if snapshot is not None else None
         self.state = 'closed'
 
         self._events = {}
@@ -17,11 +25,30 @@ class CollabDoc():
 
         self.connection.on('closed', lambda data: self.set_state('closed', data))
 
-        self.inflight_op = None
-        self.inflight_callbacks = []
+        # [op, callbacks, seq] of every op sent and not acked yet, oldest first
+        self.inflight = []
+        # Ops sent on top of one the server rejected, it rejects them too and they went back into pending_op
+        self.rebased = 0
+        self.last_acked = None
         self.pending_op = None
         self.pending_callbacks = []
+        # When the oldest edit in pending_op was made, None once it has been waiting long enough
+        self.pending_since = None
+        self.flush_timer = None
+        # (acked_count its ack brings, time sent) of the op timed for the round trip estimate
+        self.rtt_probe = None
         self.server_ops = {}
+        # Ops of our user id the server has applied to the document, counted from what it had when we opened it
+        self.acked_count = 0
+        self.resuming = False
+        # Text we opened the document with again after the server turned our resume down, None otherwise
+        self.reopening = None
+
+        # Our selection as (start, end) regions, and everybody else's by user id
+        self.selection = None
+        self.presence = {}
+        self.presence_sent = 0
+        self.presence_timer = None
 
         self._open_callback = None
 
@@ -45,38 +72,110 @@ class CollabDoc():
         if self.state is state: return
         self.state = state
 
-        if state is 'closed':
+        if state == 'closed':
+            self.presence = {}
             if self._open_callback: self._open_callback(data if data else "disconnected", None)
 
         self.emit(state, data)
 
     def get_text(self):
-        return self.snapshot
+        return self.snapshot.text() if self.snapshot is not None else None
 
     def insert(self, pos, text, callback=None):
-        op = [{'p':pos, 'i':text}]
+        op = [Component(pos, i=text)]
         self.submit_op(op, callback)
         return op
 
     def delete(self, pos, length, callback=None):
-        op = [{'p':pos, 'd':self.snapshot[pos:(pos+length)]}]
+        op = [Component(pos, d=self.snapshot[pos:(pos+length)])]
         self.submit_op(op, callback)
         return op
 
+    def set_selection(self, regions):
+        """Shares our selection with the others in the document, throttled to the client's presence_interval"""
+        self.selection = [tuple(region) for region in regions] if regions is not None else None
+        self.schedule_presence()
+
+    def schedule_presence(self):
+        if self.state != 'open' or self.presence_timer is not None: return
+        delay = self.presence_sent + self.connection.presence_interval - time.time()
+        if delay <= 0:
+            return self.send_presence()
+        self.presence_timer = self.connection.call_later(delay, self.send_presence)
+
+    def send_presence(self):
+        self.presence_timer = None
+        if self.state != 'open' or self.resuming: return
+        regions = self.selection
+        # The server only knows our document without the ops it has not acked yet
+        for op in [self.pending_op] + [entry[0] for entry in reversed(self.inflight)]:
+            if op is not None and regions:
+                regions = op_transform_regions(regions, op_invert(op))
+        self.presence_sent = time.time()
+        self.connection.send({'doc':self.name, 'presence':[list(region) for region in regions] if regions is not None else None, 'v':self.version})
+
+    def on_presence(self, entries):
+        for userid, version, regions in entries:
+            if userid == self.connection.id:
+                continue
+            if regions is not None:
+                regions = [tuple(region) for region in regions]
+                for v in range(version, self.version):
+                    if v not in self.server_ops:
+                        regions = None
+                        break
+                    regions = op_transform_regions(regions, self.server_ops[v])
+                for op in [entry[0] for entry in self.inflight] + [self.pending_op]:
+                    if op is not None and regions:
+                        regions = op_transform_regions(regions, op)
+            if regions is None:
+                if self.presence.pop(userid, None) is None: continue
+            else:
+                self.presence[userid] = regions
+            self.emit('presence', userid, regions)
+
+    def transform_presence(self, op):
+        """Moves everybody's selection through op, all regions in one batch"""
+        if not self.presence: return
+        users = list(self.presence)
+        regions = op_transform_regions([region for userid in users for region in self.presence[userid]], op)
+        start = 0
+        for userid in users:
+            end = start + len(self.presence[userid])
+            self.presence[userid] = regions[start:end]
+            start = end
+
     def on_doc_remoteop(self, op, snapshot):
         for component in op:
-            if 'i' in component:
-                self.emit('insert', component['p'], component['i'])
+            if component.i is not None:
+                self.emit('insert', component.p, component.i)
             else:
-                self.emit('delete', component['p'], component['d'])
+                self.emit('delete', component.p, component.d)
 
     def open(self, callback=None):
         if self.state != 'closed': return
 
-        self.connection.send({'doc': self.name, 'open': True, 'snapshot': self.snapshot, 'create': True})
+        # The reply can arrive on the socket thread before send returns
+        self._open_callback = callback
         self.set_state('opening')
 
-        self._open_callback = callback
+        self.connection.send({'doc': self.name, 'open': True, 'snapshot': self.get_text(), 'create': True})
+
+    def resume(self, userid, token):
+        """Called on a new connection, asks the server for everything missed since our version"""
+        if self.state == 'opening':
+            self.connection.send({'doc': self.name, 'open': True, 'snapshot': self.get_text(), 'create': True})
+        elif self.state == 'open':
+            # Hold back new ops until the server has replayed what we missed
+            self.resuming = True
+            # Answers to ops sent on the old connection are gone with it
+            self.rebased = 0
+            self.connection.send({'doc': self.name, 'resume': userid, 'token': token, 'v': self.version, 'acked': self.acked_count})
+
+    def reopen(self):
+        """Opens the document afresh when the server can not resume it, the open reply resyncs our unacked edits"""
+        self.reopening = self.acked_snapshot().text()
+        self.connection.send({'doc': self.name, 'open': True, 'snapshot': self.reopening, 'create': True})
 
     def close(self):
         self.connection.send({'doc':self.name, 'open':False})
@@ -90,52 +189,173 @@ class CollabDoc():
             self.pending_op = op_compose(self.pending_op, op)
         else:
             self.pending_op = op
+            self.pending_since = time.time()
 
         if callback:
             self.pending_callbacks.append(callback)
 
+        self.transform_presence(op)
         self.emit('change', op)
 
         self.flush()
 
+    def window(self):
+        return self.connection.window if self.connection.pipelining else 1
+
     def flush(self):
-        if not (self.connection.state == 'ok' and self.inflight_op is None and self.pending_op is not None):
+        if not (self.connection.state == 'ok' and not self.resuming and len(self.inflight) < self.window() and self.pending_op is not None):
             return
 
-        self.inflight_op = self.pending_op
-        self.inflight_callbacks = self.pending_callbacks
+        if self.pending_since is not None:
+            delay = self.pending_since + self.flush_delay() - time.time()
+            if delay > 0:
+                if self.flush_timer is None:
+                    self.flush_timer = self.connection.call_later(delay, self.flush_due)
+                return
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        op = self.pending_op
+        self.inflight.append([op, self.pending_callbacks, next(self.connection.op_seqs)])
 
         self.pending_op = None
         self.pending_callbacks = []
-
-        self.connection.send({'doc':self.name, 'op':self.inflight_op, 'v':self.version})
+        self.pending_since = None
+        if self.rtt_probe is None:
+            self.rtt_probe = (self.acked_count + len(self.inflight), time.time())
+
+        self.send_op(self.inflight[-1])
+
+    def send_op(self, entry):
+        # Pipelined ops go against the last version we saw too, the server knows they build on our earlier ones
+        message = {'doc':self.name, 'op':entry[0], 'v':self.version}
+        if self.window() > 1:
+            # Tells the server which of our ops this one was built on, so it fails along with them
+            message['seq'] = entry[2]
+            message['base'] = self.inflight[0][2]
+        self.connection.send(message)
+
+    def flush_delay(self):
+        """Seconds the client's flush policy holds edits back, never more than its flush_interval"""
+        policy = self.connection.flush_policy
+        if policy == 'interval':
+            return self.connection.flush_interval
+        if policy == 'adaptive' and self.connection.rtt is not None:
+            return min(self.connection.rtt * ADAPTIVE_RTT_FRACTION, self.connection.flush_interval)
+        return 0
+
+    def flush_due(self):
+        self.flush_timer = None
+        if self.state == 'open':
+            self.flush()
 
     def apply_op(self, op, is_remote):
         oldSnapshot = self.snapshot
         self.snapshot = op_apply(self.snapshot, op)
+        self.transform_presence(op)
 
         self.emit('change', op, oldSnapshot)
         if is_remote:
             self.emit('remoteop', op, oldSnapshot)
 
+    def acked_snapshot(self, acked=0):
+        """Our snapshot without pending_op and the inflight ops after the first acked ones"""
+        base = self.snapshot
+        if self.pending_op is not None:
+            base = op_apply(base, op_invert(self.pending_op), False)
+        for op, callbacks, seq in reversed(self.inflight[acked:]):
+            base = op_apply(base, op_invert(op), False)
+        return base
+
+    def resync(self, snapshot, version, acked):
+        self.resuming = False
+        base = self.acked_snapshot(acked)
+
+        # The server applied the first acked inflight ops and drops the rest as stale, those go out again after the resync
+        for op, callbacks, seq in reversed(self.inflight[acked:]):
+            self.pending_op = op_compose(op, self.pending_op) if self.pending_op is not None else op
+            self.pending_callbacks = callbacks + self.pending_callbacks
+        for op, callbacks, seq in self.inflight[:acked]:
+            self.acked_count += 1
+            for callback in callbacks:
+                callback(None, op)
+        self.inflight = []
+        # Every op sent before the resync is accounted for now, the server answers the rest with stale
+        self.rebased = 0
+        self.last_acked = None
+        self.rtt_probe = None
+
+        change = op_diff(base.text(), snapshot)
+        if self.pending_op is not None:
+            self.pending_op, change = op_transform_x(self.pending_op, change)
+
+        self.version = version
+        self.apply_op(change, True)
+        self.flush()
+
     def on_message(self, msg):
         if msg['doc'] != self.name:
             return self.emit('error', "Expected docName '{0}' but got {1}".format(self.name, msg['doc']))
 
+        if 'stale' in msg:
+            # The resync before it already put the op back into pending_op
+            return
+
+        if 'resync' in msg:
+            return self.resync(msg['snapshot'], msg['v'], msg.get('acked', 0))
+
+        if 'presence' in msg:
+            return self.on_presence(msg['presence'])
+
+        if 'resumed' in msg and msg['resumed'] is False:
+            # We can not tell whether the server applied our inflight ops, they go out again
+            logger.warning("Could not resume {0}: {1}, opening it again".format(self.name, msg.get('error')))
+            return self.reopen()
+
+        if 'resumed' in msg:
+            self.resuming = False
+            if msg['v'] != self.version:
+                return self.emit('error', "Expected version {0} but got {1}".format(self.version, msg['v']))
+            # Our inflight ops never made it to the server, send them again on the new connection.
+            # Their acks say nothing about the round trip time any more
+            self.rtt_probe = None
+            for entry in self.inflight:
+                self.send_op(entry)
+            self.flush()
+            return self.schedule_presence() if self.selection is not None else None
+
         if 'open' in msg:
-            if msg['open'] == True:
+            if msg['open'] == True and self.reopening is not None:
+                snapshot = msg['snapshot'] if msg.get('snapshot') is not None else self.reopening
+                self.reopening = None
+                # Nothing tells us which inflight ops the server stored before it went away,
+                # the ones that turn our document into its snapshot count as applied and the rest go out again
+                acked = 0
+                for count in range(len(self.inflight), 0, -1):
+                    if self.acked_snapshot(count).text() == snapshot:
+                        acked = count
+                        break
+                self.acked_count = msg.get('acked', 0) - acked
+                self.resync(snapshot, msg.get('v', 0), acked)
+                return self.schedule_presence() if self.selection is not None else None
+
+            elif msg['open'] == True:
 
                 if 'create' in msg and msg['create'] and not self.snapshot:
-                    self.snapshot = ''
+                    self.snapshot = Rope('')
                 else:
-                    if 'snapshot' in msg:
-                        self.snapshot = msg['snapshot']
+                    if 'snapshot' in msg and msg['snapshot'] is not None:
+                        self.snapshot = Rope(msg['snapshot'])
 
                 if 'v' in msg:
                     self.version = msg['v']
+                if 'acked' in msg:
+                    self.acked_count = msg['acked']
 
                 self.state = 'open'
                 self.emit('open')
+                if self.selection is not None: self.schedule_presence()
 
                 if self._open_callback:
                     self._open_callback(None, self)
@@ -152,23 +372,56 @@ class CollabDoc():
                 self.connection.closed(self.name)
 
         elif 'op' not in msg and 'v' in msg:
-            if msg['v'] != self.version:
+            if 'error' in msg and self.rebased:
+                self.rebased -= 1
+                return
+
+            # Pipelined ops the server composed into one are all acked with its version
+            merged = 'error' not in msg and msg['v'] == self.last_acked == self.version - 1
+            if 'error' not in msg and msg['v'] != self.version and not merged:
                 return self.emit('error', "Expected version {0} but got {1}".format(self.version, msg['v']))
+            if not self.inflight:
+                return self.emit('error', "Got an ack for version {0} with no op in flight".format(msg['v']))
 
-            oldinflight_op = self.inflight_op
-            self.inflight_op = None
+            oldinflight_op, callbacks, seq = self.inflight.pop(0)
 
             if 'error' in msg:
                 error = msg['error']
+                # Take the op back out of our document. The ops we sent after it were built on it and
+                # the server rejects them too, they go back into pending_op without it
                 undo = op_invert(oldinflight_op)
-                if self.pending_op:
+                rebasedOp = None
+                rebasedCallbacks = []
+                for op, opCallbacks, opSeq in self.inflight:
+                    op, undo = op_transform_x(op, undo)
+                    rebasedOp = op_compose(rebasedOp, op) if rebasedOp is not None else op
+                    rebasedCallbacks.extend(opCallbacks)
+                if self.pending_op is not None:
                     self.pending_op, undo = op_transform_x(self.pending_op, undo)
-                for callback in self.inflight_callbacks:
+                    if rebasedOp is not None:
+                        self.pending_op = op_compose(rebasedOp, self.pending_op)
+                elif rebasedOp is not None:
+                    self.pending_op = rebasedOp
+                    self.pending_since = None
+                self.pending_callbacks = rebasedCallbacks + self.pending_callbacks
+                self.rebased += len(self.inflight)
+                self.inflight = []
+                self.rtt_probe = None
+                self.apply_op(undo, True)
+                for callback in callbacks:
                     callback(error, None)
             else:
-                self.server_ops[self.version] = oldinflight_op
-                self.version += 1
-                for callback in self.inflight_callbacks:
+                if merged:
+                    self.server_ops[msg['v']] = op_compose(self.server_ops[msg['v']], oldinflight_op)
+                else:
+                    self.server_ops[self.version] = oldinflight_op
+                    self.version += 1
+                self.last_acked = msg['v']
+                self.acked_count += 1
+                if self.rtt_probe is not None and self.rtt_probe[0] == self.acked_count:
+                    self.connection.add_rtt_sample(time.time() - self.rtt_probe[1])
+                    self.rtt_probe = None
+                for callback in callbacks:
                     callback(None, oldinflight_op)
 
             self.flush()
@@ -177,11 +430,11 @@ class CollabDoc():
             if msg['v'] != self.version:
                 return self.emit('error', "Expected version {0} but got {1}".format(self.version, msg['v']))
 
-            op = msg['op']
+            op = op_from_wire(msg['op'])
             self.server_ops[self.version] = op
 
-            if self.inflight_op is not None:
-                self.inflight_op, op = op_transform_x(self.inflight_op, op)
+            for entry in self.inflight:
+                entry[0], op = op_transform_x(entry[0], op)
             if self.pending_op is not None:
                 self.pending_op, op = op_transform_x(self.pending_op, op)
 
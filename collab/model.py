@@ -1,108 +1,475 @@
-import time, re, logging
-from .optransform import op_transform, op_apply
+import time, re, logging, collections, itertools, functools
+from .optransform import op_transform, op_transform_x, op_apply, op_compose, op_append, op_from_wire
+from .storage import FileStorage
+from .rope import Rope
+from .connection import Broadcast
 
 logger = logging.getLogger('Sublime Collaboration')
 
+# Rough per op overhead of the objects and ints held in history, on top of the text
+OP_OVERHEAD = 100
+
+def op_size(op):
+    return OP_OVERHEAD + sum(len(c.i if c.i is not None else c.d) for c in op.op)
+
+class Op(object):
+    """An applied op as kept in history, to_wire gives the message clients get.
+
+    count is how many ops of its source were composed into it, each of them
+    got its own ack."""
+    __slots__ = ('doc', 'v', 'op', 'source', 'count')
+
+    def __init__(self, doc, v, op, source, count=1):
+        self.doc = doc
+        self.v = v
+        self.op = op
+        self.source = source
+        self.count = count
+
+    def to_wire(self):
+        if self.count > 1:
+            return {'doc':self.doc, 'v':self.v, 'op':self.op, 'source':self.source, 'count':self.count}
+        return {'doc':self.doc, 'v':self.v, 'op':self.op, 'source':self.source}
+
+class Pending(object):
+    """An applied op waiting for storage, broadcast and acked once it and every op before it are saved.
+
+    A rejected op queued behind unpublished ones has no op and is saved already, it only fails its callback."""
+    __slots__ = ('op', 'count', 'callback', 'snapshot', 'oldsnapshot', 'saved', 'error')
+
+    def __init__(self, op, count, callback, snapshot, oldsnapshot):
+        self.op = op
+        self.count = count
+        self.callback = callback
+        self.snapshot = snapshot
+        self.oldsnapshot = oldsnapshot
+        self.saved = False
+        self.error = None
+
+class Document(object):
+    __slots__ = ('name', 'snapshot', 'v', 'ops', 'sources', 'listeners', 'savelock', 'savedversion', 'queue', 'queuelock', 'size', 'bridges', 'failed', 'published', 'published_snapshot', 'unpublished')
+
+    def __init__(self, name, snapshot, v, ops, sources, savedversion):
+        self.name = name
+        # Ops apply to snapshot and v right away, readers and listeners only see them once they are published
+        self.snapshot = snapshot
+        self.v = v
+        self.ops = ops
+        self.published = v
+        self.published_snapshot = snapshot
+        self.unpublished = collections.deque()
+        # Published ops of each source
+        self.sources = sources
+        self.listeners = []
+        self.savelock = False
+        self.savedversion = savedversion
+        self.queue = collections.deque()
+        self.queuelock = False
+        self.size = 0
+        self.bridges = {}
+        # source -> highest seq of its pipelined ops that failed
+        self.failed = {}
+
+class Bridge(object):
+    """What other sources did since a source's last op, as it looks after that source's own ops.
+
+    Clients pipelining ops send each one against the last version they saw,
+    built on top of their own ops still in flight. Those ops must only be
+    transformed against the ops of other sources, which the bridge keeps
+    transformed past every op the source sent since.
+
+    Pipelined ops carry a seq, numbering the client's ops, and a base, the
+    seq of the oldest op it had in flight. Ops with a base at or below the
+    seq of an op that failed were built on that op and fail as well."""
+    __slots__ = ('v', 'ops')
+
+    def __init__(self, v, ops):
+        # Version the source's last op was applied at
+        self.v = v
+        self.ops = ops
+
+class OpHistory(object):
+    """Recent ops of a document, bounded by op count and by the bytes of text they hold.
+
+    Next to the ops it keeps runs of them merged into one component, as long
+    as each op is a single insert or delete running into the one before, like
+    typing or backspacing. Transforming against a run gives the same result
+    as transforming against its ops one by one, which composing in general
+    does not. Runs end after run_length ops, so an op that starts in the
+    middle of one goes through at most that many ops on their own."""
+    def __init__(self, max_ops, max_bytes, ops=(), run_length=32):
+        self.ops = collections.deque()
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.run_length = run_length
+        # [version of the first op, merged op, op count] of each run, oldest first
+        self.runs = collections.deque()
+        for op in ops:
+            self.append(op)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def append(self, op):
+        self.ops.append(op)
+        self.bytes += op_size(op)
+        while len(self.ops) > 1 and (len(self.ops) > self.max_ops or self.bytes > self.max_bytes):
+            self.bytes -= op_size(self.ops.popleft())
+
+        run = self.runs[-1] if self.runs else None
+        if run is not None and run[2] < self.run_length and len(run[1]) == 1 and len(op.op) == 1 and (run[1][0].i is None) == (op.op[0].i is None):
+            merged = list(run[1])
+            op_append(merged, op.op[0])
+            if len(merged) == 1:
+                run[1] = merged
+                run[2] += 1
+                op = None
+        if op is not None:
+            self.runs.append([op.v, list(op.op), 1])
+        # A run whose first ops are gone is only ever needed in part
+        while len(self.runs) > 1 and self.runs[1][0] <= self.ops[0].v:
+            self.runs.popleft()
+
+    def last(self, count):
+        """Returns the newest count ops, oldest first, in O(count)"""
+        if count <= 0:
+            return []
+        ops = list(itertools.islice(reversed(self.ops), count))
+        ops.reverse()
+        return ops
+
+    def suffix(self, count):
+        """Returns ops which, transformed against in order, do what the newest count ops do one by one.
+
+        Whole runs come back merged, the run count starts in the middle of op by op."""
+        if count <= 0:
+            return []
+        end = head = self.ops[-1].v + 1
+        start = head - count
+        ops = []
+        for first, merged, length in reversed(self.runs):
+            if first < start:
+                break
+            ops.append(merged)
+            end = first
+            if first == start:
+                break
+        ops.extend(op.op for op in itertools.islice(reversed(self.ops), head - end, count))
+        ops.reverse()
+        return ops
+
 class CollabModel(object):
-    def __init__(self, options=None):
+    def __init__(self, options=None, loop=None):
         self.options = options if options else {}
-        self.options.setdefault('numCachedOps', 20)
+        self.options.setdefault('numCachedOps', 1000)
+        self.options.setdefault('historyBytes', 4*1024*1024)
         self.options.setdefault('opsBeforeCommit', 20)
-        self.options.setdefault('maximumAge', 20)
+        self.options.setdefault('maximumAge', 1000)
+        # Bytes of snapshots and history kept in memory, idle documents beyond it are unloaded. None keeps everything
+        self.options.setdefault('residentBytes', None)
+
+        # Least recently used first
+        self.docs = collections.OrderedDict()
+        # The documents nobody listens to, the only ones evict can unload, least recently used first
+        self.evictable = collections.OrderedDict()
+        self.loading = {}
+        self.resident_bytes = 0
+        self.stats = {'broadcasts': 0, 'frames_encoded': 0, 'encodes_saved': 0, 'ops_merged': 0, 'loads': 0, 'evictions': 0}
 
-        self.docs = {}
+        self.storage = self.options.get('storage')
+        if self.storage is None and self.options.get('storagePath'):
+            # Reads go to a thread when there is an event loop to hand them back to
+            self.storage = FileStorage(self.options['storagePath'], self.options, loop)
 
     def process_queue(self, doc):
-        if doc['queuelock'] or len(doc['queue']) == 0:
+        """Drains the document's queue, applying runs of ops one source pipelined on top of each other as one op"""
+        if doc.queuelock:
             return
 
-        doc['queuelock'] = True
-        op, callback = doc['queue'].pop(0)
-        self.handle_op(doc, op, callback)
-        doc['queuelock'] = False
+        doc.queuelock = True
+        queue = doc.queue
+        while queue:
+            op, callback = queue.popleft()
+            callbacks = [callback]
+            following = []
+            while queue and self.follows(op, queue[0][0]):
+                nextOp, callback = queue.popleft()
+                following.append(nextOp)
+                callbacks.append(callback)
+            if following:
+                self.stats['ops_merged'] += len(following)
+                callback = functools.partial(self.merged_callback, callbacks)
+            self.handle_op(doc, op, callback, following)
+        doc.queuelock = False
 
-        self.process_queue(doc)
+    def follows(self, op, following):
+        """True if following was sent by the same source against the same version while op was in flight, so it was built on top of op"""
+        if op.get('source') is None or following.get('source') != op.get('source') or 'v' not in op or following.get('v') != op['v']:
+            return False
+        return following.get('base') is None or op.get('seq') is None or following['base'] <= op['seq']
 
-    def handle_op(self, doc, op, callback):
+    def merged_callback(self, callbacks, error, version):
+        for callback in callbacks:
+            callback(error, version)
+
+    def handle_op(self, doc, op, callback, following=()):
+        """Applies op, and the ops its source built on top of it against the same version in following"""
+        ops = [op] + list(following)
         if 'v' not in op or op['v'] < 0:
-            return callback('Version missing', None)
-        if op['v'] > doc['v']:
-            return callback('Op at future version', None)
-        if op['v'] < doc['v'] - self.options['maximumAge']:
-            return callback('Op too old', None)
+            return self.reject(doc, ops, callback, 'Version missing')
+        if op['v'] > doc.v:
+            return self.reject(doc, ops, callback, 'Op at future version')
+        if op['v'] < doc.v - self.options['maximumAge']:
+            return self.reject(doc, ops, callback, 'Op too old')
         if op['v'] < 0:
-            return callback('Invalid version', None)
+            return self.reject(doc, ops, callback, 'Invalid version')
+
+        if doc.v - op['v'] > len(doc.ops):
+            return self.reject(doc, ops, callback, 'Op too old')
 
-        ops = doc['ops'][(len(doc['ops'])+op['v']-doc['v']):]
+        source = op.get('source')
+        if op.get('base') is not None and op['base'] <= doc.failed.get(source, 0):
+            return self.reject(doc, ops, callback, 'Built on an op that failed')
 
-        if doc['v'] - op['v'] != len(ops):
-            logger.error("Could not get old ops in model for document {1}. Expected ops {1} to {2} and got {3} ops".format(doc['name'], op['v'], doc['v'], len(ops)))
-            return callback('Internal error', None)
+        bridge = doc.bridges.get(source) if source is not None else None
+        try:
+            if bridge is not None and op['v'] <= bridge.v:
+                # Built on top of ops from the same source the client had no ack for yet
+                others = [[v, other] for v, other in bridge.ops if v >= op['v']]
+            elif following or op.get('seq') is not None:
+                others = [[oldOp.v, oldOp.op] for oldOp in doc.ops.last(doc.v - op['v'])]
+            else:
+                # Its source waits for the ack before sending more and never needs a bridge
+                others = None
 
-        for oldOp in ops:
-            op['op'] = op_transform(op['op'], oldOp['op'], 'left')
-            op['v']+=1
+            if others is not None:
+                # Op by op, like the client transforms the ops it has in flight. Against composed ops
+                # ties break differently where deletes leave inserts side by side
+                parts = []
+                for part in [o['op'] for o in ops]:
+                    for entry in others:
+                        part, entry[1] = op_transform_x(part, entry[1])
+                    parts.append(part)
+                op['op'] = functools.reduce(op_compose, parts)
+            else:
+                for other in doc.ops.suffix(doc.v - op['v']):
+                    op['op'] = op_transform(op['op'], other, 'left')
+            op['v'] = doc.v
 
-        newSnapshot = op_apply(doc['snapshot'], op['op'])
+            newSnapshot = op_apply(doc.snapshot, op['op'])
+        except Exception as e:
+            return self.reject(doc, ops, callback, str(e))
 
-        if op['v'] != doc['v']:
-            logger.error("Version mismatch detected in model. File a ticket - this is a bug. Expecting {0} == {1}".format(op['v'], doc['v']))
-            return callback('Internal error', None)
+        # How the source numbered its pipelined ops means nothing to anyone else
+        op.pop('seq', None)
+        op.pop('base', None)
 
-        oldSnapshot = doc['snapshot']
-        doc['v'] = op['v'] + 1
-        doc['snapshot'] = newSnapshot
-        for listener in doc['listeners']:
-            listener(op, newSnapshot, oldSnapshot)
+        pending = Pending(op, len(ops), callback, newSnapshot, doc.snapshot)
+        doc.v = op['v'] + 1
+        doc.snapshot = newSnapshot
+        self.update_bridges(doc, op, others)
+        doc.unpublished.append(pending)
+        self.save_op(doc, pending)
 
-        def save_op_callback(error=None):
-            if error:
-                logger.error("Error saving op: {0}".format(error))
-                return callback(error, None)
+    def publish(self, doc):
+        """Broadcasts and acks saved ops in version order, so no client hears of an op a crash could still lose"""
+        while doc.unpublished and doc.unpublished[0].saved:
+            pending = doc.unpublished.popleft()
+            op = pending.op
+            if op is None:
+                pending.callback(pending.error, None)
+                continue
+            doc.published = op['v'] + 1
+            doc.published_snapshot = pending.snapshot
+            doc.sources[op.get('source')] = doc.sources.get(op.get('source'), 0) + pending.count
+            broadcast = Broadcast(op)
+            for listener in doc.listeners:
+                listener(op, pending.snapshot, pending.oldsnapshot, broadcast)
+            self.stats['broadcasts'] += 1
+            self.stats['frames_encoded'] += broadcast.encoded
+            self.stats['encodes_saved'] += broadcast.shared
+
+            if pending.error:
+                logger.error("Error saving op: {0}".format(pending.error))
+                pending.callback(pending.error, None)
             else:
-                return callback(None, op['v'])
-        self.save_op(doc['name'], op, save_op_callback)
+                pending.callback(None, op['v'])
 
-    def save_op(self, docname, op, callback):
-        doc = self.docs[docname]
-        doc['ops'].append(op)
-        if len(doc['ops']) > self.options['numCachedOps']:
-            doc['ops'].pop(0)
-        if not doc['savelock'] and doc['savedversion'] + self.options['opsBeforeCommit'] <= doc['v']:
-            pass
-        callback(None)
+    def reject(self, doc, ops, callback, error):
+        """Fails ops, remembering their seqs so ops their source pipelined on top of them fail too"""
+        seqs = [o['seq'] for o in ops if o.get('seq') is not None]
+        if seqs and ops[0].get('source') is not None:
+            doc.failed[ops[0]['source']] = max(seqs + [doc.failed.get(ops[0]['source'], 0)])
+        if doc.unpublished:
+            # The error must not overtake the acks of ops applied before it
+            pending = Pending(None, len(ops), callback, None, None)
+            pending.saved = True
+            pending.error = error
+            doc.unpublished.append(pending)
+            return
+        return callback(error, None)
+
+    def update_bridges(self, doc, op, others):
+        """Adds the op just applied to the bridge of every other source and drops what no valid op can need"""
+        horizon = doc.v - self.options['maximumAge']
+        for source, bridge in list(doc.bridges.items()):
+            if bridge.v < horizon:
+                del doc.bridges[source]
+            else:
+                while bridge.ops and bridge.ops[0][0] < horizon:
+                    bridge.ops.popleft()
+                bridge.ops.append((op['v'], op['op']))
+        if op.get('source') is None:
+            return
+        if others is None:
+            doc.bridges.pop(op['source'], None)
+        else:
+            doc.bridges[op['source']] = Bridge(op['v'], collections.deque(tuple(entry) for entry in others))
+
+    def save_op(self, doc, pending):
+        op, count = pending.op, pending.count
+        doc.ops.append(Op(doc.name, op['v'], op['op'], op.get('source'), count))
+        self.resize(doc)
+
+        def write_op(error=None):
+            pending.saved = True
+            pending.error = error
+            self.publish(doc)
+            if error or not self.storage:
+                return
+            if not doc.savelock and doc.savedversion + self.options['opsBeforeCommit'] <= doc.published:
+                self.try_write_snapshot(doc.name)
+            self.evict(doc)
+
+        if not self.storage:
+            return write_op()
+        # Calls back once the op is durable
+        self.storage.write_op(doc.name, dict(op, count=count) if count > 1 else op, write_op)
+
+    def resize(self, doc):
+        size = len(doc.snapshot) + doc.ops.bytes
+        self.resident_bytes += size - doc.size
+        doc.size = size
+
+    def evict(self, keep=None):
+        """Unloads least recently used documents nobody listens to until the resident size fits residentBytes"""
+        budget = self.options['residentBytes']
+        if budget is None or not self.storage or self.resident_bytes <= budget:
+            return
+        excess = self.resident_bytes - budget
+        victims = []
+        for docname, doc in self.evictable.items():
+            if excess <= 0:
+                break
+            if doc is keep or doc.queue or doc.queuelock or doc.savelock or doc.unpublished:
+                continue
+            victims.append((docname, doc))
+            excess -= doc.size
+        for docname, doc in victims:
+            # Every op is in the log already, the snapshot only saves replaying them on the next load
+            self.try_write_snapshot(docname, lambda docname=docname, doc=doc: self.unload(docname, doc))
+
+    def unload(self, docname, doc):
+        if self.docs.get(docname) is not doc or doc.listeners or doc.queue or doc.queuelock or doc.unpublished:
+            return
+        del self.docs[docname]
+        self.evictable.pop(docname, None)
+        self.resident_bytes -= doc.size
+        self.stats['evictions'] += 1
+
+    def try_write_snapshot(self, docname, callback=None):
+        if not self.storage:
+            return callback() if callback else None
+
+        doc = self.docs.get(docname)
+        if not doc or doc.savelock or doc.savedversion == doc.published:
+            return callback() if callback else None
+
+        doc.savelock = True
+        def write_snapshot(error=None):
+            doc.savelock = False
+            if error:
+                logger.error("Error writing snapshot of {0}: {1}".format(docname, error))
+            else:
+                doc.savedversion = data['v']
+            return callback() if callback else None
+        data = {'v':doc.published, 'snapshot':doc.published_snapshot, 'sources':doc.sources}
+        self.storage.write_snapshot(docname, data, write_snapshot)
 
     def exists(self, docname):
-        return docname in self.docs
+        return docname in self.docs or (self.storage is not None and self.storage.exists(docname))
 
     def get_docs(self, callback):
-        callback(None, [self.docs[doc]['name'] for doc in self.docs])
+        if not self.storage:
+            return callback(None, [self.docs[doc].name for doc in self.docs])
+        def storage_get_docs(error, docs):
+            if error: return callback(error, None)
+            callback(None, sorted(set(docs) | set(self.docs)))
+        self.storage.get_docs(storage_get_docs)
 
     def add(self, docname, data):
-        self.docs[docname] = {
-            'name': docname,
-            'snapshot': data['snapshot'],
-            'v': data['v'],
-            'ops': data['ops'],
-            'listeners': [],
-            'savelock': False,
-            'savedversion': 0,
-            'queue': [],
-            'queuelock': False,
-        }
+        self.docs[docname] = Document(docname,
+            Rope(data['snapshot']) if not isinstance(data['snapshot'], Rope) else data['snapshot'],
+            data['v'],
+            OpHistory(self.options['numCachedOps'], self.options['historyBytes'], data['ops']),
+            data.get('sources', {}),
+            data.get('savedversion', 0))
+        self.evictable[docname] = self.docs[docname]
+        self.resize(self.docs[docname])
+        self.evict(self.docs[docname])
 
     def load(self, docname, callback):
-        try:
-            return callback(None, self.docs[docname])
-        except KeyError:
+        """Calls back with the document, reading it from storage if it is not resident. Concurrent loads share one read"""
+        if docname in self.docs:
+            # Moves it to the most recently used end
+            doc = self.docs[docname] = self.docs.pop(docname)
+            if docname in self.evictable:
+                self.evictable[docname] = self.evictable.pop(docname)
+            return callback(None, doc)
+        if not self.storage:
             return callback('Document does not exist', None)
+        if docname in self.loading:
+            return self.loading[docname].append(callback)
+        self.loading[docname] = [callback]
+
+        def loaded(error, doc):
+            for callback in self.loading.pop(docname):
+                callback(error, doc)
 
-        # self.loadingdocs = {}
-        # self.loadingdocs.setdefault(docname, []).append(callback)
-        # if docname in self.loadingdocs:
-        #     for callback in self.loadingdocs[docname]:
-        #         callback(None, doc)
-        #     del self.loadingdocs[docname]
+        def storage_get_ops(error, ops):
+            if error: return loaded(error, None)
+            if not self.storage.exists(docname):
+                # Deleted while we were reading it
+                return loaded('Document does not exist', None)
+            for op in ops:
+                if op['v'] < data['v']: continue
+                if op['v'] != data['v']:
+                    logger.error("Op log of {0} skips from version {1} to {2}".format(docname, data['v'], op['v']))
+                    break
+                op['op'] = op_from_wire(op['op'])
+                # Checked when it was first applied
+                data['snapshot'] = op_apply(data['snapshot'], op['op'], False)
+                data['sources'][op['source']] = data['sources'].get(op['source'], 0) + op.get('count', 1)
+                data['v'] += 1
+            data['ops'] = [Op(docname, op['v'], op_from_wire(op['op']), op['source'], op.get('count', 1)) for op in ops if op['v'] < data['v']][-self.options['numCachedOps']:]
+            self.stats['loads'] += 1
+            self.add(docname, data)
+            return loaded(None, self.docs[docname])
+
+        def storage_get_snapshot(error, snapshot):
+            if error: return loaded(error, None)
+            data.update(snapshot)
+            if not isinstance(data['snapshot'], Rope):
+                data['snapshot'] = Rope(data['snapshot'])
+            data['savedversion'] = snapshot['v']
+            self.storage.get_ops(docname, 0, storage_get_ops)
+
+        data = {}
+        self.storage.get_snapshot(docname, storage_get_snapshot)
 
     def create(self, docname, snapshot=None, callback=None):
         if not re.match("^[A-Za-z0-9._-]*$", docname):
@@ -115,46 +482,110 @@ class CollabModel(object):
             'v': 0,
             'ops': []
         }
-        self.add(docname, data)
 
-        return callback(None) if callback else None
+        def storage_create(error=None):
+            if error: return callback(error) if callback else None
+            self.add(docname, data)
+            return callback(None) if callback else None
+
+        if not self.storage:
+            return storage_create()
+        self.storage.create(docname, data, storage_create)
 
     def delete(self, docname, callback=None):
-        if docname not in self.docs: raise Exception('delete called but document does not exist')
-        del self.docs[docname]
+        if not self.exists(docname): raise Exception('delete called but document does not exist')
+        doc = self.docs.pop(docname, None)
+        self.evictable.pop(docname, None)
+        if doc: self.resident_bytes -= doc.size
+        if self.storage:
+            return self.storage.delete(docname, callback)
         return callback(None) if callback else None
 
     def listen(self, docname, listener, callback=None):
         def done(error, doc):
             if error: return callback(error, None) if callback else None
-            doc['listeners'].append(listener)
-            return callback(None, doc['v']) if callback else None
+            self.add_listener(doc, listener)
+            return callback(None, doc.published) if callback else None
+        self.load(docname, done)
+
+    def listen_data(self, docname, listener, since, callback):
+        """Adds listener and calls back with the document data in the same step, so no op can go by in between.
+
+        With since set the data has the ops after it instead of the snapshot, if they are still in the history"""
+        def done(error, doc):
+            if error: return callback(error, None)
+            self.add_listener(doc, listener)
+            return callback(None, self.data(doc, since))
         self.load(docname, done)
 
     def remove_listener(self, docname, listener):
         if docname not in self.docs: raise Exception('remove_listener called but document not loaded')
-        self.docs[docname]['listeners'].remove(listener)
+        doc = self.docs[docname]
+        doc.listeners.remove(listener)
+        if not doc.listeners:
+            self.evictable[docname] = doc
+
+    def add_listener(self, doc, listener):
+        doc.listeners.append(listener)
+        self.evictable.pop(doc.name, None)
 
     def get_version(self, docname, callback):
-        self.load(docname, lambda error, doc: callback(error, None if error else doc['v']))
+        self.load(docname, lambda error, doc: callback(error, None if error else doc.published))
 
     def get_snapshot(self, docname, callback):
-        self.load(docname, lambda error, doc: callback(error, None if error else doc['snapshot']))
+        self.load(docname, lambda error, doc: callback(error, None if error else doc.published_snapshot.text()))
+
+    def get_ops(self, docname, start, callback):
+        def done(error, doc):
+            if error: return callback(error, None)
+            if start < doc.v - len(doc.ops) or start > doc.published:
+                return callback('Op too old', None)
+            return callback(None, self.published_ops(doc, start))
+        self.load(docname, done)
+
+    def published_ops(self, doc, start):
+        return [op.to_wire() for op in doc.ops.last(doc.v - start)[:doc.published - start]]
 
     def get_data(self, docname, callback):
-        self.load(docname, lambda error, doc: callback(error, None if error else doc))
+        self.load(docname, lambda error, doc: callback(error, None if error else self.data(doc)))
+
+    def data(self, doc, since=None):
+        if since is not None and doc.v - len(doc.ops) <= since <= doc.published:
+            return {'v':doc.published, 'ops':self.published_ops(doc, since), 'sources':doc.sources}
+        return {'v':doc.published, 'snapshot':doc.published_snapshot.text(), 'sources':doc.sources}
 
     def apply_op(self, docname, op, callback):
+        self.apply_ops(docname, [(op, callback)])
+
+    def apply_ops(self, docname, batch):
+        """Queues a batch of (op, callback) pairs in one go, so consecutive ops from one source can be composed"""
+        valid = []
+        for op, callback in batch:
+            try:
+                op['op'] = op_from_wire(op['op'])
+            except (ValueError, TypeError, AttributeError) as e:
+                callback(str(e), None)
+                continue
+            valid.append((op, callback))
+        batch = valid
+
         def on_load(error, doc):
             if error:
-                callback(error, None)
+                for op, callback in batch:
+                    callback(error, None)
             else:
-                doc['queue'].append((op, callback))
+                doc.queue.extend(batch)
                 self.process_queue(doc)
         self.load(docname, on_load)
         
     def flush(self, callback=None):
-        return callback() if callback else None
+        if not self.storage:
+            return callback() if callback else None
+        for docname in list(self.docs):
+            self.try_write_snapshot(docname)
+        self.storage.flush(lambda error=None: callback() if callback else None)
 
     def close(self):
         self.flush()
+        if self.storage:
+            self.storage.close()
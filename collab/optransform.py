@@ -1,122 +1,627 @@
+import sys
+from .rope import Rope, LEAF_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this many positions the pure Python pass beats converting to and from arrays
+NUMPY_MIN_POSITIONS = 64
+
+# Below this many components on either side going through all of leftOp is cheaper
+LINEAR_TRANSFORM_MIN = 8
+
+TEXT_TYPES = (str, unicode) if sys.version_info[0] < 3 else (str,)
+
+class Component(object):
+    """One insert (i set) or delete (d set) at position p.
+
+    Ops are lists of these everywhere inside the server and the client, they
+    only turn into {'p', 'i'} / {'p', 'd'} dicts on the wire."""
+    __slots__ = ('p', 'i', 'd')
+
+    def __init__(self, p, i=None, d=None):
+        self.p = p
+        self.i = i
+        self.d = d
+
+    @classmethod
+    def from_wire(cls, c):
+        """Checks components coming off the wire, op_apply and the transforms trust positions and text"""
+        if isinstance(c, cls):
+            return c
+        if not isinstance(c, dict):
+            raise ValueError('Op component {0} is not an object'.format(c))
+        p = c.get('p') or 0
+        if isinstance(p, bool) or not isinstance(p, int) or p < 0:
+            raise ValueError('Op component {0} has no valid position'.format(c))
+        if 'i' in c:
+            if not isinstance(c['i'], TEXT_TYPES):
+                raise ValueError('Op component {0} inserts no text'.format(c))
+            return cls(p, c['i'], None)
+        if 'd' in c:
+            if not isinstance(c['d'], TEXT_TYPES):
+                raise ValueError('Op component {0} deletes no text'.format(c))
+            return cls(p, None, c['d'])
+        raise ValueError('Op component {0} is neither an insert nor a delete'.format(c))
+
+    def to_wire(self):
+        return {'p':self.p, 'i':self.i} if self.i is not None else {'p':self.p, 'd':self.d}
+
+    def __eq__(self, other):
+        return isinstance(other, Component) and self.p == other.p and self.i == other.i and self.d == other.d
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.to_wire())
+
+def op_from_wire(op):
+    return [Component.from_wire(c) for c in op]
+
+def op_to_wire(op):
+    return [c.to_wire() for c in op]
+
 def op_inject(s1, pos, s2):
     return s1[:pos] + s2 + s1[pos:]
 
-def op_apply(snapshot, op):
+def op_apply(snapshot, op, strict=True):
+    """Applies op to a string or Rope snapshot.
+
+    Strings are rebuilt in one left to right pass, joining the kept and
+    inserted pieces once. strict checks that deletes match the text they
+    remove, ops the server has applied before can skip that."""
+    if isinstance(snapshot, Rope):
+        return op_apply_rope(snapshot, op, strict)
+    out = []
+    pos = 0
+    for step in _traversal(op):
+        if isinstance(step, int):
+            out.append(snapshot[pos:pos + step])
+            pos += step
+        elif step.i is not None:
+            out.append(step.i)
+        else:
+            if strict and not snapshot.startswith(step.d, pos):
+                raise Exception("Delete component '{0}' does not match deleted text '{1}'".format(step.d, snapshot[pos:pos + len(step.d)]))
+            pos += len(step.d)
+    if strict and pos > len(snapshot):
+        raise Exception('Op reaches past the end of a document of length {0}'.format(len(snapshot)))
+    out.append(snapshot[pos:])
+    return snapshot[:0].join(out)
+
+def op_apply_rope(snapshot, op, strict=True):
+    if len(op) > 1 and len(op) * LEAF_SIZE * 4 > len(snapshot):
+        # Each component copies a leaf and its path, past this one pass over the whole text is cheaper
+        return Rope(op_apply(snapshot.text(), op, strict))
     for component in op:
-        if 'i' in component:
-            snapshot = op_inject(snapshot, component['p'], component['i'])
+        if component.i is not None:
+            snapshot = snapshot.insert(component.p, component.i)
         else:
-            deleted = snapshot[component['p']:(component['p'] + len(component['d']))]
-            if(component['d'] != deleted): raise Exception("Delete component '{0}' does not match deleted text '{1}'".format(component['d'], deleted))
-            snapshot = snapshot[:component['p']] + snapshot[(component['p'] + len(component['d'])):]
+            if strict:
+                deleted = snapshot[component.p:(component.p + len(component.d))]
+                if(component.d != deleted): raise Exception("Delete component '{0}' does not match deleted text '{1}'".format(component.d, deleted))
+            snapshot = snapshot.delete(component.p, len(component.d))
     return snapshot
 
+def op_diff(oldval, newval):
+    if oldval == newval:
+        return []
+
+    commonStart = 0
+    while commonStart < len(oldval) and commonStart < len(newval) and oldval[commonStart] == newval[commonStart]:
+        commonStart+=1
+
+    commonEnd = 0
+    while commonEnd+commonStart < len(oldval) and commonEnd+commonStart < len(newval) and oldval[len(oldval)-1-commonEnd] == newval[len(newval)-1-commonEnd]:
+        commonEnd+=1
+
+    op = []
+    if len(oldval) != commonStart+commonEnd:
+        op.append(Component(commonStart, None, oldval[commonStart:len(oldval)-commonEnd]))
+    if len(newval) != commonStart+commonEnd:
+        op.append(Component(commonStart, newval[commonStart:len(newval)-commonEnd], None))
+    return op
+
 def op_append(newOp, c):
-    if 'i' in c and c['i'] == '': return
-    if 'd' in c and c['d'] == '': return
+    if c.i == '' or c.d == '': return
     if len(newOp) == 0:
         newOp.append(c)
     else:
         last = newOp[len(newOp) - 1]
 
-        if 'i' in last and 'i' in c and last['p'] <= c['p'] <= (last['p'] + len(last['i'])):
-            newOp[len(newOp) - 1] = {'i':op_inject(last['i'], c['p'] - last['p'], c['i']), 'p':last['p']}
-        elif 'd' in last and 'd' in c and c['p'] <= last['p'] <= (c['p'] + len(c['d'])):
-            newOp[len(newOp) - 1] = {'d':op_inject(c['d'], last['p'] - c['p'], last['d']), 'p':c['p']}
+        if last.i is not None and c.i is not None and last.p <= c.p <= (last.p + len(last.i)):
+            newOp[len(newOp) - 1] = Component(last.p, op_inject(last.i, c.p - last.p, c.i), None)
+        elif last.d is not None and c.d is not None and c.p <= last.p <= (c.p + len(c.d)):
+            newOp[len(newOp) - 1] = Component(c.p, None, op_inject(c.d, last.p - c.p, last.d))
         else:
             newOp.append(c)
 
-def op_compose(op1, op2):
-    newOp = list(op1)
-    [op_append(newOp, c) for c in op2]
-    return newOp
-
 def op_compress(op):
     return op_compose([], op)
 
 def op_normalize(op):
     newOp = []
 
-    if(isinstance(op, dict)): op = [op]
+    if(isinstance(op, (dict, Component))): op = [op]
 
-    for c in op:
-        if 'p' not in c or not c['p']: c['p'] = 0
+    for c in op_from_wire(op):
         op_append(newOp, c)
 
     return newOp
 
 def op_invert_component(c):
-    if 'i' in c:
-        return {'d':c['i'], 'p':c['p']}
+    if c.i is not None:
+        return Component(c.p, None, c.i)
     else:
-        return {'i':c['d'], 'p':c['p']}
+        return Component(c.p, c.d, None)
 
 def op_invert(op):
     return [op_invert_component(c) for c in reversed(op)]
 
 def op_transform_position(pos, c, insertAfter=False):
-    if 'i' in c:
-        if c['p'] < pos or (c['p'] == pos and insertAfter):
-            return pos + len(c['i'])
+    if c.i is not None:
+        if c.p < pos or (c.p == pos and insertAfter):
+            return pos + len(c.i)
         else:
             return pos
     else:
-        if pos <= c['p']:
+        if pos <= c.p:
             return pos
-        elif pos <= c['p'] + len(c['d']):
-            return c['p']
+        elif pos <= c.p + len(c.d):
+            return c.p
         else:
-            return pos - len(c['d'])
+            return pos - len(c.d)
 
 def op_transform_cursor(position, op, insertAfter=False):
     for c in op:
         position = op_transform_position(position, c, insertAfter)
     return position
 
+def op_transform_cursors(positions, op, insertAfter=False):
+    """Transforms a list of positions through op in one call, same results as op_transform_cursor on each.
+
+    Every component moves all positions at once, as NumPy array operations
+    when it is installed and there are enough positions to pay for the
+    conversion, otherwise in one list comprehension."""
+    if numpy is not None and len(positions) >= NUMPY_MIN_POSITIONS:
+        return _transform_cursors_numpy(positions, op, insertAfter)
+    positions = list(positions)
+    for c in op:
+        p = c.p
+        if c.i is not None:
+            size = len(c.i)
+            if insertAfter:
+                positions = [x + size if x >= p else x for x in positions]
+            else:
+                positions = [x + size if x > p else x for x in positions]
+        else:
+            size = len(c.d)
+            end = p + size
+            positions = [x - size if x > end else p if x > p else x for x in positions]
+    return positions
+
+def _transform_cursors_numpy(positions, op, insertAfter):
+    positions = numpy.array(positions, dtype=numpy.int64)
+    for c in op:
+        if c.i is not None:
+            positions[positions >= c.p if insertAfter else positions > c.p] += len(c.i)
+        else:
+            end = c.p + len(c.d)
+            positions = numpy.where(positions > end, positions - len(c.d), numpy.minimum(positions, c.p))
+    return positions.tolist()
+
+def op_transform_regions(regions, op, insertAfter=False):
+    """Transforms a list of (a, b) regions through op in one call.
+
+    Empty regions are cursors and move like op_transform_cursor. Text
+    inserted at either edge of a selection stays outside of it."""
+    points = [point for region in regions for point in region]
+    before = op_transform_cursors(points, op, False)
+    after = op_transform_cursors(points, op, True)
+    result = []
+    for k, (a, b) in enumerate(regions):
+        if a == b:
+            point = (after if insertAfter else before)[2 * k]
+            result.append((point, point))
+        elif a < b:
+            result.append((after[2 * k], before[2 * k + 1]))
+        else:
+            result.append((before[2 * k], after[2 * k + 1]))
+    return result
+
 def op_transform_component(dest, c, otherC, type):
-    if 'i' in c:
-        op_append(dest, {'i':c['i'], 'p':op_transform_position(c['p'], otherC, type == 'right')})
+    if c.i is not None:
+        op_append(dest, Component(op_transform_position(c.p, otherC, type == 'right'), c.i, None))
     else:
-        if 'i' in otherC:
-            s = c['d']
-            if c['p'] < otherC['p']:
-                op_append(dest, {'d':s[:otherC['p'] - c['p']], 'p':c['p']})
-                s = s[(otherC['p'] - c['p']):]
+        if otherC.i is not None:
+            s = c.d
+            if c.p < otherC.p:
+                op_append(dest, Component(c.p, None, s[:otherC.p - c.p]))
+                s = s[(otherC.p - c.p):]
                 pass
             if s != '':
-                op_append(dest, {'d':s, 'p':c['p'] + len(otherC['i'])})
+                op_append(dest, Component(c.p + len(otherC.i), None, s))
         else:
-            if c['p'] >= otherC['p'] + len(otherC['d']):
-                op_append(dest, {'d':c['d'], 'p':c['p'] - len(otherC['d'])})
-            elif c['p'] + len(c['d']) <= otherC['p']:
+            if c.p >= otherC.p + len(otherC.d):
+                op_append(dest, Component(c.p - len(otherC.d), None, c.d))
+            elif c.p + len(c.d) <= otherC.p:
                 op_append(dest, c)
             else:
-                newC = {'d':'', 'p':c['p']}
-                if c['p'] < otherC['p']:
-                    newC['d'] = c['d'][:(otherC['p'] - c['p'])]
+                newC = Component(c.p, None, '')
+                if c.p < otherC.p:
+                    newC.d = c.d[:(otherC.p - c.p)]
                     pass
-                if c['p'] + len(c['d']) > otherC['p'] + len(otherC['d']):
-                    newC['d'] += c['d'][(otherC['p'] + len(otherC['d']) - c['p']):]
+                if c.p + len(c.d) > otherC.p + len(otherC.d):
+                    newC.d += c.d[(otherC.p + len(otherC.d) - c.p):]
                     pass
 
-                intersectStart = max(c['p'], otherC['p'])
-                intersectEnd = min(c['p'] + len(c['d']), otherC['p'] + len(otherC['d']))
-                cIntersect = c['d'][intersectStart - c['p']:intersectEnd - c['p']]
-                otherIntersect = otherC['d'][intersectStart - otherC['p']:intersectEnd - otherC['p']]
+                intersectStart = max(c.p, otherC.p)
+                intersectEnd = min(c.p + len(c.d), otherC.p + len(otherC.d))
+                cIntersect = c.d[intersectStart - c.p:intersectEnd - c.p]
+                otherIntersect = otherC.d[intersectStart - otherC.p:intersectEnd - otherC.p]
                 if cIntersect != otherIntersect:
                     raise Exception('Delete ops delete different text in the same region of the document')
 
-                if newC['d'] != '':
-                    newC['p'] = op_transform_position(newC['p'], otherC)
+                if newC.d != '':
+                    newC.p = op_transform_position(newC.p, otherC)
                 op_append(dest, newC)
 
     return dest
 
+# Applying and composing work on traversals: lists of steps walking the
+# document the op applies to from start to end. A step is an int (keep that
+# many characters), or a Component with no position that inserts i or
+# deletes d at the current point. Walking traversals keeps both linear in the
+# number of components.
+
+def _width(step):
+    """Characters a step covers in the document after it"""
+    if isinstance(step, int): return step
+    return len(step.i) if step.i is not None else 0
+
+def _deleted(c):
+    return len(c.d) if c.d is not None else 0
+
+def _push(steps, step):
+    """Appends step to a traversal, merging it into the last step if both are of the same kind"""
+    if isinstance(step, int):
+        if not step: return
+        if steps and isinstance(steps[-1], int):
+            steps[-1] += step
+            return
+    elif step.i is not None:
+        if not step.i: return
+        if steps and not isinstance(steps[-1], int) and steps[-1].i is not None:
+            steps[-1] = Component(None, steps[-1].i + step.i, None)
+            return
+    else:
+        if not step.d: return
+        if steps and not isinstance(steps[-1], int) and steps[-1].d is not None:
+            steps[-1] = Component(None, None, steps[-1].d + step.d)
+            return
+    steps.append(step)
+
+def _split(step, offset):
+    """Splits a retain or insert step offset characters in"""
+    if isinstance(step, int):
+        return offset, step - offset
+    return Component(None, step.i[:offset], None), Component(None, step.i[offset:], None)
+
+def _insert_step(steps, c):
+    """Inserts the step for insert component c into a traversal, O(len(steps))"""
+    out = []
+    remaining = c.p
+    for k, step in enumerate(steps):
+        width = _width(step)
+        if remaining < width:
+            if remaining:
+                head, step = _split(step, remaining)
+                _push(out, head)
+            _push(out, Component(None, c.i, None))
+            _push(out, step)
+            for step in steps[k + 1:]:
+                _push(out, step)
+            return out
+        remaining -= width
+        _push(out, step)
+    _push(out, remaining)
+    _push(out, Component(None, c.i, None))
+    return out
+
+def _delete_steps(steps, c):
+    """Turns the characters delete component c removes into delete steps of a traversal, O(len(steps))"""
+    out = []
+    remaining = c.p
+    text = c.d
+    for step in steps:
+        width = _width(step)
+        if not text or remaining >= width:
+            if text: remaining -= width
+            _push(out, step)
+            continue
+        if remaining:
+            head, step = _split(step, remaining)
+            _push(out, head)
+            width -= remaining
+            remaining = 0
+        size = min(width, len(text))
+        if isinstance(step, int):
+            _push(out, Component(None, None, text[:size]))
+            _push(out, step - size)
+        else:
+            if step.i[:size] != text[:size]:
+                raise Exception("Delete component '{0}' does not match inserted text '{1}'".format(text[:size], step.i[:size]))
+            _push(out, Component(None, step.i[size:], None))
+        text = text[size:]
+    if text:
+        _push(out, remaining)
+        _push(out, Component(None, None, text))
+    return out
+
+def _traversal(op):
+    """Turns a sequential op into a traversal.
+
+    Ops whose components are in ascending order, each at or after the end of
+    the previous one, or in descending order, each ending at or before the
+    start of the previous one, convert in one pass. Anything else is built up
+    component by component. Inserts and deletes at the same point keep the
+    order they were made in, which decides how inserts of the other op tie
+    with them."""
+    steps = []
+    pos = 0
+    for c in op:
+        if c.p < pos:
+            break
+        _push(steps, c.p - pos)
+        _push(steps, Component(None, c.i, c.d))
+        pos = c.p + _width(c)
+    else:
+        return steps
+
+    steps = []
+    previous = None
+    for c in op:
+        if previous is not None and (c.p + _deleted(c) > previous.p or (c.p == previous.p and c.i is not None and previous.d is not None)):
+            break
+        previous = c
+    else:
+        pos = 0
+        for c in reversed(op):
+            _push(steps, c.p - pos)
+            _push(steps, Component(None, c.i, c.d))
+            pos = c.p + _deleted(c)
+        return steps
+
+    steps = []
+    for c in op:
+        steps = _insert_step(steps, c) if c.i is not None else _delete_steps(steps, c)
+    return steps
+
+def _components(steps):
+    op = []
+    pos = 0
+    for step in steps:
+        if isinstance(step, int):
+            pos += step
+        elif step.i is not None:
+            op_append(op, Component(pos, step.i, None))
+            pos += len(step.i)
+        else:
+            op_append(op, Component(pos, None, step.d))
+    return op
+
+def op_compose(op1, op2):
+    """Composes op1 and the op2 applied after it into one op.
+
+    Text op1 inserts and op2 deletes again cancels out, and the result is in
+    ascending order with touching components merged, so it is never longer
+    than the two together."""
+    first = _traversal(op1)
+    second = _traversal(op2)
+    steps = []
+
+    i = j = 0
+    a = first[0] if first else None
+    b = second[0] if second else None
+    while a is not None or b is not None:
+        if b is not None and not isinstance(b, int) and b.i is not None:
+            _push(steps, b)
+            j += 1
+            b = second[j] if j < len(second) else None
+            continue
+        if a is not None and not isinstance(a, int) and a.d is not None:
+            _push(steps, a)
+            i += 1
+            a = first[i] if i < len(first) else None
+            continue
+        if a is None or b is None:
+            # The implicit retain to the end of the other op
+            _push(steps, a if b is None else b)
+            if a is None:
+                j += 1
+                b = second[j] if j < len(second) else None
+            else:
+                i += 1
+                a = first[i] if i < len(first) else None
+            continue
+
+        # a keeps or inserts text that b keeps or deletes
+        sizeA = _width(a)
+        sizeB = b if isinstance(b, int) else len(b.d)
+        size = min(sizeA, sizeB)
+        if isinstance(a, int):
+            _push(steps, size if isinstance(b, int) else Component(None, None, b.d[:size]))
+        elif isinstance(b, int):
+            _push(steps, Component(None, a.i[:size], None))
+        elif a.i[:size] != b.d[:size]:
+            raise Exception("Delete component '{0}' does not match inserted text '{1}'".format(b.d[:size], a.i[:size]))
+
+        if size < sizeA:
+            a = _split(a, size)[1]
+        else:
+            i += 1
+            a = first[i] if i < len(first) else None
+        if size < sizeB:
+            b = b - size if isinstance(b, int) else Component(None, None, b.d[size:])
+        else:
+            j += 1
+            b = second[j] if j < len(second) else None
+
+    return _components(steps)
+
 def op_transform_component_x(left, right, destLeft, destRight):
     op_transform_component(destLeft, left, right, 'left')
     op_transform_component(destRight, right, left, 'right')
 
+def _in_order(op):
+    """True if no component of op is empty or starts before the text the one before it inserted ends"""
+    end = 0
+    for c in op:
+        if c.p < end or not (c.i or c.d):
+            return False
+        end = c.p + len(c.i) if c.i is not None else c.p
+    return True
+
+def _merges(last, c):
+    """True if op_append would merge c into last"""
+    if last.i is not None and c.i is not None:
+        return last.p <= c.p <= last.p + len(last.i)
+    if last.d is not None and c.d is not None:
+        return c.p <= last.p <= c.p + len(c.d)
+    return False
+
+def _shifted(c, by):
+    return Component(c.p + by, c.i, c.d) if by else c
+
+def _transform_x_linear(leftOp, rightOp):
+    """op_transform_x in one pass for ops with their components in order.
+
+    A right component leaves the left components before it alone and moves
+    everything after it by the same amount, so only the few left components
+    around it are transformed, the ones before are never looked at again and
+    the ones after are shifted lazily. Split right deletes go on a stack
+    where _transform_x_components recurses. Returns None where merged or reordered
+    left components could make the result differ from op_transform_x."""
+    if not _in_order(leftOp) or not _in_order(rightOp):
+        return None
+    for k in range(1, len(leftOp)):
+        if _merges(leftOp[k - 1], leftOp[k]):
+            return None
+
+    done = []       # left components every later right component is past
+    width = 0       # how far done moves right components
+    front = []      # left components the last right component transformed
+    tail = 0        # leftOp[tail:] is untouched except for offset
+    offset = 0
+    newRightOp = []
+
+    for r in rightOp:
+        r = Component(r.p + width, r.i, r.d)
+        queue, front = front, []
+        q = 0
+
+        while True:
+            if q < len(queue):
+                c = queue[q]
+            elif tail < len(leftOp):
+                c = _shifted(leftOp[tail], offset)
+            else:
+                break
+            if c.i is not None:
+                if c.p > r.p:
+                    break
+                step = len(c.i)
+            else:
+                if c.p + len(c.d) > r.p:
+                    break
+                step = -len(c.d)
+            if q < len(queue):
+                q += 1
+            else:
+                tail += 1
+            done.append(c)
+            width += step
+            r = Component(r.p + step, r.i, r.d)
+
+        stack = [newRightOp]
+        while r is not None:
+            if q < len(queue):
+                c = queue[q]
+            elif tail < len(leftOp):
+                c = _shifted(leftOp[tail], offset)
+            else:
+                break
+            # Everything from here on is after r and only shifts
+            if c.p > r.p if r.i is not None else c.p >= r.p + len(r.d):
+                break
+            if q < len(queue):
+                q += 1
+            else:
+                tail += 1
+
+            nextC = []
+            for l in op_transform_component([], c, r, 'left'):
+                if front and _merges(front[-1], l):
+                    op_append(front, l)
+                    l = front.pop()
+                last = front[-1] if front else done[-1] if done else None
+                if last is not None and (_merges(last, l) or l.p < last.p + len(last.i or '')):
+                    return None
+                front.append(l)
+            op_transform_component(nextC, r, c, 'right')
+
+            if len(nextC) == 1:
+                r = nextC[0]
+            elif len(nextC) == 0:
+                r = None
+            else:
+                # The first piece ends where c inserts, before everything left
+                first, r = nextC
+                stack.append([first])
+                queue[q:] = [_shifted(l, -len(first.d)) for l in queue[q:]]
+                offset -= len(first.d)
+
+        if r is not None:
+            op_append(stack[-1], r)
+            step = len(r.i) if r.i is not None else -len(r.d)
+            queue[q:] = [_shifted(l, step) for l in queue[q:]]
+            offset += step
+        while len(stack) > 1:
+            pieces = stack.pop()
+            [op_append(stack[-1], c) for c in pieces]
+
+        # What this right component moved may now touch what it shifted
+        last = front[-1] if front else done[-1] if done else None
+        c = queue[q] if q < len(queue) else _shifted(leftOp[tail], offset) if tail < len(leftOp) else None
+        if last is not None and c is not None and (_merges(last, c) or c.p < last.p + len(last.i or '')):
+            return None
+        front.extend(queue[q:])
+
+    newLeftOp = done + front
+    newLeftOp.extend(_shifted(c, offset) for c in leftOp[tail:])
+    return [newLeftOp, newRightOp]
+
 def op_transform_x(leftOp, rightOp):
+    """Transforms two ops made against the same document against each other, inserts of leftOp win ties.
+
+    Components of rightOp go through leftOp one at a time, so transforming
+    against two ops in turn gives the same result as against the two
+    concatenated, which late ops and clients with ops in flight rely on.
+    Ops with their components in order take _transform_x_linear instead of
+    going through all of leftOp for every component of rightOp."""
+    if len(leftOp) == 1 and len(rightOp) == 1:
+        return [op_transform_component([], leftOp[0], rightOp[0], 'left'), op_transform_component([], rightOp[0], leftOp[0], 'right')]
+
+    if len(leftOp) >= LINEAR_TRANSFORM_MIN and len(rightOp) >= LINEAR_TRANSFORM_MIN:
+        result = _transform_x_linear(leftOp, rightOp)
+        if result is not None:
+            return result
+    return _transform_x_components(leftOp, rightOp)
+
+def _transform_x_components(leftOp, rightOp):
     newRightOp = []
 
     for rightComponent in rightOp:
@@ -135,7 +640,7 @@ def op_transform_x(leftOp, rightOp):
                 rightComponent = None
                 break
             else:
-                l_, r_ = op_transform_x(leftOp[k:], nextC)
+                l_, r_ = _transform_x_components(leftOp[k:], nextC)
                 [op_append(newLeftOp, l) for l in l_]
                 [op_append(newRightOp, r) for r in r_]
                 rightComponent = None
@@ -0,0 +1,130 @@
+import threading, logging
+
+from .connection import Broadcast
+
+logger = logging.getLogger('Sublime Collaboration')
+
+# Clients send {'doc', 'presence': [[start, end], ...], 'v'} with their
+# selection at document version v, or 'presence': None when it goes away.
+# Each session keeps the latest selection of its user and transforms it
+# through every op, the hub then sends everyone in the document
+# {'doc', 'presence': [[userid, v, regions], ...]} with regions None for
+# users that left.
+#
+# On an op bus cluster every node has its own hub. Each passes the entries
+# of its own sessions to relay, which sends them through the broker to the
+# other nodes with the document open, and hands what comes back from them
+# to receive().
+
+class PresenceHub(object):
+    """Relays the selections of everyone in a document to the other sessions in it.
+
+    Sessions report changes with update(), the hub collects them and sends
+    one message per document every interval seconds with the latest regions
+    of each user that changed, however many updates came in between.
+
+    relay, if given, is called with (docname, entries) for every message
+    and with (docname, None) when a session joins, asking the other servers
+    to send all of their users again."""
+    def __init__(self, loop=None, interval=0.05, relay=None):
+        self.loop = loop
+        self.interval = interval
+        self.relay = relay
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.changed = {}
+        # docname -> {userid: origin} for users on other servers with a selection
+        self.remote = {}
+        self.scheduled = False
+        self.stats = {'updates': 0, 'messages': 0}
+
+    def join(self, docname, userid, session):
+        """Registers session in docname and sends it where everybody else is"""
+        with self.lock:
+            others = list(self.sessions.get(docname, {}).values())
+            self.sessions.setdefault(docname, {})[userid] = session
+        entries = [entry for entry in (other.presence_entry(docname) for other in others) if entry[2] is not None]
+        if entries:
+            session.send_presence(docname, Broadcast({'doc': docname, 'presence': entries}))
+        if self.relay is not None:
+            self.relay(docname, None)
+
+    def leave(self, docname, userid, session):
+        with self.lock:
+            sessions = self.sessions.get(docname)
+            # A resumed session may have taken over userid already
+            if not sessions or sessions.get(userid) is not session: return
+            del sessions[userid]
+            if not sessions:
+                del self.sessions[docname]
+                self.remote.pop(docname, None)
+                if self.relay is None:
+                    self.changed.pop(docname, None)
+                    return
+            self.changed.setdefault(docname, set()).add(userid)
+            self.schedule()
+
+    def update(self, docname, userid):
+        with self.lock:
+            self.stats['updates'] += 1
+            if docname not in self.sessions: return
+            self.changed.setdefault(docname, set()).add(userid)
+            self.schedule()
+
+    def schedule(self):
+        if self.scheduled: return
+        self.scheduled = True
+        if self.loop is not None:
+            self.loop.call_later(self.interval, self.tick)
+        else:
+            timer = threading.Timer(self.interval, self.tick)
+            timer.daemon = True
+            timer.start()
+
+    def tick(self):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            self.scheduled = False
+            targets = dict((docname, dict(self.sessions.get(docname, {}))) for docname in changed)
+
+        for docname, userids in changed.items():
+            sessions = targets[docname]
+            entries = [sessions[userid].presence_entry(docname) if userid in sessions else [userid, None, None] for userid in sorted(userids)]
+            self.send_all(docname, sessions.values(), entries)
+            if self.relay is not None:
+                self.relay(docname, entries)
+            self.stats['messages'] += 1
+
+    def receive(self, docname, entries, origin):
+        """Passes the entries another server relayed on to the sessions here, None asks for all of ours"""
+        with self.lock:
+            sessions = list(self.sessions.get(docname, {}).values())
+            if not sessions: return
+            if entries is None:
+                self.changed.setdefault(docname, set()).update(self.sessions[docname])
+                return self.schedule()
+            remote = self.remote.setdefault(docname, {})
+            for userid, version, regions in entries:
+                if regions is None:
+                    remote.pop(userid, None)
+                else:
+                    remote[userid] = origin
+        self.send_all(docname, sessions, entries)
+
+    def forget(self, origin):
+        """Clears the selections of everyone on a server that went away"""
+        gone = {}
+        with self.lock:
+            for docname, remote in self.remote.items():
+                userids = [userid for userid, where in remote.items() if where == origin]
+                for userid in userids:
+                    del remote[userid]
+                if userids:
+                    gone[docname] = (userids, list(self.sessions.get(docname, {}).values()))
+        for docname, (userids, sessions) in gone.items():
+            self.send_all(docname, sessions, [[userid, None, None] for userid in sorted(userids)])
+
+    def send_all(self, docname, sessions, entries):
+        broadcast = Broadcast({'doc': docname, 'presence': entries})
+        for session in sessions:
+            session.send_presence(docname, broadcast)
@@ -0,0 +1,153 @@
+"""Persistent rope used as the document snapshot on both the server and the client.
+
+A Rope is an immutable AVL tree of text chunks. insert and delete copy only
+the path to the chunks they touch, so they are O(log n) in the length of the
+document and the previous rope stays valid, which is what listeners holding
+on to an old snapshot expect. The full string is only built by text(), when
+a snapshot actually has to leave the process.
+"""
+
+LEAF_SIZE = 1024
+LEAF_MAX = 2 * LEAF_SIZE
+
+class _Leaf(object):
+    __slots__ = ('text', 'length')
+    height = 0
+
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+class _Node(object):
+    __slots__ = ('left', 'right', 'length', 'height')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+        self.height = max(left.height, right.height) + 1
+
+def _build(text, start=0, end=None):
+    if end is None: end = len(text)
+    if end - start <= LEAF_MAX:
+        return _Leaf(text[start:end]) if end > start else None
+    chunks = (end - start + LEAF_SIZE - 1) // LEAF_SIZE
+    middle = start + (chunks // 2) * LEAF_SIZE
+    return _Node(_build(text, start, middle), _build(text, middle, end))
+
+def _make(left, right):
+    """Joins two trees whose heights differ by at most two, rotating once if needed"""
+    if left.height > right.height + 1:
+        if left.left.height >= left.right.height:
+            return _Node(left.left, _Node(left.right, right))
+        return _Node(_Node(left.left, left.right.left), _Node(left.right.right, right))
+    if right.height > left.height + 1:
+        if right.right.height >= right.left.height:
+            return _Node(_Node(left, right.left), right.right)
+        return _Node(_Node(left, right.left.left), _Node(right.left.right, right.right))
+    return _Node(left, right)
+
+def _join(left, right):
+    if left is None: return right
+    if right is None: return left
+    if left.height > right.height + 1:
+        return _make(left.left, _join(left.right, right))
+    if right.height > left.height + 1:
+        return _make(_join(left, right.left), right.right)
+    if left.height == 0 and right.height == 0 and left.length + right.length <= LEAF_SIZE:
+        return _Leaf(left.text + right.text)
+    return _make(left, right)
+
+def _insert(node, pos, text):
+    if node is None:
+        return _build(text)
+    if node.height == 0:
+        text = node.text[:pos] + text + node.text[pos:]
+        return _Leaf(text) if len(text) <= LEAF_MAX else _build(text)
+    if pos <= node.left.length:
+        return _join(_insert(node.left, pos, text), node.right)
+    return _join(node.left, _insert(node.right, pos - node.left.length, text))
+
+def _delete(node, pos, length):
+    if length <= 0:
+        return node
+    if node.height == 0:
+        text = node.text[:pos] + node.text[pos + length:]
+        return _Leaf(text) if text else None
+    split = node.left.length
+    if pos + length <= split:
+        return _join(_delete(node.left, pos, length), node.right)
+    if pos >= split:
+        return _join(node.left, _delete(node.right, pos - split, length))
+    return _join(_delete(node.left, pos, split - pos), _delete(node.right, 0, length - (split - pos)))
+
+def _collect(node, start, end, out):
+    if node is None or start >= end:
+        return
+    if node.height == 0:
+        out.append(node.text[start:end] if start > 0 or end < node.length else node.text)
+        return
+    split = node.left.length
+    if start < split:
+        _collect(node.left, start, min(end, split), out)
+    if end > split:
+        _collect(node.right, max(start - split, 0), end - split, out)
+
+class Rope(object):
+    __slots__ = ('root', '_text')
+
+    def __init__(self, text=''):
+        self.root = text if isinstance(text, (_Leaf, _Node)) else _build(text)
+        self._text = text if not isinstance(text, (_Leaf, _Node)) else None
+
+    def __len__(self):
+        return self.root.length if self.root is not None else 0
+
+    def __getitem__(self, index):
+        length = len(self)
+        if isinstance(index, slice):
+            start, end, step = index.indices(length)
+            if step != 1:
+                return self.text()[index]
+            return self.slice(start, end)
+        if index < 0: index += length
+        if not 0 <= index < length:
+            raise IndexError('rope index out of range')
+        return self.slice(index, index + 1)
+
+    def __str__(self):
+        return self.text()
+
+    def __repr__(self):
+        return 'Rope({0!r})'.format(self.text())
+
+    def slice(self, start, end):
+        if self._text is not None:
+            return self._text[start:end]
+        out = []
+        _collect(self.root, start, end, out)
+        return ''.join(out) if out else self.empty()
+
+    def empty(self):
+        node = self.root
+        while node is not None and node.height != 0:
+            node = node.left
+        return node.text[:0] if node is not None else ''
+
+    def text(self):
+        """Materializes the rope, the result is cached since ropes never change"""
+        if self._text is None:
+            out = []
+            _collect(self.root, 0, len(self), out)
+            self._text = ''.join(out) if out else self.empty()
+        return self._text
+
+    def insert(self, pos, text):
+        if not 0 <= pos <= len(self):
+            raise IndexError('Insert position {0} outside document of length {1}'.format(pos, len(self)))
+        return Rope(_insert(self.root, pos, text)) if text else self
+
+    def delete(self, pos, length):
+        if pos < 0 or pos + length > len(self):
+            raise IndexError('Delete of {0} at {1} outside document of length {2}'.format(length, pos, len(self)))
+        return Rope(_delete(self.root, pos, length) or _Leaf(self.empty())) if length else self
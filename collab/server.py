@@ -2,6 +2,9 @@ import threading
 from .session import CollabSession
 from .model import CollabModel
 from .connection import SocketServer
+from .shard import ModelProxy
+from .bus import BusModel, MAX_NODES
+from .presence import PresenceHub
 
 class CollabServer(object):
     def __init__(self, options=None):
@@ -9,21 +12,36 @@ class CollabServer(object):
             options = {}
 
         self.options = options
-        self.model = CollabModel(options)
         self.host = self.options.get('host', '127.0.0.1')
         self.port = self.options.get('port', 6633)
         self.next_user_id = 0
+        self.user_id_step = 1
 
-        self.server = SocketServer(self.host, self.port)
-        self.server.on('connection', lambda connection: CollabSession(connection, self.model, self.new_user_id()))
+        self.server = SocketServer(self.host, self.port, self.options.get('threaded', False), self.options.get('nodelay', True))
+        if self.options.get('node'):
+            self.model = BusModel(options, self.server.loop)
+            # Node n hands out n, n + MAX_NODES, ... so user ids stay unique across the cluster
+            self.next_user_id, self.user_id_step = self.options['node'] - MAX_NODES, MAX_NODES
+        elif self.options.get('workers', 0) > 1:
+            self.model = ModelProxy(options, self.options['workers'], self.server.loop)
+        else:
+            self.model = CollabModel(options, self.server.loop)
+        # Selections are relayed between the sessions of this server, once per presenceInterval seconds,
+        # and on a bus cluster through the broker to the sessions of the other nodes
+        relay = self.model.relay_presence if isinstance(self.model, BusModel) else None
+        self.presence = PresenceHub(self.server.loop, self.options.get('presenceInterval', 0.05), relay)
+        if relay is not None:
+            self.model.presence = self.presence
+        self.server.on('connection', lambda connection: CollabSession(connection, self.model, self.new_user_id(), self.options, self.presence))
 
     def run_forever(self):
         threading.Thread(target=self.server.run_forever).start()
 
     def new_user_id(self):
-        self.next_user_id += 1
+        self.next_user_id += self.user_id_step
         return self.next_user_id
 
     def close(self):
-        self.model.close()
+        # Sessions let go of their documents as their connections close, the model has to be there for that
         self.server.close()
+        self.model.close()
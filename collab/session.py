@@ -1,14 +1,30 @@
-import logging, sys
+import logging, sys, collections, os, binascii, hmac, hashlib
+from .connection import handshake_offer
+from .optransform import op_transform_regions, op_from_wire
 
 logger = logging.getLogger('Sublime Collaboration')
 
 class CollabSession(object):
-    def __init__(self, connection, model, userid):
+    def __init__(self, connection, model, userid, options=None, presence=None):
         self.connection = connection
         self.model = model
+        self.presence = presence
 
         self.docs = {}
         self.userid = userid
+        self.received = []
+
+        self.options = options if options else {}
+        self.options.setdefault('highWatermark', 1024*1024)
+        self.options.setdefault('lowWatermark', 256*1024)
+        self.options.setdefault('compressThreshold', 1024)
+        self.options.setdefault('maxFrameBytes', 64*1024*1024)
+        # Signs the tokens clients resume their user id with, shared by the sessions of a server. The default
+        # is new in every process, so tokens only survive a restart, or work on other nodes, when it is configured
+        self.options.setdefault('resumeSecret', binascii.hexlify(os.urandom(16)).decode('ascii'))
+
+        self.connection.compress_threshold = self.options['compressThreshold']
+        self.connection.max_frame_bytes = self.options['maxFrameBytes']
 
         if self.connection.ready():
             self.on_session_create()
@@ -16,17 +32,31 @@ class CollabSession(object):
             self.connection.on('ok', lambda: self.on_session_create)
         self.connection.on('close', self.on_session_close)
         self.connection.on('message', self.on_session_message)
+        self.connection.on('drain', self.on_session_drain)
+        self.connection.on('received', self.on_session_received)
 
     def on_session_create(self):
-        self.connection.send({'auth':self.userid})
+        message = handshake_offer()
+        message['auth'] = self.userid
+        # Only whoever got this token can take the user id over on a new connection
+        message['resume'] = self.resume_token(self.userid)
+        # Ops may be sent before earlier ones are acked, see Bridge in model.py
+        message['pipeline'] = True
+        self.connection.send(message)
 
     def on_session_close(self):
         for docname in self.docs:
             if 'listener' in self.docs[docname]:
                 self.model.remove_listener(docname, self.docs[docname]['listener'])
+                self.leave_presence(docname)
         self.docs = None
 
     def on_session_message(self, query, callback=None):
+        if 'protocol' in query:
+            if not self.connection.configure(query):
+                logger.warning("Unsupported protocol request {0} from {1}".format(query, self.userid))
+            return callback() if callback else None
+
         if 'docs' in query:
             return self.model.get_docs(lambda e, docs: self.on_get_docs(e, docs, callback))
 
@@ -39,64 +69,296 @@ class CollabSession(object):
             error = "'open' must be True, False or missing"
         if 'v' in query and (not isinstance(query['v'], (int, float)) or query['v'] < 0):
             error = "'v' invalid"
+        if 'resume' in query and not (isinstance(query['resume'], int) and isinstance(query.get('token'), (str, unicode) if sys.version_info[0] < 3 else str)):
+            error = "'resume' must be a user id with its 'token'"
+        if ('seq' in query or 'base' in query) and not all(isinstance(query.get(key), int) and query[key] > 0 for key in ('seq', 'base')):
+            error = "'seq' and 'base' must be positive integers"
+        if 'presence' in query and not (self.valid_regions(query['presence']) and 'v' in query):
+            error = "'presence' must be a list of [start, end] regions or None, at version 'v'"
 
         if error:
             logger.error("Invalid query {0} from {1}: {2}".format(query, self.userid, error))
             self.connection.abort()
             return callback() if callback else None
 
+        if 'resume' in query and not self.valid_resume_token(query['resume'], query['token']):
+            # Most likely signed before a restart with another resumeSecret, the client opens the document afresh
+            logger.info("Session {0} could not resume {1}, its token does not match".format(self.userid, query['resume']))
+            self.send({'doc':query['doc'], 'resumed':False, 'error':'Resume token rejected'})
+            return callback() if callback else None
+
         if query['doc'] not in self.docs:
-            self.docs[query['doc']] = {'queue': [], 'queuelock': False}
+            self.docs[query['doc']] = {'name': query['doc'], 'queue': collections.deque(), 'queuelock': False}
 
         doc = self.docs[query['doc']]
         doc['queue'].append((query, callback))
+        if self.connection.receiving:
+            # More frames from the same read may follow, process them together afterwards
+            if len(doc['queue']) == 1: self.received.append(doc)
+            return
         self.process_queue(doc)
 
+    def resume_token(self, userid):
+        return hmac.new(self.options['resumeSecret'].encode('utf-8'), str(userid).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def valid_resume_token(self, userid, token):
+        return hmac.compare_digest(self.resume_token(userid).encode('utf-8'), token.encode('utf-8'))
+
+    def sent_count(self, data):
+        """Ops of this user the document has, the op bus turns the keys of sources into strings"""
+        sources = data['sources']
+        return sources.get(self.userid, sources.get(str(self.userid), 0))
+
+    def valid_regions(self, regions):
+        if regions is None: return True
+        if not isinstance(regions, list): return False
+        for region in regions:
+            if not isinstance(region, list) or len(region) != 2 or not all(isinstance(point, int) and point >= 0 for point in region):
+                return False
+        return True
+
+    def on_session_received(self):
+        received, self.received = self.received, []
+        for doc in received:
+            self.process_queue(doc)
+
     def on_get_docs(self, error, docs, callback):
         self.send({"docs":docs} if not error else {"docs":None, "error":error})
         return callback() if callback else None
 
     def process_queue(self, doc):
-        if doc['queuelock'] or len(doc['queue']) == 0:
+        """Drains the document's queue, runs of ops go to the model as one batch"""
+        if doc['queuelock']:
             return
 
         doc['queuelock'] = True
-        query, callback = doc['queue'].pop(0)
-        self.handle_message(query, callback)
+        queue = doc['queue']
+        while queue and self.docs:
+            if not self.is_op(queue[0][0]):
+                query, callback = queue.popleft()
+                self.handle_message(query, callback)
+                continue
+
+            batch = []
+            while queue and self.is_op(queue[0][0]):
+                query, callback = queue.popleft()
+                request = self.op_request(doc, query, callback)
+                if request: batch.append(request)
+            if batch:
+                self.model.apply_ops(doc['name'], batch)
         doc['queuelock'] = False
 
-        self.process_queue(doc)
+    def is_op(self, query):
+        return 'op' in query and 'v' in query and 'open' not in query and 'resume' not in query and 'create' not in query and not ('snapshot' in query and query['snapshot'] is None)
 
     def handle_message(self, query, callback = None):
         if not self.docs:
             return callback() if callback else None
 
-        if 'open' in query and query['open'] == False:
+        if 'resume' in query and 'v' in query:
+            self.handle_resume(query, callback)
+
+        elif 'open' in query and query['open'] == False:
             if 'listener' not in self.docs[query['doc']]:
                 self.send({'doc':query['doc'], 'open':False, 'error':'Doc is not open'})
             else:
                 self.model.remove_listener(query['doc'], self.docs[query['doc']]['listener'])
                 del self.docs[query['doc']]['listener']
+                self.leave_presence(query['doc'])
                 self.send({'doc':query['doc'], 'open':False})
             return callback() if callback else None
 
         elif 'open' in query or ('snapshot' in query and query['snapshot'] is None) or 'create' in query:
             self.handle_opencreatesnapshot(query, callback)
 
+        elif 'presence' in query:
+            self.handle_presence(query, callback)
+
         elif 'op' in query and 'v' in query:
-            def apply_op(error, appliedVersion):
-                self.send({'doc':query['doc'], 'v':None, 'error':error} if error else {'doc':query['doc'], 'v':appliedVersion})
-                return callback() if callback else None
-            self.model.apply_op(query['doc'], {'doc':query['doc'], 'v':query['v'], 'op':query['op'], 'source':self.userid}, apply_op)
+            request = self.op_request(self.docs[query['doc']], query, callback)
+            if request: self.model.apply_op(query['doc'], *request)
 
         else:
             logger.error("Invalid query {0} from {1}".format(query, self.userid))
             self.connection.abort()
             return callback() if callback else None
 
-    def on_remote_message(self, message, snapshot, oldsnapshot):
-        if message['source'] is self.userid: return
-        self.send(message)
+    def op_request(self, doc, query, callback=None):
+        """Turns an op query into the (op, callback) pair the model applies, None if it is answered already"""
+        if query['v'] < doc.get('resynced', 0):
+            self.send({'doc':query['doc'], 'stale':True})
+            return callback() if callback else None
+
+        def apply_op(error, appliedVersion):
+            if 'lagging' in doc:
+                # Answers wait for the resync, an error must not overtake the acks held back before it
+                if error:
+                    doc['errors'].append((doc['withheld'], error))
+                else:
+                    doc['withheld'] += 1
+            else:
+                self.send({'doc':query['doc'], 'v':None, 'error':error} if error else {'doc':query['doc'], 'v':appliedVersion})
+            return callback() if callback else None
+        op = {'doc':query['doc'], 'v':query['v'], 'op':query['op'], 'source':self.userid}
+        if 'seq' in query:
+            op['seq'] = query['seq']
+            op['base'] = query['base']
+        return (op, apply_op)
+
+    def on_remote_message(self, message, snapshot, oldsnapshot, broadcast=None):
+        doc = self.docs.get(message['doc']) if self.docs else None
+        if doc is None: return
+        if doc.get('presence') is not None:
+            self.transform_presence(doc['presence'], message)
+
+        if message['source'] == self.userid: return
+        if 'lagging' in doc: return
+
+        if self.connection.protocol >= 2 and self.connection.outbound_bytes > self.options['highWatermark']:
+            logger.info("Session {0} fell behind on {1} at version {2}".format(self.userid, message['doc'], message['v']))
+            doc['lagging'] = message['v']
+            doc['withheld'] = 0
+            doc['errors'] = []
+            self.connection.wait_for_drain(self.options['lowWatermark'])
+            return
+
+        if broadcast is not None:
+            self.connection.send_broadcast(broadcast)
+        else:
+            self.send(message)
+
+    def handle_presence(self, query, callback=None):
+        """Takes the user's selection at version query['v'] and brings it up to date before the hub relays it"""
+        docname = query['doc']
+        doc = self.docs[docname]
+        if self.presence is None or 'listener' not in doc:
+            return callback() if callback else None
+
+        if query['presence'] is None:
+            doc['presence'] = None
+            self.presence.update(docname, self.userid)
+            return callback() if callback else None
+
+        state = doc['presence'] = {'v': query['v'], 'regions': [tuple(region) for region in query['presence']]}
+
+        def model_get_ops(error, ops):
+            if doc.get('presence') is not state: return
+            if error:
+                doc['presence'] = None
+                return
+            for op in ops:
+                self.transform_presence(state, op)
+            self.presence.update(docname, self.userid)
+
+        self.model.get_ops(docname, query['v'], model_get_ops)
+        return callback() if callback else None
+
+    def transform_presence(self, state, op):
+        """Moves the selection through op, ops it has seen already are skipped"""
+        if op['v'] != state['v']: return
+        # Text the user types at their own cursor goes before it
+        state['regions'] = op_transform_regions(state['regions'], op_from_wire(op['op']), op.get('source') == self.userid)
+        state['v'] += 1
+
+    def presence_entry(self, docname):
+        doc = self.docs.get(docname) if self.docs else None
+        state = doc.get('presence') if doc else None
+        if state is None:
+            return [self.userid, None, None]
+        return [self.userid, state['v'], [list(region) for region in state['regions']]]
+
+    def send_presence(self, docname, broadcast):
+        doc = self.docs.get(docname) if self.docs else None
+        if doc is None or 'listener' not in doc or 'lagging' in doc: return
+        self.connection.send_broadcast(broadcast)
+
+    def join_presence(self, docname):
+        if self.presence is not None:
+            self.presence.join(docname, self.userid, self)
+
+    def leave_presence(self, docname):
+        if self.presence is not None:
+            self.presence.leave(docname, self.userid, self)
+
+    def on_session_drain(self):
+        if not self.docs: return
+        for docname in list(self.docs):
+            if 'lagging' in self.docs[docname]:
+                self.resync(docname)
+
+    def resync(self, docname):
+        doc = self.docs[docname]
+        since = doc.pop('lagging')
+        withheld = doc.pop('withheld')
+        errors = doc.pop('errors')
+
+        def model_get_data(error, data):
+            if error:
+                logger.error("Could not resync {0} for {1}: {2}".format(docname, self.userid, error))
+                return self.connection.abort()
+            doc['resynced'] = data['v']
+            # The client sends the failed ops again along with the rest it has not seen acked
+            self.send({'doc':docname, 'resync':True, 'snapshot':data['snapshot'], 'v':data['v'], 'acked':withheld})
+
+        def model_get_ops(error, ops):
+            if error:
+                return self.model.get_data(docname, model_get_data)
+            self.replay(docname, ops, errors)
+
+        self.model.get_ops(docname, since, model_get_ops)
+
+    def replay(self, docname, ops, errors=()):
+        """Sends ops the client missed, acking its own. Ops composed from several of its ops are acked once for each.
+
+        errors holds (acks before it, error) for each of its ops that failed meanwhile, sent in its place among the acks"""
+        errors = collections.deque(errors)
+        acked = 0
+        for op in ops:
+            if op['source'] == self.userid:
+                for _ in range(op.get('count', 1)):
+                    while errors and errors[0][0] <= acked:
+                        self.send({'doc':docname, 'v':None, 'error':errors.popleft()[1]})
+                    self.send({'doc':docname, 'v':op['v']})
+                    acked += 1
+            else:
+                self.send(op)
+        for count, error in errors:
+            self.send({'doc':docname, 'v':None, 'error':error})
+
+    def handle_resume(self, query, callback = None):
+        """Reattaches a reconnecting client to a document, replaying what it missed since query['v']"""
+        docname = query['doc']
+        doc = self.docs[docname]
+        if self.userid != query['resume']:
+            logger.info("Session {0} resumes as {1}".format(self.userid, query['resume']))
+            self.userid = query['resume']
+
+        if 'listener' in doc:
+            self.send({'doc':docname, 'open':False, 'error':'Doc is already open'})
+            return callback() if callback else None
+        doc['listener'] = self.on_remote_message
+
+        def model_listen(error, data):
+            if error:
+                del doc['listener']
+                self.send({'doc':docname, 'open':False, 'error':error})
+                return callback() if callback else None
+            if 'ops' in data:
+                self.replay(docname, data['ops'])
+                message = {'doc':docname, 'open':True, 'resumed':True, 'v':data['v']}
+            else:
+                doc['resynced'] = data['v']
+                # The client counts acks from the number of its ops the document had when it opened it
+                acked = self.sent_count(data) - query.get('acked', 0)
+                message = {'doc':docname, 'resync':True, 'snapshot':data['snapshot'], 'v':data['v'], 'acked':acked}
+            docid = self.connection.codec.assign(docname)
+            if docid is not None: message['docid'] = docid
+            self.send(message)
+            self.join_presence(docname)
+            return callback() if callback else None
+
+        # The ops we replay and the ones the listener gets after them come from the same step
+        self.model.listen_data(docname, doc['listener'], query['v'], model_listen)
 
     def send(self, msg):
         self.connection.send(msg)
@@ -131,6 +393,9 @@ class CollabSession(object):
         def step2Snapshot(message):
             if 'snapshot' not in query or message['create']:
                 return step3Open(message)
+            if 'open' in query and 'listener' not in self.docs[query['doc']]:
+                # Read along with adding the listener, ops in between would reach neither
+                return step3Open(message)
 
             def model_get_data(error, data):
                 if error:
@@ -153,15 +418,27 @@ class CollabSession(object):
                 return finished(message)
 
             doc['listener'] = self.on_remote_message
+            # A document we just created is still at version 0, ops since then are replayed
+            since = 0 if message.get('create') else None
 
-            def model_listen(error, v):
+            def model_listen(error, data):
                 if error:
                     del doc['listener']
                     message['open'] = False
                     message['error'] = error
+                    return finished(message)
                 message['open'] = True
-                if 'v' not in message: message['v'] = v
-                return finished(message)
-            self.model.listen(query['doc'], doc['listener'], model_listen)
+                message['acked'] = self.sent_count(data)
+                if 'snapshot' in data:
+                    if 'snapshot' in query: message['snapshot'] = data['snapshot']
+                    message['v'] = data['v']
+                else:
+                    message['v'] = since
+                docid = self.connection.codec.assign(query['doc'])
+                if docid is not None: message['docid'] = docid
+                finished(message)
+                if 'ops' in data: self.replay(query['doc'], data['ops'])
+                return self.join_presence(query['doc'])
+            self.model.listen_data(query['doc'], doc['listener'], since, model_listen)
 
         step1Create({'doc':query['doc']})
\ No newline at end of file
@@ -0,0 +1,273 @@
+import logging, threading, multiprocessing, zlib, itertools
+
+from .model import CollabModel
+from .connection import Broadcast, EventLoop
+
+logger = logging.getLogger('Sublime Collaboration')
+
+def shard_for(docname, count):
+    """Stable across processes, unlike hash() which is salted per interpreter"""
+    return zlib.crc32(docname.encode('utf-8')) % count
+
+class ModelService(object):
+    """Serves proxied model calls against a local CollabModel, for shard workers and bus nodes.
+
+    send gets ('result', requestid, result) for every call made with a request
+    id, and ('op', docname, op) for every op on a document that is listened to."""
+    # The calls ModelProxy and BusModel make, no other method of the model can be reached through a service
+    METHODS = frozenset(['create', 'delete', 'get_docs', 'get_version', 'get_snapshot', 'get_ops', 'get_data', 'listen', 'listen_data', 'remove_listener', 'apply_ops'])
+
+    def __init__(self, model, send):
+        self.model = model
+        self.send = send
+        self.listeners = {}
+
+    def forward(self, docname):
+        def listener(op, snapshot, oldsnapshot, broadcast=None):
+            self.send(('op', docname, op))
+        return listener
+
+    def reply(self, requestid):
+        return lambda *result: self.send(('result', requestid, result))
+
+    def handle(self, method, requestid, args):
+        if method not in self.METHODS:
+            logger.error("Refusing proxied call {0}".format(method))
+            if requestid is not None:
+                self.send(('result', requestid, ('Unknown call {0}'.format(method), None)))
+            return
+        try:
+            if method in ('listen', 'listen_data'):
+                docname = args[0]
+                if docname in self.listeners:
+                    # Ops are already forwarded, answering in the same step keeps the two in line
+                    self.listeners[docname][1] += 1
+                    if method == 'listen':
+                        self.model.get_version(docname, self.reply(requestid))
+                    else:
+                        self.model.load(docname, lambda error, doc: self.send(('result', requestid, (error, None if error else self.model.data(doc, args[1])))))
+                else:
+                    listener = self.forward(docname)
+                    def listen(error, result):
+                        if not error: self.listeners[docname] = [listener, 1]
+                        self.send(('result', requestid, (error, result)))
+                    if method == 'listen':
+                        self.model.listen(docname, listener, listen)
+                    else:
+                        self.model.listen_data(docname, listener, args[1], listen)
+            elif method == 'remove_listener':
+                docname = args[0]
+                if docname in self.listeners:
+                    self.listeners[docname][1] -= 1
+                    if not self.listeners[docname][1]:
+                        self.model.remove_listener(docname, self.listeners.pop(docname)[0])
+            elif method == 'apply_ops':
+                docname, ops = args
+                results = [None] * len(ops)
+                pending = [len(ops)]
+                def applied(index, error, version):
+                    results[index] = (error, version)
+                    pending[0] -= 1
+                    if not pending[0]: self.send(('result', requestid, (results,)))
+                self.model.apply_ops(docname, [(op, lambda error, version, index=index: applied(index, error, version)) for index, op in enumerate(ops)])
+            else:
+                getattr(self.model, method)(*(tuple(args) + (self.reply(requestid),)))
+        except Exception as e:
+            logger.exception('Proxied call {0} failed'.format(method))
+            if requestid is not None:
+                self.send(('result', requestid, (str(e), None)))
+
+def run_worker(pipe, options):
+    """Entry point of a worker process, owns a CollabModel and serves calls from the ModelProxy.
+
+    Calls run on an event loop fed by a reader thread, so storage can hand
+    back its acks and reads the same way it does in the server process."""
+    loop = EventLoop()
+    model = CollabModel(options, loop)
+    service = ModelService(model, pipe.send)
+
+    def close(requestid):
+        model.close()
+        try:
+            pipe.send(('result', requestid, ()))
+        except (OSError, IOError):
+            pass
+        loop.stop()
+
+    def read_pipe():
+        while True:
+            try:
+                method, requestid, args = pipe.recv()
+            except (EOFError, OSError):
+                method, requestid = 'close', None
+            if method == 'close':
+                return loop.call_soon(close, requestid)
+            loop.call_soon(service.handle, method, requestid, args)
+
+    reader = threading.Thread(target=read_pipe)
+    reader.daemon = True
+    reader.start()
+    loop.run_forever()
+
+class ModelProxy(object):
+    """Stands in for CollabModel in the server process and routes each document to the worker process owning it.
+
+    Every worker has its own pipe and a reader thread. Results and broadcasts
+    are handed to the server's event loop, so sessions see the same single
+    threaded callbacks as with a local model. Listeners get the op but no
+    snapshots, those stay in the worker."""
+    def __init__(self, options=None, workers=2, loop=None):
+        self.options = options if options else {}
+        self.loop = loop
+        self.workers = []
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.listeners = {}
+        self.cancelled = []
+        self.requestids = itertools.count(1)
+        self.stats = {'broadcasts': 0, 'frames_encoded': 0, 'encodes_saved': 0}
+
+        worker_options = dict((key, value) for key, value in self.options.items() if key != 'storage')
+        for index in range(workers):
+            parent, child = multiprocessing.Pipe()
+            options = dict(worker_options)
+            if options.get('storagePath'):
+                options['storagePath'] = '{0}.{1}'.format(options['storagePath'], index)
+            process = multiprocessing.Process(target=run_worker, args=(child, options))
+            process.daemon = True
+            process.start()
+            child.close()
+            reader = threading.Thread(target=self.read_worker, args=(parent,))
+            reader.daemon = True
+            reader.start()
+            self.workers.append((process, parent, threading.Lock()))
+
+    def dispatch(self, callback, *args):
+        if self.loop is not None:
+            self.loop.call_soon(callback, *args)
+        else:
+            callback(*args)
+
+    def read_worker(self, pipe):
+        while True:
+            try:
+                message = pipe.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'result':
+                with self.lock:
+                    callback = self.callbacks.pop(message[1], None)
+                if callback:
+                    self.dispatch(callback, *message[2])
+            elif message[0] == 'op':
+                self.dispatch(self.on_worker_op, message[1], message[2])
+
+    def call(self, docname, method, args, callback=None):
+        if not self.workers:
+            # Closed, the workers are gone along with the documents
+            return
+        requestid = None
+        if callback is not None:
+            requestid = next(self.requestids)
+            with self.lock:
+                self.callbacks[requestid] = callback
+        process, pipe, lock = self.workers[shard_for(docname, len(self.workers))]
+        with lock:
+            pipe.send((method, requestid, args))
+
+    def on_worker_op(self, docname, op):
+        listeners = self.listeners.get(docname)
+        if not listeners: return
+        broadcast = Broadcast(op)
+        for listener in list(listeners):
+            listener(op, None, None, broadcast)
+        self.stats['broadcasts'] += 1
+        self.stats['frames_encoded'] += broadcast.encoded
+        self.stats['encodes_saved'] += broadcast.shared
+
+    def get_docs(self, callback):
+        docs = []
+        pending = [len(self.workers)]
+        def worker_docs(error, names):
+            if pending[0] is None: return
+            if error:
+                pending[0] = None
+                return callback(error, None)
+            docs.extend(names)
+            pending[0] -= 1
+            if not pending[0]: callback(None, sorted(docs))
+        for index, (process, pipe, lock) in enumerate(self.workers):
+            requestid = next(self.requestids)
+            with self.lock:
+                self.callbacks[requestid] = worker_docs
+            with lock:
+                pipe.send(('get_docs', requestid, ()))
+
+    def create(self, docname, snapshot=None, callback=None):
+        self.call(docname, 'create', (docname, snapshot), callback)
+
+    def delete(self, docname, callback=None):
+        self.call(docname, 'delete', (docname,), callback)
+
+    def listen(self, docname, listener, callback=None):
+        self.register(docname, listener, 'listen', (docname,), callback)
+
+    def listen_data(self, docname, listener, since, callback):
+        self.register(docname, listener, 'listen_data', (docname, since), callback)
+
+    def register(self, docname, listener, method, args, callback):
+        """The worker sends its answer down the pipe ahead of any op after it, so the listener misses none"""
+        def listen(error, result):
+            if error:
+                return callback(error, None) if callback else None
+            if (docname, listener) in self.cancelled:
+                # Removed again before the worker answered
+                self.cancelled.remove((docname, listener))
+                return self.call(docname, 'remove_listener', (docname,))
+            self.listeners.setdefault(docname, []).append(listener)
+            return callback(None, result) if callback else None
+        self.call(docname, method, args, listen)
+
+    def remove_listener(self, docname, listener):
+        if listener not in self.listeners.get(docname, []):
+            self.cancelled.append((docname, listener))
+            return
+        self.listeners[docname].remove(listener)
+        if not self.listeners[docname]: del self.listeners[docname]
+        self.call(docname, 'remove_listener', (docname,))
+
+    def get_version(self, docname, callback):
+        self.call(docname, 'get_version', (docname,), callback)
+
+    def get_snapshot(self, docname, callback):
+        self.call(docname, 'get_snapshot', (docname,), callback)
+
+    def get_ops(self, docname, start, callback):
+        self.call(docname, 'get_ops', (docname, start), callback)
+
+    def get_data(self, docname, callback):
+        self.call(docname, 'get_data', (docname,), callback)
+
+    def apply_op(self, docname, op, callback):
+        self.apply_ops(docname, [(op, callback)])
+
+    def apply_ops(self, docname, batch):
+        def applied(results):
+            for (op, callback), (error, version) in zip(batch, results):
+                callback(error, version)
+        self.call(docname, 'apply_ops', (docname, [op for op, callback in batch]), applied)
+
+    def flush(self, callback=None):
+        return callback() if callback else None
+
+    def close(self):
+        for process, pipe, lock in self.workers:
+            try:
+                with lock:
+                    pipe.send(('close', None, ()))
+            except (OSError, IOError):
+                pass
+        for process, pipe, lock in self.workers:
+            process.join(5)
+            pipe.close()
+        self.workers = []
@@ -0,0 +1,362 @@
+import os, json, threading, logging, errno, sys, collections, functools
+from .optransform import op_to_wire
+
+logger = logging.getLogger('Sublime Collaboration')
+
+# Each document is stored as a snapshot file plus one or more op log segments:
+#   <doc>.snapshot      JSON {"v", "snapshot", "sources"} written atomically
+#   <doc>.<v>.log       one JSON op per line, starting at version v
+# A new segment is started when a snapshot is taken opsBeforeCommit ops or more
+# into the current one, so recovery loads the snapshot and replays the ops after
+# it from the last segments. Appends go straight to the kernel with os.write,
+# and a committer thread fsyncs the dirty logs. Given an event loop, an op is
+# acked once the committer has synced its log, all ops written during one fsync
+# share the next, the first snapshot of a new document is written by the
+# committer too, and reads happen on a reader thread with their results handed
+# back through the loop. Without one, every op is synced before it is acked.
+
+SNAPSHOT_SUFFIX = '.snapshot'
+LOG_SUFFIX = '.log'
+
+_replace = getattr(os, 'replace', os.rename)
+
+def _encode_line(data):
+    line = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    if not isinstance(line, bytes):
+        line = line.encode('utf-8')
+    return line + b'\n'
+
+class FileStorage(object):
+    """Durable document storage backed by snapshot files and append-only op logs"""
+    def __init__(self, path, options=None, loop=None):
+        self.path = path
+        self.loop = loop
+        self.options = options if options else {}
+        # Longest the committer sleeps between snapshot writes, ops wake it right away
+        self.options.setdefault('commitInterval', 0.2)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.lock = threading.Lock()
+        # flush commits on the caller's thread, this keeps it from racing the committer
+        self.committing = threading.Lock()
+        self.logs = {}
+        self.retired = []
+        self.dirty = set()
+        # Callbacks of ops written since the last commit, called once it has synced them
+        self.acks = []
+        # (docname, callback) of documents created since the last commit, called once their snapshot is written
+        self.creates = []
+        self.snapshots = {}
+        self.segments = {}
+        self.closed = False
+
+        for filename in os.listdir(path):
+            if filename.endswith(SNAPSHOT_SUFFIX):
+                self.segments.setdefault(filename[:-len(SNAPSHOT_SUFFIX)], [])
+        for filename in os.listdir(path):
+            if filename.endswith(LOG_SUFFIX):
+                docname, start = filename[:-len(LOG_SUFFIX)].rsplit('.', 1)
+                if docname in self.segments:
+                    self.segments[docname].append(int(start))
+        for docname in self.segments:
+            self.segments[docname].sort()
+
+        self.wakeup = threading.Event()
+        self.committer = threading.Thread(target=self.run_committer)
+        self.committer.daemon = True
+        self.committer.start()
+
+        self.reads = collections.deque()
+        self.reading = threading.Event()
+        if loop is not None:
+            self.reader = threading.Thread(target=self.run_reader)
+            self.reader.daemon = True
+            self.reader.start()
+
+    def snapshot_path(self, docname):
+        return os.path.join(self.path, docname + SNAPSHOT_SUFFIX)
+
+    def log_path(self, docname, start):
+        return os.path.join(self.path, '{0}.{1}{2}'.format(docname, start, LOG_SUFFIX))
+
+    def exists(self, docname):
+        return docname in self.segments
+
+    def get_docs(self, callback):
+        callback(None, list(self.segments))
+
+    def create(self, docname, data, callback=None):
+        if self.exists(docname):
+            return callback('Document already exists') if callback else None
+        data = {'v':data['v'], 'snapshot':data['snapshot'], 'sources':dict(data.get('sources', {}))}
+        if self.loop is not None:
+            # The committer writes the snapshot, reads find it queued until then
+            with self.lock:
+                self.segments[docname] = []
+                self.snapshots[docname] = data
+                if callback: self.creates.append((docname, callback))
+            self.start_segment(docname, data['v'])
+            self.wakeup.set()
+            return
+        try:
+            self.write_snapshot_file(docname, data)
+        except (IOError, OSError) as e:
+            return callback(str(e)) if callback else None
+        with self.lock:
+            self.segments[docname] = []
+        self.start_segment(docname, data['v'])
+        return callback(None) if callback else None
+
+    def delete(self, docname, callback=None):
+        if not self.exists(docname):
+            return callback('Document does not exist') if callback else None
+        with self.lock:
+            fd = self.logs.pop(docname, None)
+            self.dirty.discard(docname)
+            self.snapshots.pop(docname, None)
+            segments = self.segments.pop(docname)
+        if fd is not None:
+            os.close(fd)
+        for start in segments:
+            self.remove(self.log_path(docname, start))
+        self.remove(self.snapshot_path(docname))
+        return callback(None) if callback else None
+
+    def read(self, read, args, callback):
+        """Runs read on the reader thread and calls back on the event loop, or does it all right away without a loop"""
+        if self.loop is None:
+            return read(*(args + (callback,)))
+        self.reads.append((read, args, callback))
+        self.reading.set()
+
+    def run_reader(self):
+        while not self.closed:
+            self.reading.wait()
+            self.reading.clear()
+            while self.reads and not self.closed:
+                read, args, callback = self.reads.popleft()
+                try:
+                    read(*(args + (functools.partial(self.loop.call_soon, callback),)))
+                except Exception as e:
+                    logger.exception("Storage read failed")
+                    self.loop.call_soon(callback, str(e), None)
+
+    def get_snapshot(self, docname, callback):
+        self.read(self.read_snapshot, (docname,), callback)
+
+    def read_snapshot(self, docname, callback):
+        if not self.exists(docname):
+            return callback('Document does not exist', None)
+        with self.lock:
+            pending = self.snapshots.get(docname)
+        if pending is not None:
+            # Not on disk yet, but newer than the file
+            return callback(None, dict(pending, sources=dict(pending['sources'])))
+        try:
+            with open(self.snapshot_path(docname), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError) as e:
+            logger.error("Could not read snapshot of {0}: {1}".format(docname, e))
+            return callback('Could not read snapshot', None)
+        data['sources'] = dict((source, count) for source, count in data.get('sources', []))
+        callback(None, data)
+
+    def get_ops(self, docname, start, callback):
+        """Reads every logged op from version start onwards"""
+        self.read(self.read_ops, (docname, start), callback)
+
+    def read_ops(self, docname, start, callback):
+        with self.lock:
+            segments = list(self.segments.get(docname, ()))
+        if not self.exists(docname):
+            return callback('Document does not exist', None)
+        ops = []
+        for segment in segments:
+            path = self.log_path(docname, segment)
+            try:
+                with open(path, 'rb') as f:
+                    good = 0
+                    for line in f:
+                        try:
+                            op = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            break
+                        good += len(line)
+                        if op['v'] >= start:
+                            ops.append(op)
+                    if good < os.path.getsize(path) and docname not in self.logs:
+                        logger.warning("Discarding torn write at the end of {0}".format(path))
+                        f.close()
+                        with open(path, 'r+b') as t:
+                            t.truncate(good)
+            except (IOError, OSError) as e:
+                logger.error("Could not read op log {0}: {1}".format(path, e))
+                return callback('Could not read op log', None)
+        callback(None, ops)
+
+    def write_op(self, docname, op, callback=None):
+        """Appends op to the document's log and calls back once it is durable"""
+        data = {'v':op['v'], 'op':op_to_wire(op['op']), 'source':op.get('source')}
+        if op.get('count', 1) > 1:
+            data['count'] = op['count']
+        line = _encode_line(data)
+        if docname not in self.logs:
+            if not self.exists(docname):
+                return callback('Document does not exist') if callback else None
+            segments = self.segments[docname]
+            self.start_segment(docname, segments[-1] if segments else op['v'])
+        with self.lock:
+            fd = self.logs[docname]
+            try:
+                os.write(fd, line)
+            except OSError as e:
+                return callback(str(e)) if callback else None
+            self.dirty.add(docname)
+            if self.loop is not None:
+                if callback: self.acks.append(callback)
+                self.wakeup.set()
+                return
+            fd = os.dup(fd)
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            return callback(str(e)) if callback else None
+        finally:
+            os.close(fd)
+        return callback(None) if callback else None
+
+    def write_snapshot(self, docname, data, callback=None):
+        """Writes the snapshot in the background, starting a new log segment at data['v'] if the current one is long enough"""
+        if not self.exists(docname):
+            return callback('Document does not exist') if callback else None
+        with self.lock:
+            self.snapshots[docname] = {'v':data['v'], 'snapshot':data['snapshot'], 'sources':dict(data.get('sources', {}))}
+            segments = self.segments[docname]
+            # Snapshots taken to unload a document may come a few ops apart, a segment for each would only pile up files
+            new_segment = not segments or data['v'] - segments[-1] >= self.options.get('opsBeforeCommit', 20)
+        if new_segment:
+            self.start_segment(docname, data['v'])
+        self.wakeup.set()
+        return callback(None) if callback else None
+
+    def start_segment(self, docname, start):
+        fd = os.open(self.log_path(docname, start), os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        with self.lock:
+            old = self.logs.get(docname)
+            self.logs[docname] = fd
+            if start not in self.segments[docname]:
+                self.segments[docname].append(start)
+            if old is not None:
+                self.retired.append(old)
+
+    def write_snapshot_file(self, docname, data):
+        snapshot = data['snapshot']
+        if hasattr(snapshot, 'text'):
+            # Ropes are immutable, so building the string here off the loop thread is safe
+            snapshot = snapshot.text()
+        data = dict(data, snapshot=snapshot, sources=list(data.get('sources', {}).items()))
+        path = self.snapshot_path(docname)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_encode_line(data))
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(path + '.tmp', path)
+        self.sync_directory()
+
+    def sync_directory(self):
+        if sys.platform == 'win32': return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT: raise
+
+    def commit(self):
+        """Fsyncs every log written since the last commit and writes queued snapshots"""
+        with self.committing:
+            self.commit_locked()
+
+    def commit_locked(self):
+        with self.lock:
+            fds = [os.dup(self.logs[docname]) for docname in self.dirty if docname in self.logs]
+            fds.extend(self.retired)
+            self.retired = []
+            self.dirty = set()
+            snapshots, self.snapshots = self.snapshots, {}
+            acks, self.acks = self.acks, []
+            creates, self.creates = self.creates, []
+
+        # Retired segments are fsynced here too, before any snapshot that replaces them is written
+        error = None
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                error = e
+            finally:
+                os.close(fd)
+        for callback in acks:
+            self.loop.call_soon(callback, str(error) if error else None)
+
+        failed = {}
+        for docname, data in snapshots.items():
+            try:
+                self.write_snapshot_file(docname, data)
+            except (IOError, OSError) as e:
+                logger.error("Could not write snapshot of {0}: {1}".format(docname, e))
+                failed[docname] = str(e)
+                continue
+            self.compact(docname, data['v'])
+
+        for docname, callback in creates:
+            if docname in failed:
+                self.delete(docname)
+            self.loop.call_soon(callback, failed.get(docname))
+        if error is not None:
+            raise error
+
+    def compact(self, docname, version):
+        """Drops log segments the snapshot covers, keeping numCachedOps ops of history for resuming clients"""
+        horizon = version - self.options.get('numCachedOps', 0)
+        with self.lock:
+            segments = self.segments.get(docname, [])
+            obsolete = [start for start, following in zip(segments, segments[1:]) if following <= horizon]
+            for start in obsolete:
+                segments.remove(start)
+        for start in obsolete:
+            self.remove(self.log_path(docname, start))
+
+    def run_committer(self):
+        while not self.closed:
+            self.wakeup.wait(self.options['commitInterval'])
+            self.wakeup.clear()
+            try:
+                self.commit()
+            except Exception:
+                logger.exception("Op log commit failed")
+
+    def flush(self, callback=None):
+        self.commit()
+        return callback(None) if callback else None
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.wakeup.set()
+        self.committer.join()
+        if self.loop is not None:
+            self.reading.set()
+            self.reader.join()
+        self.commit()
+        with self.lock:
+            for fd in self.logs.values():
+                os.close(fd)
+            self.logs = {}
@@ -16,9 +16,11 @@ logger.addHandler(loggerhandler)
 try:
     from .collab.client import CollabClient
     from .collab.server import CollabServer
+    from .collab.optransform import op_apply
 except (ImportError, ValueError):
     from collab.client import CollabClient
     from collab.server import CollabServer
+    from collab.optransform import op_apply
 
 class SublimeListener(sublime_plugin.EventListener):
     _events = {}
@@ -79,12 +81,17 @@ class SublimeEditor(object):
         self._events = {}
         self.state = "ok"
         self.in_remoteop = False
+        self.presence_keys = set()
+        # The text the view was last in sync with, so edits are diffed without building the document's rope into a string
+        self.text = None
 
         SublimeListener.on("modified", self._on_view_modified)
         SublimeListener.on("close", self._on_view_close)
         SublimeListener.on("post_save", self._on_view_post_save)
+        SublimeListener.on("selection_modified", self._on_view_selection_modified)
         self.doc.on("closed", self.close)
         self.doc.on("remoteop", self._on_doc_remoteop)
+        self.doc.on("presence", self._on_doc_presence)
 
         sublime.set_timeout(lambda: self._initialize(self.doc.get_text()), 0)
 
@@ -117,17 +124,29 @@ class SublimeEditor(object):
             SublimeListener.removeListener("modified", self._on_view_modified)
             SublimeListener.removeListener("close", self._on_view_close)
             SublimeListener.removeListener("post_save", self._on_view_post_save)
+            SublimeListener.removeListener("selection_modified", self._on_view_selection_modified)
             self.doc.removeListener("closed", self.close)
             self.doc.removeListener("remoteop", self._on_doc_remoteop)
+            self.doc.removeListener("presence", self._on_doc_presence)
+            for key in self.presence_keys:
+                self.view.erase_regions(key)
             self.view = None
             self.doc = None
             self.emit("closed")
 
     def _on_view_modified(self, view):
+        if self.in_remoteop: return
+        if self.view == None: return
+        if view.id() == self.view.id() and self.doc and self.text is not None:
+            text = self._get_text()
+            self._apply_change(self.doc, self.text, text)
+            self.text = text
+
+    def _on_view_selection_modified(self, view):
         if self.in_remoteop: return
         if self.view == None: return
         if view.id() == self.view.id() and self.doc:
-            self._apply_change(self.doc, self.doc.get_text(), self._get_text())
+            self.doc.set_selection([(region.a, region.b) for region in view.sel()])
 
     def _on_view_post_save(self, view):
         if self.view == None: return
@@ -159,20 +178,36 @@ class SublimeEditor(object):
     def _on_doc_remoteop(self, op, old_snapshot):
         sublime.set_timeout(lambda: self._apply_remoteop(op), 0)
 
+    def _on_doc_presence(self, userid, regions):
+        sublime.set_timeout(lambda: self._draw_presence(userid, regions), 0)
+
+    def _draw_presence(self, userid, regions):
+        if self.view == None: return
+        key = 'collab_presence_{0}'.format(userid)
+        if regions is None:
+            self.view.erase_regions(key)
+            self.presence_keys.discard(key)
+        else:
+            # Sublime moves the regions along with later edits by itself
+            self.view.add_regions(key, [sublime.Region(a, b) for a, b in regions], 'comment', '', sublime.DRAW_EMPTY | sublime.DRAW_OUTLINED)
+            self.presence_keys.add(key)
+
     def _get_text(self):
         return self.view.substr(sublime.Region(0, self.view.size())).replace('\r\n', '\n')
 
     def _initialize(self, text):
+        self.text = text
         if self._get_text() == text: return
         self.view.run_command('collab_begin_edit', {'func': 'replace', 'region_start': 0, 'region_end': self.view.size(), 'string': text})
 
     def _apply_remoteop(self, op):
+        self.text = op_apply(self.text, op, False)
         self.in_remoteop = True
         for component in op:
-            if 'i' in component:
-                self.view.run_command('collab_begin_edit', {'func': 'insert', 'point': component['p'], 'string': component['i']})
+            if component.i is not None:
+                self.view.run_command('collab_begin_edit', {'func': 'insert', 'point': component.p, 'string': component.i})
             else:
-                self.view.run_command('collab_begin_edit', {'func': 'erase', 'region_start': component['p'], 'region_end': component['p']+len(component['d'])})
+                self.view.run_command('collab_begin_edit', {'func': 'erase', 'region_start': component.p, 'region_end': component.p+len(component.d)})
         self.in_remoteop = False
 
 
@@ -185,7 +220,8 @@ class SublimeCollaboration(object):
     def connect(self, host):
         global client
         if client: self.disconnect()
-        client = CollabClient(host, 6633)
+        # Keystrokes typed within a fraction of the round trip go out as one op
+        client = CollabClient(host, 6633, flush_policy='adaptive')
         client.on('error', lambda error: sublime.error_message("Client error: {0}".format(error)))
         client.on('closed', self.on_close)
         self.set_status()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compares the JSON and compact wire codecs on typical op and ack messages.
+
+Decode times include op_from_wire, which every op goes through before it is
+used, so they compare what a receiver pays per message."""
+import sys, os, timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collab.connection import JsonCodec, CompactCodec
+from collab.optransform import op_from_wire, op_to_wire
+
+MESSAGES = [
+    ('keystroke', {'doc':'src.main.py', 'op':[{'p':18234, 'i':'a'}], 'v':4021}),
+    ('remote keystroke', {'doc':'src.main.py', 'op':[{'p':18234, 'i':'a'}], 'v':4021, 'source':17}),
+    ('backspace', {'doc':'src.main.py', 'op':[{'p':18233, 'd':'b'}], 'v':4022}),
+    ('paste', {'doc':'src.main.py', 'op':[{'p':90, 'd':'old_name'}, {'p':90, 'i':'new_name = compute(value)\n' * 4}], 'v':4023}),
+    ('ack', {'doc':'src.main.py', 'v':4024}),
+]
+
+def decode(codec, codec_id, payload):
+    message = codec.decode(codec_id, payload)
+    if 'op' in message:
+        message['op'] = op_from_wire(message['op'])
+    return message
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=15)) / number * 1e6
+
+def main(argv):
+    number = int(argv[0]) if argv else 20000
+
+    json_codec = JsonCodec()
+    compact_codec = CompactCodec()
+    compact_codec.assign('src.main.py')
+
+    print('{0:<18}{1:>8}{2:>8}{3:>12}{4:>12}{5:>12}{6:>12}'.format('message', 'json B', 'cmp B', 'json enc', 'cmp enc', 'json dec', 'cmp dec'))
+    for name, message in MESSAGES:
+        json_id, json_payload = json_codec.encode(message)
+        compact_id, compact_payload = compact_codec.encode(message)
+        decoded = decode(compact_codec, compact_id, compact_payload)
+        if 'op' in decoded:
+            decoded['op'] = op_to_wire(decoded['op'])
+        assert decoded == message
+
+        print('{0:<18}{1:>8}{2:>8}{3:>10.2f}us{4:>10.2f}us{5:>10.2f}us{6:>10.2f}us'.format(
+            name, len(json_payload), len(compact_payload),
+            bench(lambda: json_codec.encode(message), number),
+            bench(lambda: compact_codec.encode(message), number),
+            bench(lambda: decode(json_codec, json_id, json_payload), number),
+            bench(lambda: decode(compact_codec, compact_id, compact_payload), number)))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Measures op history memory and transform speed of the internal op types.
+
+Memory is compared against holding the same ops in their wire form, a dict
+per op and per component, which is what the model kept before. With --check
+it instead transforms random op pairs and verifies both orders converge,
+that transforming against two ops in turn matches transforming against
+the two concatenated, that the one pass transform of ops in order matches
+going through them a component at a time, and that composing two ops gives
+the same document as applying them in turn."""
+import sys, os, timeit, tracemalloc, random, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import collab.optransform
+from collab.optransform import op_transform, op_transform_x, _transform_x_components, op_transform_cursor, op_transform_cursors, op_apply, op_compose, op_from_wire
+from collab.model import Op
+
+def traced(build):
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, kept
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def random_op(rnd, doc, count):
+    op = []
+    for _ in range(count):
+        p = rnd.randint(0, len(doc))
+        if doc and rnd.random() < 0.45:
+            p = min(p, len(doc) - 1)
+            c = {'p':p, 'd':doc[p:p + rnd.randint(1, min(4, len(doc) - p))]}
+        else:
+            c = {'p':p, 'i':''.join(rnd.choice('XYZ') for _ in range(rnd.randint(1, 3)))}
+        op.append(c)
+        doc = op_apply(doc, op_from_wire([c]))
+    return op_from_wire(op)
+
+def check(trials):
+    """TP1: applying a then b' gives the same document as b then a'"""
+    rnd = random.Random(0)
+    for _ in range(trials):
+        doc = ''.join(rnd.choice('abcdef') for _ in range(rnd.randint(0, 30)))
+        left, right = random_op(rnd, doc, rnd.randint(0, 6)), random_op(rnd, doc, rnd.randint(0, 6))
+        newLeft, newRight = op_transform_x(left, right)
+        if op_apply(op_apply(doc, left), newRight) != op_apply(op_apply(doc, right), newLeft):
+            print('diverged on {0!r}: {1} against {2}'.format(doc, left, right))
+            return 1
+        # The server transforms a late op against history one op at a time, the client transforms
+        # history against its ops in flight the same way, both have to agree with a single pass
+        later = random_op(rnd, op_apply(doc, right), rnd.randint(0, 6))
+        if op_transform(left, right + later, 'left') != op_transform(newLeft, later, 'left'):
+            print('transforming in turn differs on {0!r}: {1} against {2} then {3}'.format(doc, left, right, later))
+            return 1
+        # Composed ops are in order and long enough to take the one pass transform
+        left, right = op_compose([], random_op(rnd, doc, rnd.randint(8, 30))), op_compose([], random_op(rnd, doc, rnd.randint(8, 30)))
+        if op_transform_x(left, right) != _transform_x_components(left, right):
+            print('one pass transform differs on {0!r}: {1} against {2}'.format(doc, left, right))
+            return 1
+        after = op_apply(doc, left)
+        following = random_op(rnd, after, rnd.randint(0, 6))
+        if op_apply(doc, op_compose(left, following)) != op_apply(after, following):
+            print('composition wrong on {0!r}: {1} then {2}'.format(doc, left, following))
+            return 1
+    print('{0} random op pairs converged, transformed in turn and composed'.format(trials))
+
+def main(argv):
+    if argv and argv[0] == '--check':
+        return check(int(argv[1]) if len(argv) > 1 else 100000)
+    count = int(argv[0]) if argv else 10000
+    wire = [{'doc':'src.main.py', 'v':v, 'op':[{'p':v, 'i':'a'}], 'source':v % 7} for v in range(count)]
+
+    dicts, _ = traced(lambda: [dict(op, op=[dict(c) for c in op['op']]) for op in wire])
+    slotted, _ = traced(lambda: [Op(op['doc'], op['v'], op_from_wire(op['op']), op['source']) for op in wire])
+    print('{0} ops in history: {1:.0f} B/op as dicts, {2:.0f} B/op as Op/Component'.format(count, float(dicts) / count, float(slotted) / count))
+
+    insert = op_from_wire([{'p':10, 'i':'abc'}])
+    delete = op_from_wire([{'p':5, 'd':'xx'}])
+    print('{0:<24}{1:>10.2f}us'.format('insert against delete', bench(lambda: op_transform(insert, delete, 'left'), 100000)))
+
+    many = op_from_wire([{'p':k * 20, 'i':'ab'} if k % 2 else {'p':k * 20, 'd':'xxx'} for k in range(20)])
+    other = op_from_wire([{'p':k * 20 + 3, 'i':'ab'} if k % 2 else {'p':k * 20 + 3, 'd':'xxx'} for k in range(20)])
+    print('{0:<24}{1:>10.2f}us'.format('20 against 20', bench(lambda: op_transform(many, other, 'left'), 200)))
+
+    document = 'abcdefghij' * 100000
+    replace = op_from_wire([c for k in range(5000) for c in ({'p':k * 191 + 5, 'd':'fgh'}, {'p':k * 191 + 5, 'i':'XYZW'})])
+    started = time.time()
+    op_apply(document, replace)
+    print('{0:<24}{1:>10.2f}ms'.format('replace 5000 in 1MB', (time.time() - started) * 1000))
+
+    pending, length = [], 0
+    for k in range(200):
+        if k % 4 == 3:
+            length -= 1
+            pending = op_compose(pending, op_from_wire([{'p':length, 'd':'x'}]))
+        else:
+            pending = op_compose(pending, op_from_wire([{'p':length, 'i':'x'}]))
+            length += 1
+    print('{0:<24}{1:>10}'.format('200 keys, 50 backspaces', '{0} components'.format(len(pending))))
+
+    numpy = collab.optransform.numpy
+    for cursors, components in ((500, 1), (500, 20), (5000, 20)):
+        positions = list(range(0, cursors * 37, 37))
+        op = op_from_wire([{'p':k * 50, 'i':'ab'} if k % 2 else {'p':k * 50, 'd':'xyz'} for k in range(components)])
+        label = '{0} cursors, {1} comps'.format(cursors, components)
+        one = bench(lambda: [op_transform_cursor(x, op) for x in positions], 20)
+        collab.optransform.numpy = None
+        batched = bench(lambda: op_transform_cursors(positions, op), 20)
+        collab.optransform.numpy = numpy
+        vectorized = bench(lambda: op_transform_cursors(positions, op), 20) if numpy is not None else float('nan')
+        print('{0:<24}{1:>10.0f}us one by one, {2:.0f}us batched, {3:.0f}us with numpy'.format(label, one, batched, vectorized))
+
+    for components in (1, 10, 100, 1000, 10000):
+        left = op_from_wire([{'p':k * 10, 'i':'ab'} if k % 2 else {'p':k * 10, 'd':'xyz'} for k in range(components)])
+        right = op_from_wire([{'p':k * 10 + 5, 'i':'cd'} if k % 2 else {'p':k * 10 + 5, 'd':'xyz'} for k in range(components)])
+        started = time.time()
+        op_transform_x(left, right)
+        elapsed = (time.time() - started) * 1000
+        # A component at a time takes minutes at 10000
+        if components <= 1000:
+            started = time.time()
+            _transform_x_components(left, right)
+            print('{0:<24}{1:>10.2f}ms, {2:.2f}ms a component at a time'.format('{0} against {0}'.format(components), elapsed, (time.time() - started) * 1000))
+        else:
+            print('{0:<24}{1:>10.2f}ms'.format('{0} against {0}'.format(components), elapsed))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Measures op throughput of the sharded model against an in-process CollabModel.
+
+Every round submits a batch of ops to each document, each op a few versions
+behind so the model has to transform it, and waits for all of them to be
+acked. Throughput only scales with worker count when there are cores to
+spare, on a single core the pipes are pure overhead."""
+import sys, os, time, threading, multiprocessing
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collab.model import CollabModel
+from collab.shard import ModelProxy
+
+def run(model, docs, rounds, batch, lag):
+    versions = dict((doc, 0) for doc in docs)
+    done = threading.Event()
+    lock = threading.Lock()
+    outstanding = [0]
+
+    def applied(doc, error, version):
+        if error: raise Exception(error)
+        with lock:
+            versions[doc] = max(versions[doc], version + 1)
+            outstanding[0] -= 1
+            if not outstanding[0]: done.set()
+
+    started = time.time()
+    for _ in range(rounds):
+        done.clear()
+        outstanding[0] = len(docs) * batch
+        for doc in docs:
+            base = max(0, versions[doc] - lag)
+            ops = []
+            for source in range(batch):
+                op = {'doc':doc, 'v':base, 'op':[{'p':0, 'i':'word{0} '.format(source)}], 'source':source}
+                ops.append((op, lambda error, version, doc=doc: applied(doc, error, version)))
+            model.apply_ops(doc, ops)
+        done.wait()
+    return rounds * len(docs) * batch / (time.time() - started)
+
+def main(argv):
+    docnames = ['doc{0}'.format(i) for i in range(int(argv[0]) if argv else 64)]
+    rounds, batch, lag = 20, 8, 40
+    print('{0} cpus, {1} docs, {2} ops per doc per round, ops {3} versions behind'.format(multiprocessing.cpu_count(), len(docnames), batch, lag))
+
+    model = CollabModel({})
+    for doc in docnames: model.create(doc, 'x' * 10000)
+    print('{0:<12}{1:>12.0f} ops/s'.format('in-process', run(model, docnames, rounds, batch, lag)))
+
+    for workers in (1, 2, 4, 8):
+        model = ModelProxy({}, workers)
+        created = threading.Semaphore(0)
+        for doc in docnames: model.create(doc, 'x' * 10000, lambda error=None: created.release())
+        for doc in docnames: created.acquire()
+        print('{0:<12}{1:>12.0f} ops/s'.format('{0} workers'.format(workers), run(model, docnames, rounds, batch, lag)))
+        model.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
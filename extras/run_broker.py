@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""Runs the op bus broker that run_server.py --node=N instances join to share documents."""
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collab.bus import BusBroker
+
+def main(argv):
+    secret = None
+    for arg in list(argv):
+        if arg.startswith('--secret='):
+            secret = arg.split('=', 1)[1]
+            argv.remove(arg)
+    if not secret:
+        sys.stderr.write("please provide the secret nodes join with as --secret=<secret>\n")
+        return -2
+
+    host, port = argv[0].split(':', 1) if argv else ('', '')
+    try:
+        # Nodes can make calls into each other's models through the broker, so it stays local unless told otherwise
+        sys.stderr.write('Starting broker at ' + (host or '127.0.0.1') + ':' + (port or '6634') + '\n')
+        BusBroker(host or '127.0.0.1', int(port or 6634), secret).run_forever()
+    except KeyboardInterrupt:
+        sys.stderr.write("^C received, broker stopped")
+        return -1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,6 +5,26 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from collab.server import CollabServer
 
 def main(argv):
+    options = {}
+    for arg in list(argv):
+        if arg.startswith('--workers='):
+            options['workers'] = int(arg.split('=', 1)[1])
+            argv.remove(arg)
+        elif arg.startswith('--node='):
+            options['node'] = int(arg.split('=', 1)[1])
+            argv.remove(arg)
+        elif arg.startswith('--bus='):
+            options['busHost'], options['busPort'] = arg.split('=', 1)[1].split(':', 1)
+            options['busPort'] = int(options['busPort'])
+            argv.remove(arg)
+        elif arg.startswith('--bus-secret='):
+            options['busSecret'] = arg.split('=', 1)[1]
+            argv.remove(arg)
+        elif arg.startswith('--resume-secret='):
+            # Without it clients can not resume their sessions after a restart
+            options['resumeSecret'] = arg.split('=', 1)[1]
+            argv.remove(arg)
+
     if len(argv) == 1:
         if ':' not in argv[0]:
             sys.stderr.write("please provide `host:port' to bind or just `host:' for default port\n")
@@ -25,7 +45,8 @@ def main(argv):
         port = 6633
     try:
         sys.stderr.write('Starting at ' + host +':' + str(port) + '...')
-        server = CollabServer({'host':host, 'port': int(port)})
+        options.update({'host':host, 'port': int(port)})
+        server = CollabServer(options)
         sys.stderr.write(' started.\n')
         server.run_forever()
     except KeyboardInterrupt:
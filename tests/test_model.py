@@ -0,0 +1,102 @@
+import random, unittest
+
+from collab.model import CollabModel, OpHistory, Op
+from collab.optransform import Component, op_apply, op_compose, op_transform
+
+def result(call, *args):
+    out = []
+    call(*(args + (lambda *values: out.append(values),)))
+    return out[0]
+
+def edit(rnd, text, cursor):
+    """Mostly typing and backspacing at a cursor, like an editor sends"""
+    kind = rnd.random()
+    if kind < 0.45:
+        return [Component(cursor, rnd.choice('ab'))], cursor + 1
+    if kind < 0.65 and cursor > 0:
+        return [Component(cursor - 1, None, text[cursor - 1])], cursor - 1
+    if kind < 0.75 and cursor < len(text):
+        return [Component(cursor, None, text[cursor])], cursor
+    if kind < 0.9:
+        p = rnd.randint(0, len(text))
+        return [Component(p, rnd.choice(['x', 'yz']))], p + 1
+    p = rnd.randint(0, len(text))
+    return [Component(p, 'M'), Component(0, 'N')], p
+
+def late_op(rnd, text):
+    op = []
+    for _ in range(rnd.randint(1, 3)):
+        if text and rnd.random() < 0.4:
+            p = rnd.randrange(len(text))
+            n = rnd.randint(1, min(3, len(text) - p))
+            op.append(Component(p, None, text[p:p + n]))
+            text = text[:p] + text[p + n:]
+        else:
+            p = rnd.randint(0, len(text))
+            op.append(Component(p, 'L'))
+            text = text[:p] + 'L' + text[p:]
+    return op
+
+class OpHistoryTest(unittest.TestCase):
+    def test_bounded_by_ops_and_bytes(self):
+        history = OpHistory(5, 10 ** 9)
+        for v in range(8):
+            history.append(Op('d', v, [Component(v, 'a')], 1))
+        self.assertEqual([op.v for op in history], [3, 4, 5, 6, 7])
+        self.assertEqual([op.v for op in history.last(2)], [6, 7])
+        history = OpHistory(100, 10)
+        for v in range(8):
+            history.append(Op('d', v, [Component(0, 'abcd')], 1))
+        self.assertTrue(len(history) < 8)
+
+    def test_typing_is_merged_into_runs(self):
+        history = OpHistory(100, 10 ** 9, run_length=4)
+        for v in range(10):
+            history.append(Op('d', v, [Component(v, 'a')], 1))
+        self.assertEqual(history.suffix(10), [[Component(0, 'aaaa')], [Component(4, 'aaaa')], [Component(8, 'aa')]])
+        self.assertEqual(history.suffix(3), [[Component(7, 'a')], [Component(8, 'aa')]])
+
+    def test_suffix_transforms_like_op_by_op(self):
+        for seed in range(150):
+            rnd = random.Random(seed)
+            text = 'hello world'
+            texts = [text]
+            history = OpHistory(rnd.choice([10, 40, 1000]), 10 ** 9, run_length=rnd.choice([1, 2, 5, 32]))
+            cursor = 3
+            for v in range(rnd.randint(1, 80)):
+                cursor = min(cursor, len(text))
+                op, cursor = edit(rnd, text, cursor)
+                text = op_apply(text, op)
+                texts.append(text)
+                history.append(Op('d', v, op, 1))
+                count = rnd.randint(1, len(history))
+                late = late_op(rnd, texts[v + 1 - count])
+                one_by_one = merged = late
+                for op in history.last(count):
+                    one_by_one = op_transform(one_by_one, op.op, 'left')
+                for op in history.suffix(count):
+                    merged = op_transform(merged, op, 'left')
+                self.assertEqual(op_compose([], merged), op_compose([], one_by_one))
+                self.assertEqual(op_apply(text, merged), op_apply(text, one_by_one))
+
+class ModelTest(unittest.TestCase):
+    def test_late_ops_are_transformed(self):
+        model = CollabModel()
+        result(model.create, 'a.txt', u'abc')
+        self.assertEqual(result(model.apply_op, 'a.txt', {'v': 0, 'op': [{'p': 3, 'i': 'd'}], 'source': 1}), (None, 0))
+        self.assertEqual(result(model.apply_op, 'a.txt', {'v': 0, 'op': [{'p': 0, 'i': 'X'}], 'source': 2}), (None, 1))
+        self.assertEqual(result(model.apply_op, 'a.txt', {'v': 1, 'op': [{'p': 1, 'd': 'b'}], 'source': 1}), (None, 2))
+        error, data = result(model.get_data, 'a.txt')
+        self.assertEqual((data['v'], data['snapshot']), (3, u'Xacd'))
+        model.close()
+
+    def test_bad_ops_are_refused(self):
+        model = CollabModel()
+        result(model.create, 'a.txt', u'abc')
+        for op in ({'v': 1, 'op': [{'p': 0, 'i': 'x'}]}, {'v': 0, 'op': [{'p': 0, 'd': 'x'}]}, {'v': 0, 'op': [{'p': -1, 'i': 'x'}]}):
+            self.assertNotEqual(result(model.apply_op, 'a.txt', dict(op, source=1))[0], None)
+        self.assertEqual(result(model.get_data, 'a.txt')[1]['snapshot'], u'abc')
+        model.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import random, unittest
+
+from collab import optransform
+from collab.optransform import Component, op_from_wire, op_apply, op_compose, op_transform, op_transform_x, op_transform_cursor
+
+def random_op(rnd, doc, count):
+    op = []
+    for _ in range(count):
+        p = rnd.randint(0, len(doc))
+        if doc and rnd.random() < 0.45:
+            p = min(p, len(doc) - 1)
+            c = Component(p, None, doc[p:p + rnd.randint(1, min(4, len(doc) - p))])
+        else:
+            c = Component(p, ''.join(rnd.choice('XYZ') for _ in range(rnd.randint(1, 3))), None)
+        op.append(c)
+        doc = op_apply(doc, [c])
+    return op
+
+class FromWireTest(unittest.TestCase):
+    def test_inserts_and_deletes(self):
+        self.assertEqual(op_from_wire([{'p':3, 'i':'ab'}, {'p':1, 'd':'x'}]), [Component(3, 'ab'), Component(1, None, 'x')])
+
+    def test_missing_position_is_zero(self):
+        self.assertEqual(op_from_wire([{'i':'a'}]), [Component(0, 'a')])
+
+    def test_components_pass_through(self):
+        c = Component(2, 'a')
+        self.assertIs(op_from_wire([c])[0], c)
+
+    def test_rejects_bad_components(self):
+        for c in ('p', None, [1], {'p':1}, {'p':-1, 'i':'a'}, {'p':True, 'i':'a'}, {'p':1.5, 'i':'a'}, {'p':'1', 'i':'a'}, {'p':1, 'i':3}, {'p':1, 'd':None}, {'p':1, 'i':None}):
+            self.assertRaises(ValueError, op_from_wire, [c])
+
+class ApplyTest(unittest.TestCase):
+    def test_components_apply_in_turn(self):
+        self.assertEqual(op_apply('hello world', op_from_wire([{'p':5, 'd':' world'}, {'p':0, 'i':'oh, '}, {'p':9, 'i':'!'}])), 'oh, hello!')
+
+    def test_strict_checks_deleted_text(self):
+        self.assertRaises(Exception, op_apply, 'hello', [Component(0, None, 'jello')])
+        self.assertRaises(Exception, op_apply, 'hello', [Component(7, 'x')])
+
+    def test_trusted_skips_checks(self):
+        self.assertEqual(op_apply('hello', [Component(0, None, 'jel')], False), 'lo')
+
+    def test_matches_component_by_component(self):
+        rnd = random.Random(1)
+        for _ in range(500):
+            doc = ''.join(rnd.choice('abc') for _ in range(rnd.randint(0, 20)))
+            op = random_op(rnd, doc, rnd.randint(1, 8))
+            expected = doc
+            for c in op:
+                if c.i is not None:
+                    expected = expected[:c.p] + c.i + expected[c.p:]
+                else:
+                    expected = expected[:c.p] + expected[c.p + len(c.d):]
+            self.assertEqual(op_apply(doc, op), expected)
+            self.assertEqual(op_apply(doc, op, False), expected)
+
+class ComposeTest(unittest.TestCase):
+    def test_same_document_as_in_turn(self):
+        rnd = random.Random(2)
+        for _ in range(500):
+            doc = ''.join(rnd.choice('abc') for _ in range(rnd.randint(0, 20)))
+            first = random_op(rnd, doc, rnd.randint(0, 6))
+            after = op_apply(doc, first)
+            second = random_op(rnd, after, rnd.randint(0, 6))
+            self.assertEqual(op_apply(doc, op_compose(first, second)), op_apply(after, second))
+
+    def test_cancels_typing_and_backspace(self):
+        self.assertEqual(op_compose([Component(0, 'abc')], [Component(1, None, 'bc')]), [Component(0, 'a')])
+
+class TransformTest(unittest.TestCase):
+    def test_left_insert_wins_ties(self):
+        left, right = [Component(2, 'L')], [Component(2, 'R')]
+        self.assertEqual(op_transform(left, right, 'left'), [Component(2, 'L')])
+        self.assertEqual(op_transform(right, left, 'right'), [Component(3, 'R')])
+
+    def test_delete_around_insert_splits(self):
+        self.assertEqual(op_transform([Component(1, None, 'bcd')], [Component(2, 'X')], 'left'), [Component(1, None, 'b'), Component(2, None, 'cd')])
+
+    def test_side_is_checked(self):
+        self.assertRaises(ValueError, op_transform, [Component(0, 'a')], [Component(0, 'b')], 'middle')
+
+    def test_converges(self):
+        rnd = random.Random(3)
+        for _ in range(2000):
+            doc = ''.join(rnd.choice('abcdef') for _ in range(rnd.randint(0, 30)))
+            left, right = random_op(rnd, doc, rnd.randint(0, 6)), random_op(rnd, doc, rnd.randint(0, 6))
+            newLeft, newRight = op_transform_x(left, right)
+            self.assertEqual(op_apply(op_apply(doc, left), newRight), op_apply(op_apply(doc, right), newLeft))
+
+    def test_in_turn_matches_concatenated(self):
+        rnd = random.Random(4)
+        for _ in range(2000):
+            doc = ''.join(rnd.choice('abcdef') for _ in range(rnd.randint(0, 30)))
+            left, right = random_op(rnd, doc, rnd.randint(0, 6)), random_op(rnd, doc, rnd.randint(0, 6))
+            later = random_op(rnd, op_apply(doc, right), rnd.randint(0, 6))
+            newLeft = op_transform(left, right, 'left')
+            self.assertEqual(op_transform(left, right + later, 'left'), op_transform(newLeft, later, 'left'))
+
+    def test_one_pass_matches_component_by_component(self):
+        rnd = random.Random(5)
+        fast = 0
+        for _ in range(2000):
+            doc = ''.join(rnd.choice('abcdef') for _ in range(rnd.randint(0, 30))) * rnd.choice([1, 4, 20])
+            left, right = op_compose([], random_op(rnd, doc, rnd.randint(8, 30))), op_compose([], random_op(rnd, doc, rnd.randint(8, 30)))
+            linear = optransform._transform_x_linear(left, right)
+            if linear is None:
+                continue
+            fast += 1
+            self.assertEqual(linear, optransform._transform_x_components(left, right))
+            self.assertEqual(op_transform_x(left, right), linear)
+        self.assertTrue(fast > 500)
+
+    def test_cursor_follows_inserts_before_it(self):
+        op = [Component(0, 'ab'), Component(5, None, 'xyz')]
+        self.assertEqual(op_transform_cursor(4, op), 5)
+        self.assertEqual(op_transform_cursor(9, op), 8)
+        self.assertEqual(op_transform_cursor(0, [Component(0, 'ab')]), 0)
+        self.assertEqual(op_transform_cursor(0, [Component(0, 'ab')], True), 2)
+
+if __name__ == '__main__':
+    unittest.main()
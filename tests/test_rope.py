@@ -0,0 +1,64 @@
+import random, unittest
+
+from collab.rope import Rope, LEAF_SIZE
+from collab.optransform import Component, op_apply
+
+class RopeTest(unittest.TestCase):
+    def test_edits_match_strings(self):
+        rnd = random.Random(1)
+        text = ''.join(rnd.choice('abcdefgh\n') for _ in range(LEAF_SIZE * 5))
+        rope = Rope(text)
+        for _ in range(2000):
+            if text and rnd.random() < 0.4:
+                p = rnd.randrange(len(text))
+                n = rnd.randint(1, min(LEAF_SIZE * 3, len(text) - p))
+                rope, text = rope.delete(p, n), text[:p] + text[p + n:]
+            else:
+                p = rnd.randint(0, len(text))
+                s = ''.join(rnd.choice('XYZ') for _ in range(rnd.choice([1, 5, LEAF_SIZE * 2])))
+                rope, text = rope.insert(p, s), text[:p] + s + text[p:]
+            self.assertEqual(len(rope), len(text))
+        self.assertEqual(rope.text(), text)
+        for _ in range(200):
+            a = rnd.randint(0, len(text))
+            b = rnd.randint(a, len(text))
+            self.assertEqual(rope[a:b], text[a:b])
+        self.assertEqual(rope[-1], text[-1])
+
+    def test_edits_leave_the_old_rope_alone(self):
+        rope = Rope('hello world')
+        rope.insert(5, ',').delete(0, 6)
+        self.assertEqual(rope.text(), 'hello world')
+
+    def test_delete_everything(self):
+        rope = Rope(u'中' * (LEAF_SIZE * 3))
+        empty = rope.delete(0, len(rope))
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.text(), u'')
+        self.assertEqual(empty.insert(0, u'a').text(), u'a')
+
+    def test_out_of_range(self):
+        rope = Rope('abc')
+        self.assertRaises(IndexError, rope.insert, 4, 'x')
+        self.assertRaises(IndexError, rope.delete, 2, 2)
+        self.assertRaises(IndexError, lambda: rope[3])
+
+    def test_op_apply_on_ropes(self):
+        rnd = random.Random(2)
+        text = 'abcdefghij' * 2000
+        # Few components edit the rope in place, many rebuild it in one pass
+        for count in (1, 3, 200):
+            op = []
+            doc = text
+            for _ in range(count):
+                p = rnd.randrange(len(doc))
+                c = Component(p, 'XY') if rnd.random() < 0.5 else Component(p, None, doc[p:p + 3])
+                doc = op_apply(doc, [c])
+                op.append(c)
+            result = op_apply(Rope(text), op)
+            self.assertTrue(isinstance(result, Rope))
+            self.assertEqual(result.text(), doc)
+        self.assertRaises(Exception, op_apply, Rope(text), [Component(0, None, 'xyz')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os, shutil, tempfile, unittest
+
+from collab.storage import FileStorage
+from collab.model import CollabModel
+from collab.optransform import Component
+
+def result(call, *args):
+    out = []
+    call(*(args + (lambda *values: out.append(values),)))
+    return out[0]
+
+class FileStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = FileStorage(self.path, {'opsBeforeCommit': 5, 'numCachedOps': 0})
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def write(self, storage, count, start=0):
+        for v in range(start, start + count):
+            self.assertEqual(result(storage.write_op, 'a.txt', {'v': v, 'op': [Component(v, 'x')], 'source': 1}), (None,))
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = FileStorage(self.path, {'opsBeforeCommit': 5, 'numCachedOps': 0})
+        return self.storage
+
+    def test_ops_survive_a_restart(self):
+        self.assertEqual(result(self.storage.create, 'a.txt', {'v': 0, 'snapshot': u'h\xe9llo'}), (None,))
+        self.write(self.storage, 3)
+        storage = self.reopen()
+        self.assertEqual(result(storage.get_docs), (None, ['a.txt']))
+        error, data = result(storage.get_snapshot, 'a.txt')
+        self.assertEqual((data['v'], data['snapshot']), (0, u'h\xe9llo'))
+        error, ops = result(storage.get_ops, 'a.txt', 1)
+        self.assertEqual([(op['v'], op['op']) for op in ops], [(1, [{'p': 1, 'i': 'x'}]), (2, [{'p': 2, 'i': 'x'}])])
+
+    def test_torn_write_is_discarded(self):
+        result(self.storage.create, 'a.txt', {'v': 0, 'snapshot': u''})
+        self.write(self.storage, 2)
+        self.storage.close()
+        with open(os.path.join(self.path, 'a.txt.0.log'), 'ab') as f:
+            f.write(b'{"v":2,"op":[{"p"')
+        storage = self.reopen()
+        error, ops = result(storage.get_ops, 'a.txt', 0)
+        self.assertEqual([op['v'] for op in ops], [0, 1])
+        # Ops written after the torn line are read back
+        self.write(storage, 1, 2)
+        error, ops = result(storage.get_ops, 'a.txt', 0)
+        self.assertEqual([op['v'] for op in ops], [0, 1, 2])
+
+    def test_snapshots_start_segments_and_drop_old_ones(self):
+        result(self.storage.create, 'a.txt', {'v': 0, 'snapshot': u''})
+        self.write(self.storage, 6)
+        result(self.storage.write_snapshot, 'a.txt', {'v': 6, 'snapshot': u'x' * 6})
+        self.write(self.storage, 2, 6)
+        self.storage.flush()
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if name.endswith('.log')), ['a.txt.6.log'])
+        storage = self.reopen()
+        error, data = result(storage.get_snapshot, 'a.txt')
+        self.assertEqual(data['v'], 6)
+        error, ops = result(storage.get_ops, 'a.txt', 6)
+        self.assertEqual([op['v'] for op in ops], [6, 7])
+
+    def test_create_and_delete(self):
+        result(self.storage.create, 'a.txt', {'v': 0, 'snapshot': u''})
+        self.assertEqual(result(self.storage.create, 'a.txt', {'v': 0, 'snapshot': u''}), ('Document already exists',))
+        self.assertEqual(result(self.storage.delete, 'a.txt'), (None,))
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(result(self.storage.get_snapshot, 'a.txt')[0], 'Document does not exist')
+
+class ModelRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def model(self):
+        return CollabModel({'storagePath': self.path, 'opsBeforeCommit': 7, 'numCachedOps': 5})
+
+    def test_document_is_rebuilt_from_snapshot_and_log(self):
+        model = self.model()
+        self.assertEqual(result(model.create, 'a.txt', u'start'), (None,))
+        text = u'start'
+        for v in range(30):
+            p = (v * 7) % (len(text) + 1)
+            self.assertEqual(result(model.apply_op, 'a.txt', {'v': v, 'op': [{'p': p, 'i': u'中'}], 'source': v % 3 + 1}), (None, v))
+            text = text[:p] + u'中' + text[p:]
+        model.close()
+
+        model = self.model()
+        error, data = result(model.get_data, 'a.txt')
+        self.assertEqual((error, data['v'], data['snapshot']), (None, 30, text))
+        # A late op from before the restart is transformed against the logged ops
+        self.assertEqual(result(model.apply_op, 'a.txt', {'v': 28, 'op': [{'p': 0, 'i': u'Q'}], 'source': 1}), (None, 30))
+        error, data = result(model.get_data, 'a.txt')
+        self.assertEqual(data['snapshot'], u'Q' + text)
+        model.close()
+
+if __name__ == '__main__':
+    unittest.main()